@@ -1,11 +1,22 @@
+import asyncio
+import concurrent.futures
 import contextlib
+import functools
+import itertools
 import multiprocessing
+import pickle
 import sys
 import time
 from datetime import datetime
-from threading import Thread, Condition, Lock, Event, RLock
-from queue import Queue, Empty
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from collections import defaultdict, deque, namedtuple
+from threading import Thread, Condition, Lock, Event, RLock, Semaphore, BoundedSemaphore, current_thread, get_ident
+from queue import Queue, PriorityQueue, Empty, Full
+from concurrent.futures import CancelledError
+from concurrent.futures.process import BrokenProcessPool
 from GoldenSource.python.common.domain import Domain
+from GoldenSource.python.utils.patterns import Singleton
 
 
 class CountDownLatch(object):
@@ -42,23 +53,37 @@ class CountDownLatch(object):
             self.lock.wait()
         self.lock.release()
 
+class DeadlineExceededError(TimeoutError):
+    """
+    Error of a Future whose job was dropped for not being started before its deadline
+    """
+
+
 class Future(object):
     """
     Future result object returned when queuing a job in a ThreadPool Trying to get the result will hold until the task is completed.
     The status of the call can be monitored using the done and successful flags. In case of an unsuccessful run, the error details can be retrieved
     with error.
+    A Future is cheap to create: the string rendering of the job is only computed when asked for, and the latch a caller blocks on is only
+    created once someone actually waits. Completion callbacks can be registered with add_done_callback, and a Future can be awaited from asyncio
+    or turned into a concurrent.futures.Future with concurrent_future.
     """
+    __slots__ = ('_func', '_args', '_kwargs', '_result', '_running', '_successful', '_done', '_cancelled', '_error', '_exec_time',
+                 '_latch', '_callbacks', '_deadline')
+
+    # Striped locks guarding the creation of the latches and the registration of the callbacks, the completion of a job only takes one
+    # short uncontended lock
+    _LOCKS = tuple(Lock() for _ in range(64))
 
     def __init__(self, func, *args, **kwargs):
         # Job information
         self._func = func
         self._args = args
         self._kwargs = kwargs
-        self._func_str = self._func.__name__ if hasattr(self._func, '__name__') else str(self._func)
-        self._args_str = ", ".join(repr(v) for v in self._args) + ", ".join("{}={!r}".format(k, repr(v)) for k, v in self._kwargs.items())
-
-        # Lock to restrict certain accesses
-        self._lock = Condition()
+        self._latch = None
+        self._callbacks = None
+        self._cancelled = False
+        self._deadline = None
         self._reset()
 
     def _reset(self):
@@ -72,18 +97,30 @@ class Future(object):
         self._error = None
         self._exec_time = None
 
+    @property
+    def _lock(self):
+        return Future._LOCKS[(id(self) >> 4) & 63]
+
     def __call__(self):
         """
         Calls the inner job all-the-while maintaining all other flags up-to-date
         Note that calling this will effectively be the same as calling the wrapped function with the overhead of setting the internal
         flags and status of the Future object
         """
-        try:
+        with self._lock:
+            if self._cancelled:
+                return None
             self._reset()
-
-            self._lock.acquire()
-            t = time.time()
-            self._running = True
+            expired = self._deadline is not None and time.monotonic() > self._deadline
+            self._running = not expired
+        if expired:
+            # Dropped without running, the job is too late to be of any use
+            error = DeadlineExceededError("{!s} was not started before its deadline".format(self))
+            self._error = (DeadlineExceededError, error, None)
+            self._complete()
+            return None
+        t = time.perf_counter()
+        try:
             self._result = self._func(*self._args, **self._kwargs)
         except:
             self._successful = False
@@ -92,21 +129,121 @@ class Future(object):
             self._successful = True
             return self._result
         finally:
-            self._exec_time = time.time() - t
+            self._exec_time = time.perf_counter() - t
+            self._complete()
+
+    def _complete(self):
+        with self._lock:
             self._done = True
             self._running = False
-            self._lock.notify_all()
-            self._lock.release()
+            latch, callbacks, self._callbacks = self._latch, self._callbacks, None
+        if latch is not None:
+            latch.set()
+        if callbacks:
+            for callback in callbacks:
+                self._run_callback(callback)
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            Domain().logger_service.get_logger(Future.__name__).exception("Error in the done callback of {!s}".format(self))
 
-    def get(self):
+    def _wait(self, timeout=None):
+        """
+        Holds until the job completes
+        :return: True if the job completed, False if the timeout expired
+        """
+        if self._done:
+            return True
+        with self._lock:
+            if self._done:
+                return True
+            if self._latch is None:
+                self._latch = Event()
+            latch = self._latch
+        return latch.wait(timeout)
+
+    def add_done_callback(self, callback):
+        """
+        Calls callback(future) once the job completes, right away if it already did
+        """
+        with self._lock:
+            if not self._done:
+                if self._callbacks is None:
+                    self._callbacks = []
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def cancel(self):
+        """
+        Cancels the job if it has not started yet
+        :return: True if the job got cancelled
+        """
+        with self._lock:
+            if self._running or self._done:
+                return self._cancelled
+            self._cancelled = True
+            self._error = (CancelledError, CancelledError(), None)
+        self._complete()
+        return True
+
+    def cancelled(self):
+        return self._cancelled
+
+    @property
+    def deadline(self):
+        """
+        Returns the time.monotonic() time after which the job is dropped instead of being run, None if there is none
+        """
+        return self._deadline
+
+    @deadline.setter
+    def deadline(self, deadline):
+        self._deadline = deadline
+
+    def get(self, timeout=None):
         """
         Holds until the job completes, then returns the result if the job completed normally.
         The error or exception that caused the job to fail can be retrieved with the error method
         """
-        result = self.result
-        if not self.successful:
-            raise self.error[0]
-        return result
+        if not self._wait(timeout):
+            raise TimeoutError("{!s} did not complete within {}s".format(self, timeout))
+        if not self._successful:
+            raise self._error[1].with_traceback(self._error[2])
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Holds until the job completes, then returns the exception that made it fail, None if it completed normally
+        """
+        if not self._wait(timeout):
+            raise TimeoutError("{!s} did not complete within {}s".format(self, timeout))
+        return None if self._successful else self._error[1]
+
+    def concurrent_future(self):
+        """
+        Returns a concurrent.futures.Future completed along with this future, e.g. for asyncio.wrap_future
+        """
+        future = concurrent.futures.Future()
+
+        def transfer(source):
+            if source.cancelled():
+                future.cancel()
+            elif future.set_running_or_notify_cancel():
+                if source.successful:
+                    future.set_result(source._result)
+                else:
+                    future.set_exception(source._error[1])
+
+        # Cancelling from the consumer side, e.g. an asyncio task, cancels the job if it has not started
+        future.add_done_callback(lambda f: f.cancelled() and self.cancel())
+        self.add_done_callback(transfer)
+        return future
+
+    def __await__(self):
+        return asyncio.wrap_future(self.concurrent_future()).__await__()
 
     @property
     def result(self):
@@ -114,11 +251,7 @@ class Future(object):
         Returns the result of the job if it has completed
         """
         # Block only as long as the job has not completed
-        if not self._done:
-            self._lock.acquire()
-            while not self._done:
-                self._lock.wait()
-            self._lock.release()
+        self._wait()
         return self._result
     
     @property
@@ -156,12 +289,139 @@ class Future(object):
         None is returned if the job has not yet been invoked nor completed
         """
         return self._exec_time
+
+    def _func_str(self):
+        return self._func.__name__ if hasattr(self._func, '__name__') else str(self._func)
+
+    def _args_str(self):
+        return ", ".join([repr(v) for v in self._args] + ["{}={!r}".format(k, v) for k, v in self._kwargs.items()])
     
     def __str__(self):
-        return "{}({})".format(self._func_str, self._args_str)
+        return "{}({})".format(self._func_str(), self._args_str())
     
     def __repr__(self):
-        return "{}({})".format(self.__class__.__name__, self._func_str, self._args_str)
+        return "{}({!s})".format(self.__class__.__name__, self)
+
+# Poison pill stopping the Worker that gets it
+STOP = object()
+# Overall time given to the threads of a pool to stop when it gets terminated
+TERMINATE_TIMEOUT = 2
+
+class WaitTimeStats(object):
+    """
+    Statistics of the time spent by the tasks of a priority class in the queue
+    """
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, wait_time):
+        self.count += 1
+        self.total += wait_time
+        if wait_time > self.max:
+            self.max = wait_time
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def __str__(self):
+        return "count:{} mean:{} max:{}".format(self.count, self.mean, self.max)
+
+    __repr__ = __str__
+
+
+class PriorityTaskQueue(PriorityQueue):
+    """
+    Queue of tasks handing out the task of lowest priority value first, FIFO within a priority. Items are put either as (priority, task) or as a
+    bare task, which goes last: the STOP pills put to terminate a pool only come out after the queued tasks.
+    The time spent by the tasks in the queue is recorded per priority, see wait_times.
+    """
+    LAST = float('inf')
+
+    def _init(self, maxsize):
+        super(PriorityTaskQueue, self)._init(maxsize)
+        self._sequence = itertools.count()
+        self._wait_times = defaultdict(WaitTimeStats)
+
+    def _put(self, item):
+        priority, task = item if isinstance(item, tuple) else (self.LAST, item)
+        super(PriorityTaskQueue, self)._put((priority, next(self._sequence), time.monotonic(), task))
+
+    def _get(self):
+        priority, _, queued_at, task = super(PriorityTaskQueue, self)._get()
+        if task is not STOP:
+            self._wait_times[priority].add(time.monotonic() - queued_at)
+        return task
+
+    def wait_times(self):
+        """
+        Returns a snapshot of the queue wait time statistics {priority: WaitTimeStats}
+        """
+        with self.mutex:
+            snapshot = {}
+            for priority, stats in self._wait_times.items():
+                snapshot[priority] = copy_stats = WaitTimeStats()
+                copy_stats.count, copy_stats.total, copy_stats.max = stats.count, stats.total, stats.max
+            return snapshot
+
+    def head_wait(self):
+        """
+        Returns how long the next task to be handed out has been waiting in the queue, 0 if the queue is empty
+        """
+        with self.mutex:
+            return time.monotonic() - self.queue[0][2] if self.queue else 0.
+
+
+class TimedQueue(Queue):
+    """
+    FIFO queue of tasks keeping track of how long they have been waiting, see head_wait
+    """
+
+    def _put(self, item):
+        super(TimedQueue, self)._put((time.monotonic(), item))
+
+    def _get(self):
+        return super(TimedQueue, self)._get()[1]
+
+    def head_wait(self):
+        """
+        Returns how long the next task to be handed out has been waiting in the queue, 0 if the queue is empty
+        """
+        with self.mutex:
+            return time.monotonic() - self.queue[0][0] if self.queue else 0.
+
+
+def _cancel_queued(tasks):
+    """
+    Empties the queue, cancelling the queued futures
+    """
+    pills = 0
+    while True:
+        try:
+            task = tasks.get_nowait()
+        except Empty:
+            break
+        if task is STOP:
+            pills += 1
+        else:
+            task.cancel()
+        tasks.task_done()
+    # The pills of workers already stopping stay in the queue
+    for _ in range(pills):
+        tasks.put(STOP)
+
+def _join_all(threads, timeout=None):
+    """
+    Joins the threads within an overall timeout, rather than a timeout per thread
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for thread in threads:
+        thread.join(None if deadline is None else max(0., deadline - time.monotonic()))
+    return not any(thread.is_alive() for thread in threads)
 
 class Worker(Thread):
     """
@@ -191,43 +451,48 @@ class Worker(Thread):
     def run(self):
 
         """
-        Starts the worker thread. It will run until terminate is called.
+        Starts the worker thread. It will run until it gets a STOP pill from its queue, see terminate.
         """
-        while not self.stop_request.isSet():
+        while True:
+            future = self.tasks.get()
             try:
-                future = self.tasks.get(block=True, timeout=2)
-            except Empty:
-                pass
+                if future is STOP:
+                    break
+                future()
             except:
-                self.logger.exception()
-            else:
-                try:
-                    future()
-                except:
-                    self.logger.exception("Error while executing {!s}".format(future))
-                    pass
-                finally:
-                    self.tasks.task_done()
+                self.logger.exception("Error while executing {!s}".format(future))
+            finally:
+                self.tasks.task_done()
 
-    def terminate(self):
+    def terminate(self, drain=False):
         """
-        Stops the worker thread
+        Stops the worker thread by queuing a STOP pill, the thread exits as soon as it gets it. Note that with a queue shared by several
+        workers, the pill stops whichever worker gets it first.
+        :param drain: True to run the tasks already queued first, False to cancel them
         """
         self.stop_request.set()
+        if not drain:
+            _cancel_queued(self.tasks)
+        self.tasks.put(STOP)
 
 
 class Threadpool(list):
     SLOTS_MULT = 100
-    """ Pool of threads consuming tasks from a queue """
+    HIGH_PRIORITY = 0
+    DEFAULT_PRIORITY = 5
+    LOW_PRIORITY = 10
+    FIFO_QUEUE = Queue
+    """ Pool of threads consuming tasks from a queue, FIFO by default or by priority first """
 
-    def __init__(self, name, num_threads, num_slots=0, blocking=False):
+    def __init__(self, name, num_threads, num_slots=0, blocking=False, priority=False):
         super(Threadpool, self).__init__()
         self._name = name
         self._blocking = blocking
+        queue_clazz = PriorityTaskQueue if priority else self.FIFO_QUEUE
         if num_slots > 0:
-            self.tasks = Queue(num_slots)
+            self.tasks = queue_clazz(num_slots)
         else:
-            self.tasks = Queue(num_threads * self.SLOTS_MULT)
+            self.tasks = queue_clazz(num_threads * self.SLOTS_MULT)
         for i in range(num_threads):
             self.append(Worker(self.tasks, name="{}:Thread-{}".format(self._name, i)))
 
@@ -239,21 +504,187 @@ class Threadpool(list):
         self.tasks.put(future, block=self._blocking)
         return future
 
+    def schedule_task(self, priority, timeout, func, *args, **kwargs):
+        """
+        Add a task to the queue with a priority and a deadline
+        :param priority: The lower the sooner, only effective on pools created with priority=True
+        :param timeout: Seconds after which the task is dropped if it has not started, its Future failing with a DeadlineExceededError.
+        None for no deadline.
+        """
+        future = Future(func, *args, **kwargs)
+        if timeout is not None:
+            future.deadline = time.monotonic() + timeout
+        self.tasks.put((priority, future) if isinstance(self.tasks, PriorityTaskQueue) else future, block=self._blocking)
+        return future
+
+    def wait_times(self):
+        """
+        Returns the queue wait time statistics {priority: WaitTimeStats}, only recorded on pools created with priority=True
+        """
+        return self.tasks.wait_times() if isinstance(self.tasks, PriorityTaskQueue) else {}
+
     def wait_completion(self):
         """
         Waits for all tasks to be completed
         """
         self.tasks.join()
 
-    def terminate(self):
+    def stop(self, drain=False):
         """
-        Terminates the threadpool, effectively requesting all worker threads to stop and waiting up to 2 seconds per thread.
-        No guarantee is made that the threads will be fully stpped by the time this method returns
+        Requests all worker threads to stop, without waiting for them
+        :param drain: True to run the tasks already queued first, False to cancel them
         """
         for worker in self:
-            worker.terminate()
-        for worker in self:
-            worker.join(2)
+            worker.stop_request.set()
+        if not drain:
+            _cancel_queued(self.tasks)
+        for _ in self:
+            self.tasks.put(STOP)
+
+    def join(self, timeout=None):
+        """
+        Waits for all worker threads to stop, within an overall timeout
+        :return: True if all the threads stopped
+        """
+        return _join_all(self, timeout)
+
+    def terminate(self, drain=False, timeout=TERMINATE_TIMEOUT):
+        """
+        Terminates the threadpool, requesting all worker threads to stop and waiting up to timeout seconds for all of them.
+        No guarantee is made that the threads will be fully stopped by the time this method returns
+        :param drain: True to run the tasks already queued first, False to cancel them
+        """
+        self.stop(drain)
+        return self.join(timeout)
+
+ScalingEvent = namedtuple('ScalingEvent', ['time', 'action', 'size', 'reason'])
+
+
+class ElasticWorker(Worker):
+    """
+    Worker of an ElasticThreadpool, offering to leave the pool after idling for the idle timeout of the pool
+    """
+
+    def __init__(self, pool, name=None):
+        self.pool = pool
+        super(ElasticWorker, self).__init__(pool.tasks, name=name)
+
+    def run(self):
+        while True:
+            try:
+                future = self.tasks.get(timeout=self.pool.idle_timeout)
+            except Empty:
+                if self.pool._reap(self):
+                    break
+                continue
+            try:
+                if future is STOP:
+                    break
+                future()
+            except:
+                self.logger.exception("Error while executing {!s}".format(future))
+            finally:
+                self.tasks.task_done()
+
+
+class ElasticThreadpool(Threadpool):
+    """
+    Threadpool sized between num_threads and max_threads threads. A thread is added when a task is queued while the queue holds more than
+    max_queue_depth tasks or its next task has been waiting for more than max_wait_time seconds (an idle thread would have taken it), and
+    threads above num_threads leave the pool after idling for idle_timeout seconds. The scaling events are kept, see events
+    """
+    DEFAULT_IDLE_TIMEOUT = 60
+    DEFAULT_MAX_QUEUE_DEPTH = 10
+    DEFAULT_MAX_WAIT_TIME = 0.1
+    MAX_EVENTS = 100
+    FIFO_QUEUE = TimedQueue
+    GROW = 'grow'
+    REAP = 'reap'
+
+    def __init__(self, name, num_threads, num_slots=0, blocking=False, priority=False, max_threads=None, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 max_queue_depth=DEFAULT_MAX_QUEUE_DEPTH, max_wait_time=DEFAULT_MAX_WAIT_TIME):
+        self.min_threads = num_threads
+        self.max_threads = max(num_threads, max_threads or num_threads)
+        self.idle_timeout = idle_timeout
+        self.max_queue_depth = max_queue_depth
+        self.max_wait_time = max_wait_time
+        self._scale_lock = Lock()
+        self._stopping = False
+        self._thread_ids = itertools.count()
+        self._events = deque(maxlen=self.MAX_EVENTS)
+        self.logger = Domain().logger_service.get_logger(ElasticThreadpool.__name__)
+        # The queue is sized for the largest pool
+        super(ElasticThreadpool, self).__init__(name, 0, num_slots or self.max_threads * self.SLOTS_MULT, blocking, priority)
+        with self._scale_lock:
+            for _ in range(num_threads):
+                self._add_worker()
+
+    def _add_worker(self):
+        self.append(ElasticWorker(self, name="{}:Thread-{}".format(self._name, next(self._thread_ids))))
+
+    def _record(self, action, reason):
+        event = ScalingEvent(datetime.now(), action, len(self), reason)
+        self._events.append(event)
+        self.logger.info("{} {}s to {} threads: {}".format(self._name, action, event.size, reason))
+
+    def _scale(self):
+        """
+        Adds a thread if the queue is backing up
+        """
+        if len(self) >= self.max_threads:
+            return
+        depth = self.tasks.qsize()
+        if depth <= self.max_queue_depth:
+            wait = self.tasks.head_wait()
+            if wait <= self.max_wait_time:
+                return
+            reason = "next task waiting for {:.4f}s".format(wait)
+        else:
+            reason = "{} tasks queued".format(depth)
+        with self._scale_lock:
+            if self._stopping or len(self) >= self.max_threads:
+                return
+            self._add_worker()
+            self._record(self.GROW, reason)
+
+    def _reap(self, worker):
+        """
+        Removes the idle worker from the pool if the pool is above its minimum size
+        :return: True if the worker must exit
+        """
+        with self._scale_lock:
+            if self._stopping or len(self) <= self.min_threads:
+                return False
+            self.remove(worker)
+            self._record(self.REAP, "idle for {}s".format(self.idle_timeout))
+            return True
+
+    def add_task(self, func, *args, **kwargs):
+        future = super(ElasticThreadpool, self).add_task(func, *args, **kwargs)
+        self._scale()
+        return future
+
+    def schedule_task(self, priority, timeout, func, *args, **kwargs):
+        future = super(ElasticThreadpool, self).schedule_task(priority, timeout, func, *args, **kwargs)
+        self._scale()
+        return future
+
+    @property
+    def size(self):
+        return len(self)
+
+    def events(self):
+        """
+        Returns the latest scaling events, oldest first
+        """
+        return list(self._events)
+
+    def stop(self, drain=False):
+        with self._scale_lock:
+            # The pool does not change size any more, each of its workers gets a pill
+            self._stopping = True
+        super(ElasticThreadpool, self).stop(drain)
+
 
 class AllocatingThreadpool(list):
     SLOTS_MULT = 100
@@ -283,24 +714,38 @@ class AllocatingThreadpool(list):
         Waits for all tasks to be completed
         """
         for worker in self:
-            worker.task.join()
+            worker.tasks.join()
     
-    def terminate(self):
+    def stop(self, drain=False):
         """
-        Terminates the threadpool, effectively requesting all worker threads to stop and waiting up to 2 seconds per thread.
-        No guarantee is made that the threads will be fully stpped by the time this method returns
+        Requests all worker threads to stop, without waiting for them
+        :param drain: True to run the tasks already queued first, False to cancel them
         """
         for worker in self:
-            worker.terminate()
-        for worker in self:
-            worker.join(2)
+            worker.terminate(drain)
+
+    def join(self, timeout=None):
+        """
+        Waits for all worker threads to stop, within an overall timeout
+        :return: True if all the threads stopped
+        """
+        return _join_all(self, timeout)
+
+    def terminate(self, drain=False, timeout=TERMINATE_TIMEOUT):
+        """
+        Terminates the threadpool, requesting all worker threads to stop and waiting up to timeout seconds for all of them.
+        No guarantee is made that the threads will be fully stopped by the time this method returns
+        :param drain: True to run the tasks already queued first, False to cancel them
+        """
+        self.stop(drain)
+        return self.join(timeout)
 
 class AssignedThreadpool(AllocatingThreadpool):
     def __init__(self, name, num_threads, num_slots_per_thread=0, blocking=False):
         super(AssignedThreadpool, self).__init__(name, num_threads, num_slots_per_thread, blocking)
         self._worker_by_subject = {}
         self._load_by_worker = {w: 0 for w in self}
-        self._lock = RLock()
+        self._lock = lock_monitor.lock("{}.assign".format(name), RLock())
 
     def _work_for_subject(self, subject):
         return 1
@@ -324,6 +769,300 @@ class AssignedThreadpool(AllocatingThreadpool):
                     self._load_by_worker[worker] += new_work
         return worker
 
+class StealingWorker(Thread):
+    """
+    Worker of a WorkStealingThreadpool: runs the tasks of its own deque first, then steals from the other workers
+    """
+
+    def __init__(self, pool, index, name=None):
+        super(StealingWorker, self).__init__(name=name)
+        self.pool = pool
+        self.index = index
+        self.tasks = deque()
+        self.stop_request = Event()
+        self.daemon = True
+        self.logger_service = Domain().logger_service
+        self.logger = self.logger_service.get_logger(StealingWorker.__name__)
+        self.start()
+
+    def _find_task(self):
+        # The owner takes the oldest task of its deque, thieves take the newest ones so that both ends rarely collide
+        try:
+            return self.tasks.popleft()
+        except IndexError:
+            pass
+        workers = self.pool
+        for offset in range(1, len(workers)):
+            try:
+                return workers[(self.index + offset) % len(workers)].tasks.pop()
+            except IndexError:
+                continue
+        return None
+
+    def _next_task(self):
+        """
+        Returns the task matching the release of the semaphore taken, None if that task was cancelled or the worker stopped.
+        A single pass over the deques can miss the task, taken by another worker which then leaves a task added meanwhile to
+        a deque already passed, so the deques are scanned until a task turns up.
+        """
+        pool = self.pool
+        while True:
+            task = self._find_task()
+            if task is not None:
+                return task
+            with pool._all_done:
+                if pool._vanished:
+                    pool._vanished -= 1
+                    return None
+            if self.stop_request.is_set():
+                return None
+            time.sleep(0)
+
+    def run(self):
+        """
+        Starts the worker thread. It will run until terminate is called.
+        """
+        pool = self.pool
+        while True:
+            # Each release of the semaphore matches a queued task, or a cancelled one, see WorkStealingThreadpool._cancel_queued
+            pool._queued.acquire()
+            if self.stop_request.is_set():
+                break
+            task = self._next_task()
+            if task is None:
+                continue
+            try:
+                task()
+            except:
+                self.logger.exception("Error while executing {!s}".format(task))
+            finally:
+                pool._task_done()
+
+    def terminate(self):
+        """
+        Stops the worker thread once it wakes up, see WorkStealingThreadpool.stop
+        """
+        self.stop_request.set()
+
+
+class WorkStealingThreadpool(list):
+    SLOTS_MULT = 100
+    """
+    Pool of threads each owning a deque of tasks, idle threads stealing the tasks of the busy ones. Tasks are spread
+    round-robin over the deques, and a task added from one of the worker threads goes to the deque of that thread.
+    """
+
+    def __init__(self, name, num_threads, num_slots=0, blocking=False):
+        super(WorkStealingThreadpool, self).__init__()
+        self._name = name
+        self._blocking = blocking
+        self._slots = BoundedSemaphore(num_slots if num_slots > 0 else num_threads * self.SLOTS_MULT)
+        self._queued = Semaphore(0)
+        self._unfinished = 0
+        # Cancelled tasks whose release of the semaphore a worker already took, that worker giving up its search for one
+        self._vanished = 0
+        self._all_done = Condition()
+        self._next_worker = itertools.count()
+        self._draining = False
+        for i in range(num_threads):
+            self.append(StealingWorker(self, i, name="{}:Thread-{}".format(self._name, i)))
+
+    def _target_worker(self):
+        worker = current_thread()
+        if isinstance(worker, StealingWorker) and worker.pool is self:
+            return worker
+        return self[next(self._next_worker) % len(self)]
+
+    def _reserve(self):
+        if not self._slots.acquire(blocking=self._blocking):
+            raise Full()
+
+    def _submit(self, task, worker=None, reserve=True):
+        """
+        Queues a task on the deque of the worker, by default the current worker thread or the next one round-robin
+        :param reserve: False if a queue slot was already reserved for the task
+        """
+        if reserve:
+            self._reserve()
+        with self._all_done:
+            self._unfinished += 1
+        (worker or self._target_worker()).tasks.append(task)
+        self._queued.release()
+
+    def _task_done(self):
+        self._slots.release()
+        with self._all_done:
+            self._unfinished -= 1
+            if not self._unfinished:
+                self._all_done.notify_all()
+
+    def add_task(self, func, *args, **kwargs):
+        """
+        Add a task to the queue
+        """
+        future = Future(func, *args, **kwargs)
+        self._submit(future)
+        return future
+
+    def schedule_task(self, priority, timeout, func, *args, **kwargs):
+        """
+        Add a task to the queue with a deadline, see Threadpool.schedule_task. The deques are FIFO, the priority is ignored.
+        """
+        future = Future(func, *args, **kwargs)
+        if timeout is not None:
+            future.deadline = time.monotonic() + timeout
+        self._submit(future)
+        return future
+
+    def wait_times(self):
+        return {}
+
+    def wait_completion(self):
+        """
+        Waits for all tasks to be completed
+        """
+        with self._all_done:
+            while self._unfinished:
+                self._all_done.wait()
+
+    def _stop_workers(self):
+        for worker in self:
+            worker.terminate()
+        # Wake every worker up, they exit instead of looking for a task
+        for _ in self:
+            self._queued.release()
+
+    def _cancel_queued(self):
+        """
+        Cancels the queued tasks. Each cancelled task takes back its release of the semaphore, or when a worker already
+        took it lets that worker give up its search, and gives back its queue slots.
+        """
+        cancelled = vanished = 0
+        for worker in self:
+            while True:
+                try:
+                    task = worker.tasks.popleft()
+                except IndexError:
+                    break
+                cancelled += 1
+                if not self._queued.acquire(blocking=False):
+                    vanished += 1
+                if isinstance(task, _SubjectLane):
+                    with task.lock:
+                        futures = list(task.futures)
+                        task.futures.clear()
+                else:
+                    futures = (task,)
+                for future in futures:
+                    future.cancel()
+                    self._slots.release()
+        with self._all_done:
+            self._unfinished -= cancelled
+            self._vanished += vanished
+            if not self._unfinished:
+                self._all_done.notify_all()
+
+    def stop(self, drain=False):
+        """
+        Requests all worker threads to stop. When draining, the workers are only stopped by join, once the queued tasks are done.
+        :param drain: True to run the tasks already queued first, False to cancel them
+        """
+        self._draining = drain
+        if not drain:
+            self._cancel_queued()
+            self._stop_workers()
+
+    def join(self, timeout=None):
+        """
+        Waits for all worker threads to stop, within an overall timeout
+        :return: True if all the threads stopped
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self._draining:
+            with self._all_done:
+                while self._unfinished:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self._all_done.wait(remaining)
+            self._draining = False
+            self._stop_workers()
+        return _join_all(self, None if deadline is None else max(0., deadline - time.monotonic()))
+
+    def terminate(self, drain=False, timeout=TERMINATE_TIMEOUT):
+        """
+        Terminates the threadpool, requesting all worker threads to stop and waiting up to timeout seconds for all of them.
+        No guarantee is made that the threads will be fully stopped by the time this method returns
+        :param drain: True to run the tasks already queued first, False to cancel them
+        """
+        self.stop(drain)
+        return self.join(timeout)
+
+
+class _SubjectLane(object):
+    """
+    Ordered tasks of one subject of a StealingAssignedThreadpool. At most one runner of the lane is queued at any time,
+    so the tasks of the subject run one after the other in order, on whichever worker picks the runner up.
+    """
+
+    def __init__(self, pool, worker):
+        self.pool = pool
+        self.worker = worker
+        self.futures = deque()
+        self.lock = Lock()
+
+    def add(self, future):
+        # Every future holds a queue slot, whereas the runner is only queued when the lane was idle
+        self.pool._reserve()
+        with self.lock:
+            self.futures.append(future)
+            schedule = len(self.futures) == 1
+        if schedule:
+            self.pool._submit(self, self.worker, reserve=False)
+
+    def __call__(self):
+        future = self.futures[0]
+        try:
+            future()
+        finally:
+            with self.lock:
+                self.futures.popleft()
+                schedule = bool(self.futures)
+            if schedule:
+                # Queued behind the tasks of the current worker, other subjects get their turn
+                self.pool._submit(self, current_thread(), reserve=False)
+
+    def __str__(self):
+        return str(self.futures[0]) if self.futures else "empty lane"
+
+
+class StealingAssignedThreadpool(WorkStealingThreadpool):
+    """
+    Work-stealing pool with the interface of AssignedThreadpool: the tasks of a subject run in order and never
+    concurrently, but a subject is not pinned to a worker, a backed-up subject's work moves to the idle workers
+    """
+
+    def __init__(self, name, num_threads, num_slots_per_thread=0, blocking=False):
+        super(StealingAssignedThreadpool, self).__init__(name, num_threads, num_slots_per_thread * num_threads, blocking)
+        self._lane_by_subject = {}
+        self._lock = RLock()
+
+    def add_task(self, subject, func, *args, **kwargs):
+        """
+        Add a task to the queue of the subject
+        """
+        lane = self._lane_by_subject.get(subject)
+        if lane is None:
+            with self._lock:
+                lane = self._lane_by_subject.get(subject)
+                if lane is None:
+                    worker = self[len(self._lane_by_subject) % len(self)]
+                    lane = self._lane_by_subject[subject] = _SubjectLane(self, worker)
+        future = Future(func, *args, **kwargs)
+        lane.add(future)
+        return future
+
+
 def spawn(f):
     def fun(q_in, q_out):
         while True:
@@ -353,6 +1092,306 @@ def parmap(f, X, nprocs=multiprocessing.cpu_count()):
     return [x for i, x in sorted(res)]
 
 
+def _process_worker(f, initializer, initargs, q_in, q_out):
+    """
+    Loop of the ProcessPool worker processes: runs the initializer once, then maps the chunks of items sent by the pool. The chunks come as
+    (index, func, items), func None standing for the function of the pool, and their results go back as (index, pickled (successful, results
+    or error)). The results are pickled here rather than by the feeder thread of the queue, which would drop those that cannot be pickled.
+    """
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        task = q_in.get()
+        if task is None:
+            break
+        i, func, chunk = task
+        func = f if func is None else func
+        try:
+            result = (True, [func(x) for x in chunk])
+        except Exception as ex:
+            result = (False, ex)
+        try:
+            data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as ex:
+            data = pickle.dumps((False, RuntimeError("Cannot send the results of {} back: {!r}".format(func, ex))),
+                                protocol=pickle.HIGHEST_PROTOCOL)
+        q_out.put((i, data))
+
+
+class ProcessPool(object):
+    """
+    Persistent version of parmap: the worker processes are forked once, inheriting the memory of the parent at that
+    time (e.g. a warm graph), and then run f, or the function given to each map call, over the items of every map call.
+    initializer(*initargs) runs once in each worker when it starts, e.g. to load configuration or open connections.
+    The items are sent to the workers in chunks of chunksize items, at most max_pending chunks per call at a time so that neither the input
+    nor the results pile up in the queues. Calls run concurrently, including a call made while iterating over the results of another: one
+    caller at a time reads the results queue and hands the results over to their calls.
+    A worker process dying, e.g. killed by the OS, breaks the pool: the calls waiting for results raise BrokenProcessPool.
+    """
+    DEFAULT_PENDING_PER_PROC = 2
+    # Seconds spent waiting for a result before checking that the workers are alive
+    LIVENESS_INTERVAL = 0.1
+
+    def __init__(self, f=None, nprocs=multiprocessing.cpu_count(), initializer=None, initargs=(), chunksize=1, max_pending=None):
+        # Fork explicitly, the workers rely on inheriting the state of the parent
+        context = multiprocessing.get_context('fork')
+        # Workers share the resource tracker of the parent, which then accounts for the shared memory they attach (see map_array)
+        resource_tracker.ensure_running()
+        self.nprocs = nprocs
+        self.chunksize = chunksize
+        self.max_pending = max_pending or nprocs * self.DEFAULT_PENDING_PER_PROC
+        self.q_in = context.Queue()
+        self.q_out = context.Queue()
+        self._condition = Condition()
+        self._calls = itertools.count()
+        # The results received and not consumed yet {call: {chunk index: (successful, results or error)}}
+        self._results = {}
+        self._reading = False
+        self._broken = None
+        self.procs = [context.Process(target=_process_worker, args=(f, initializer, initargs, self.q_in, self.q_out)) for _ in range(nprocs)]
+        for p in self.procs:
+            p.daemon = True
+            p.start()
+
+    def imap(self, X, func=None, chunksize=None):
+        """
+        Runs func, f by default, over X in the worker processes, streaming the results
+        Only max_pending chunks are in flight at any time: X is consumed lazily and the workers wait for the consumer of the results.
+        :return: Generator of the results, in the order of X. The first error raised by func is raised when its result is reached
+        """
+        chunksize = chunksize or self.chunksize
+        chunks = _chunks(X, chunksize)
+        with self._condition:
+            if self.procs is None:
+                raise RuntimeError('The process pool is closed')
+            if self._broken is not None:
+                raise BrokenProcessPool(self._broken)
+            call = next(self._calls)
+            self._results[call] = {}
+        sent = received = 0
+        try:
+            for chunk in itertools.islice(chunks, self.max_pending):
+                self.q_in.put(((call, sent), func, chunk))
+                sent += 1
+            while received < sent:
+                # Results come back in any order, yield them in order and top up the workers as they do
+                successful, results = self._result(call, received)
+                received += 1
+                for chunk in itertools.islice(chunks, 1):
+                    self.q_in.put(((call, sent), func, chunk))
+                    sent += 1
+                if not successful:
+                    raise results
+                yield from results
+        finally:
+            # Abandoned or failed halfway, the results of the chunks still in flight are dropped as they come
+            with self._condition:
+                del self._results[call]
+
+    def _result(self, call, i):
+        """
+        Waits for the result of the chunk i of the call, reading the results queue unless another caller already does
+        :return: (successful, results or error)
+        """
+        while True:
+            with self._condition:
+                results = self._results[call]
+                while i not in results and self._reading and self._broken is None:
+                    self._condition.wait()
+                if i in results:
+                    return results.pop(i)
+                if self._broken is not None:
+                    raise BrokenProcessPool(self._broken)
+                self._reading = True
+            try:
+                self._read()
+            finally:
+                with self._condition:
+                    self._reading = False
+                    self._condition.notify_all()
+
+    def _read(self):
+        """
+        Reads a result off the queue and hands it over to its call, checking that the workers are alive when none comes
+        """
+        try:
+            (call, i), data = self.q_out.get(timeout=self.LIVENESS_INTERVAL)
+        except Empty:
+            dead = [p.pid for p in self.procs or () if not p.is_alive()]
+            if dead:
+                with self._condition:
+                    self._broken = "The worker processes {} died, their results are lost".format(dead)
+            return
+        try:
+            result = pickle.loads(data)
+        except Exception as ex:
+            result = (False, RuntimeError("Cannot receive the results of the pool: {!r}".format(ex)))
+        with self._condition:
+            # The results of the abandoned calls are dropped
+            if call in self._results:
+                self._results[call][i] = result
+
+    def map(self, X, func=None, chunksize=None):
+        """
+        Runs func, f by default, over X in the worker processes
+        :return: The list of the results, in the order of X
+        """
+        return list(self.imap(X, func, chunksize))
+
+    def map_array(self, func, X, rows=None, out_dtype=None, out_shape=None):
+        """
+        Runs the vectorized func over slices of rows of the NumPy array or DataFrame X in the worker processes, without pickling the data:
+        X is copied once into shared memory, the workers get the bounds of their slices and write the results of func into a shared output
+        array allocated upfront.
+        func gets an array, or a DataFrame for DataFrame inputs, and returns the rows of output of its slice. It must be picklable, e.g. a
+        module function, and must not keep references to its input.
+        :param rows: Number of rows per slice, by default X is cut into 4 slices per process
+        :param out_dtype: dtype of the output, the dtype of X by default
+        :param out_shape: Shape of a row of output, the shape of a row of X by default
+        :return: The output array, or a Series/DataFrame with the index of X for DataFrame inputs
+        :raise ValueError: If X or the output hold Python objects, e.g. DataFrames with string columns, which cannot live in shared memory
+        """
+        import numpy
+
+        frame = None
+        if not isinstance(X, numpy.ndarray):
+            frame, X = X, X.to_numpy()
+        n = len(X)
+        out_dtype = X.dtype if out_dtype is None else numpy.dtype(out_dtype)
+        for name, dtype in (('X', X.dtype), ('The output', out_dtype)):
+            if dtype.hasobject:
+                raise ValueError("{} has dtype {}, map_array only shares numeric arrays: convert the columns first, or use map".format(
+                    name, dtype))
+        out_shape = X.shape[1:] if out_shape is None else tuple(out_shape)
+        rows = rows or max(1, -(-n // (self.nprocs * 4)))
+        with _SharedArray.create(X.shape, X.dtype, X) as source, _SharedArray.create((n,) + out_shape, out_dtype) as target:
+            if frame is not None:
+                source.columns = list(frame.columns)
+            self.map([(start, min(start + rows, n)) for start in range(0, n, rows)],
+                     functools.partial(_map_array_slice, func, source, target), chunksize=1)
+            with target.attach() as out:
+                out = out.copy()
+        if frame is None:
+            return out
+        import pandas
+        if out.ndim == 1:
+            return pandas.Series(out, index=frame.index)
+        return pandas.DataFrame(out, index=frame.index, columns=frame.columns if out.shape[1] == frame.shape[1] else None)
+
+    def close(self):
+        with self._condition:
+            if self.procs is None:
+                return
+            procs, self.procs = self.procs, None
+        if self._broken is None:
+            [self.q_in.put(None) for _ in procs]
+        else:
+            # A dead worker may have left the locks of the queues taken, the other workers could block on them forever
+            [p.terminate() for p in procs]
+        [p.join() for p in procs]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _SharedArray(object):
+    """
+    Description of an array held in shared memory, pickled to the workers instead of the data
+    """
+
+    def __init__(self, shm, shape, dtype):
+        self.shm = shm
+        self.name = shm.name
+        self.shape = shape
+        self.dtype = dtype
+        self.columns = None
+
+    @classmethod
+    def create(cls, shape, dtype, data=None):
+        import numpy
+
+        dtype = numpy.dtype(dtype)
+        shm = SharedMemory(create=True, size=max(1, int(numpy.prod(shape)) * dtype.itemsize))
+        array = cls(shm, shape, dtype)
+        if data is not None:
+            with array.attach() as view:
+                view[...] = data
+        return array
+
+    @contextlib.contextmanager
+    def attach(self):
+        """
+        Yields the array over the shared memory, which must not be referenced anymore on exit
+        """
+        import numpy
+
+        shm = self.shm or SharedMemory(name=self.name)
+        view = numpy.ndarray(self.shape, self.dtype, buffer=shm.buf)
+        try:
+            yield view
+        finally:
+            del view
+            if self.shm is None:
+                shm.close()
+
+    def wrap(self, rows, start, stop):
+        """
+        Returns the slice of rows as a DataFrame if the array comes from one
+        """
+        if self.columns is None:
+            return rows
+        import pandas
+        return pandas.DataFrame(rows, columns=self.columns, index=pandas.RangeIndex(start, stop), copy=False)
+
+    def __getstate__(self):
+        return self.name, self.shape, self.dtype, self.columns
+
+    def __setstate__(self, state):
+        self.shm = None
+        self.name, self.shape, self.dtype, self.columns = state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _map_array_slice(func, source, target, bounds):
+    start, stop = bounds
+    error = None
+    with source.attach() as X, target.attach() as out:
+        try:
+            out[start:stop] = func(source.wrap(X[start:stop], start, stop))
+        except Exception as ex:
+            # The traceback references the slice, which must be released before detaching the shared memory
+            error = ex.with_traceback(None)
+        del X, out
+    if error is not None:
+        raise error
+
+
+def array_parmap(f, X, nprocs=multiprocessing.cpu_count(), rows=None, out_dtype=None, out_shape=None):
+    """
+    parmap counterpart for NumPy arrays and DataFrames, passing slices of rows through shared memory, see ProcessPool.map_array
+    """
+    with ProcessPool(nprocs=nprocs) as pool:
+        return pool.map_array(f, X, rows, out_dtype, out_shape)
+
+
+def _chunks(X, chunksize):
+    iterator = iter(X)
+    while True:
+        chunk = list(itertools.islice(iterator, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
 class Timer(Thread):
     counter = 0
 
@@ -396,6 +1435,79 @@ class Timer(Thread):
     def __repr__(self):
         return "{}({!r},{!r},{!r},{!r},{!r})".format(self.__class__.__name__, self.stopped, self.fcn, self.interval, self.name, self.immediate)
 
+class AsyncTimer(object):
+    """
+    asyncio counterpart of Timer: calls fcn every interval seconds from a task of the event loop instead of a thread of its own.
+    fcn is either a coroutine function, awaited on the loop, or a plain callable, run on executor (see ThreadpoolService.get_executor) so
+    that blocking calls do not stall the loop. executor None is the default executor of the loop.
+    """
+    counter = 0
+
+    def __init__(self, fcn, interval=1, name=None, immediate=False, executor=None):
+        if not name:
+            self.name = "AsyncTimer-{}".format(AsyncTimer.counter)
+            AsyncTimer.counter += 1
+        else:
+            self.name = name
+        self.immediate = immediate
+        self.interval = interval
+        self.last_called = None
+        self.fcn = fcn
+        self.executor = executor
+        self.task = None
+        self._stopped = None
+        self.logger_service = Domain().logger_service
+        self.logger = self.logger_service.get_logger(self.__class__.__name__)
+
+    def start(self):
+        """
+        Starts the timer on the running event loop
+        :return: The asyncio task of the timer
+        """
+        self._stopped = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    def stop(self):
+        """
+        Stops the timer after the current call if any, await join() to wait for it
+        """
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def join(self):
+        if self.task is not None:
+            await self.task
+
+    async def _call(self):
+        try:
+            if asyncio.iscoroutinefunction(self.fcn):
+                await self.fcn()
+            else:
+                await asyncio.get_running_loop().run_in_executor(self.executor, self.fcn)
+        except Exception:
+            self.logger.exception("{} failed".format(self.fcn))
+        finally:
+            self.last_called = datetime.now()
+
+    async def run(self):
+        if self.immediate:
+            self.immediate = False
+            await self._call()
+
+        while not self._stopped.is_set():
+            try:
+                await asyncio.wait_for(self._stopped.wait(), self.interval)
+            except asyncio.TimeoutError:
+                await self._call()
+
+    def __str__(self):
+        return "{}<every {:.4f} seconds>".format(self.name, self.interval)
+
+    def __repr__(self):
+        return "{}({!r},{!r},{!r},{!r})".format(self.__class__.__name__, self.fcn, self.interval, self.name, self.immediate)
+
+
 class NotifiableTimer(Thread):
     counter = 0
 
@@ -470,7 +1582,352 @@ class NotifiableTimer(Thread):
                                                      , self.name)
 
 
+class LockStats(object):
+    """
+    Contention statistics of a named lock: how many acquisitions, how many had to wait, how long they waited and how long the lock was held
+    """
+    __slots__ = ('name', 'acquisitions', 'contentions', 'wait_total', 'wait_max', 'hold_total', 'hold_max', '_mutex')
+
+    def __init__(self, name):
+        self.name = name
+        self.acquisitions = 0
+        self.contentions = 0
+        self.wait_total = 0.
+        self.wait_max = 0.
+        self.hold_total = 0.
+        self.hold_max = 0.
+        self._mutex = Lock()
+
+    def _acquired(self, wait):
+        with self._mutex:
+            self.acquisitions += 1
+            if wait is not None:
+                self.contentions += 1
+                self.wait_total += wait
+                if wait > self.wait_max:
+                    self.wait_max = wait
+
+    def _released(self, hold):
+        with self._mutex:
+            self.hold_total += hold
+            if hold > self.hold_max:
+                self.hold_max = hold
+
+    def copy(self):
+        stats = LockStats(self.name)
+        with self._mutex:
+            for attr in LockStats.__slots__[1:-1]:
+                setattr(stats, attr, getattr(self, attr))
+        return stats
+
+    def __str__(self):
+        return "{} acquisitions:{} contentions:{} wait:{:.6f}s (max {:.6f}s) hold:{:.6f}s (max {:.6f}s)".format(
+            self.name, self.acquisitions, self.contentions, self.wait_total, self.wait_max, self.hold_total, self.hold_max)
+
+    __repr__ = __str__
+
+
+class InstrumentedLock(object):
+    """
+    Lock or RLock wrapper recording its contention in LockStats, see LockMonitor.lock
+    """
+    __slots__ = ('_lock', '_stats', '_depth', '_acquired_at', '_owner')
+
+    def __init__(self, lock, stats):
+        self._lock = lock
+        self._stats = stats
+        self._depth = 0
+        self._acquired_at = None
+        self._owner = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        wait = None
+        if not self._lock.acquire(False):
+            if not blocking:
+                return False
+            t = time.perf_counter()
+            if not self._lock.acquire(True, timeout):
+                return False
+            wait = time.perf_counter() - t
+        # Only the holder gets here, the RLock owner re-entering included
+        self._depth += 1
+        if self._depth == 1:
+            self._acquired_at = time.perf_counter()
+            self._owner = get_ident()
+        self._stats._acquired(wait)
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._stats._released(time.perf_counter() - self._acquired_at)
+            self._owner = None
+        self._lock.release()
+
+    def locked(self):
+        return self._depth > 0
+
+    def _is_owned(self):
+        """
+        Used by Condition, which otherwise checks the ownership by acquiring the lock, recording fake acquisitions
+        """
+        return self._owner == get_ident()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __repr__(self):
+        return "InstrumentedLock({!r})".format(self._stats.name)
+
+
+class LockMonitor(object):
+    """
+    Registry of the named locks of the application. When instrumentation is enabled, with the instrument parameter of the locks section or
+    enable(), lock() wraps the locks it creates in InstrumentedLock, and the statistics of each name are available from snapshot() and
+    report(). Disabled, lock() hands out the plain lock: no overhead on acquire and release.
+    Only the locks created while enabled are instrumented.
+    """
+
+    def __init__(self):
+        self._enabled = None
+        self._stats = {}
+        self._mutex = Lock()
+
+    @property
+    def enabled(self):
+        if self._enabled is None:
+            # Resolved from the configuration once there is one
+            domain = Singleton._instances.get(Domain)
+            if domain is None:
+                return False
+            self._enabled = bool(domain.get_param('locks', 'instrument', default=False))
+        return self._enabled
+
+    def enable(self, enabled=True):
+        self._enabled = enabled
+
+    def lock(self, name, lock=None):
+        """
+        Returns the lock, a new Lock by default, instrumented under the given name if enabled
+        """
+        lock = Lock() if lock is None else lock
+        stats = self.stats(name)
+        return lock if stats is None else InstrumentedLock(lock, stats)
+
+    def stats(self, name):
+        """
+        Returns the LockStats of the given name for the synchronization objects recording their own statistics, None if disabled
+        """
+        if not self.enabled:
+            return None
+        with self._mutex:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = LockStats(name)
+        return stats
+
+    def snapshot(self):
+        """
+        Returns a copy of the statistics of the named locks {name: LockStats}
+        """
+        with self._mutex:
+            stats = list(self._stats.values())
+        return {s.name: s.copy() for s in stats}
+
+    def report(self):
+        """
+        Returns the statistics of the named locks, one line per lock from the longest waits down
+        """
+        stats = sorted(self.snapshot().values(), key=lambda s: s.wait_total, reverse=True)
+        return "\n".join(str(s) for s in stats)
+
+    def reset(self):
+        with self._mutex:
+            self._stats = {}
+
+
+lock_monitor = LockMonitor()
+
+
 class RWLock(object):
+    """
+    Readers-writer lock built on a single condition variable: readers and writers take one mutex to update the counters and only wait on
+    the condition when they have to.
+    Writers have priority: no reader enters while a writer is waiting, and when the last writer leaves, all the waiting readers enter at once.
+    A reentrant lock lets a thread take the read lock again, or the write lock again, or the read lock while holding the write lock.
+    A reader can upgrade to the write lock, and a writer downgrade to the read lock, without letting another writer in between.
+    With lock instrumentation enabled (see LockMonitor), the waits are recorded under <name>.read and <name>.write.
+    """
+
+    def __init__(self, name='RWLock', reentrant=False):
+        self._mutex = lock_monitor.lock("{}.mutex".format(name))
+        self._condition = Condition(self._mutex)
+        self._reentrant = reentrant
+        self._readers = 0
+        self._writers_waiting = 0
+        self._writer = None
+        self._write_depth = 0
+        self._upgrading = None
+        self._upgraded_reads = 0
+        # Read lock depths per thread, kept by reentrant locks only
+        self._read_depths = {} if reentrant else None
+        self._read_stats = lock_monitor.stats("{}.read".format(name))
+        self._write_stats = lock_monitor.stats("{}.write".format(name))
+        self._write_acquired_at = None
+
+    @contextlib.contextmanager
+    def read_lock(self):
+        self.reader_acquire()
+        try:
+            yield
+        finally:
+            self.reader_release()
+
+    @contextlib.contextmanager
+    def write_lock(self):
+        self.writer_acquire()
+        try:
+            yield
+        finally:
+            self.writer_release()
+
+    def reader_acquire(self):
+        # The mutex directly rather than through the condition, the uncontended path is the one to make fast
+        with self._mutex:
+            if self._writer is None and not self._writers_waiting and not self._reentrant:
+                self._readers += 1
+                if self._read_stats is not None:
+                    self._read_stats._acquired(None)
+                return
+            if self._reentrant:
+                me = get_ident()
+                depth = self._read_depths.get(me, 0)
+                if depth or self._writer == me:
+                    # Already in, waiting for the pending writers would deadlock
+                    self._read_depths[me] = depth + 1
+                    self._readers += 1
+                    return
+            wait = None
+            if self._writer is not None or self._writers_waiting:
+                t = time.perf_counter()
+                while self._writer is not None or self._writers_waiting:
+                    self._condition.wait()
+                wait = time.perf_counter() - t
+            self._readers += 1
+            if self._reentrant:
+                self._read_depths[me] = 1
+            if self._read_stats is not None:
+                self._read_stats._acquired(wait)
+
+    def reader_release(self):
+        with self._mutex:
+            self._readers -= 1
+            if self._reentrant:
+                me = get_ident()
+                depth = self._read_depths[me] - 1
+                if depth:
+                    self._read_depths[me] = depth
+                else:
+                    del self._read_depths[me]
+            # Only writers, the upgrading reader included, wait for readers to leave
+            if self._writers_waiting and (not self._readers or self._upgrading is not None):
+                self._condition.notify_all()
+
+    def writer_acquire(self):
+        me = get_ident()
+        with self._condition:
+            if self._writer == me:
+                if not self._reentrant:
+                    raise RuntimeError("The write lock is already held by the current thread and the lock is not reentrant")
+                self._write_depth += 1
+                return
+            wait = None
+            self._writers_waiting += 1
+            try:
+                if self._readers or self._writer is not None:
+                    t = time.perf_counter()
+                    while self._readers or self._writer is not None:
+                        self._condition.wait()
+                    wait = time.perf_counter() - t
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._write_depth = 1
+            if self._write_stats is not None:
+                self._write_stats._acquired(wait)
+                self._write_acquired_at = time.perf_counter()
+
+    def writer_release(self):
+        with self._condition:
+            self._write_depth -= 1
+            if self._write_depth:
+                return
+            if self._write_stats is not None:
+                self._write_stats._released(time.perf_counter() - self._write_acquired_at)
+            if self._upgraded_reads and self._reentrant:
+                # The read locks were consumed by the upgrade
+                me = get_ident()
+                depth = self._read_depths[me] - self._upgraded_reads
+                if depth:
+                    self._read_depths[me] = depth
+                else:
+                    del self._read_depths[me]
+            self._writer = None
+            self._upgraded_reads = 0
+            self._condition.notify_all()
+
+    def upgrade(self):
+        """
+        Turns the read lock of the current thread into the write lock, waiting for the other readers to leave. No other writer gets in in
+        between, so what was read still holds. Only one reader can be upgrading at a time.
+        """
+        me = get_ident()
+        with self._condition:
+            if self._upgrading is not None:
+                raise RuntimeError("Another reader is upgrading, upgrading as well would deadlock")
+            reads = self._read_depths[me] if self._reentrant else 1
+            self._upgrading = me
+            # Counted as a waiting writer, no new reader gets in
+            self._writers_waiting += 1
+            try:
+                while self._readers > reads or self._writer is not None:
+                    self._condition.wait()
+            finally:
+                self._writers_waiting -= 1
+                self._upgrading = None
+            self._readers -= reads
+            self._upgraded_reads = reads
+            self._writer = me
+            self._write_depth = 1
+            if self._write_stats is not None:
+                self._write_acquired_at = time.perf_counter()
+
+    def downgrade(self):
+        """
+        Turns the write lock of the current thread back into the read lock(s) it was upgraded from, or a read lock, letting the readers in
+        """
+        with self._condition:
+            if self._write_stats is not None:
+                self._write_stats._released(time.perf_counter() - self._write_acquired_at)
+            if self._upgraded_reads:
+                # The read locks of a reentrant lock were still counted in the depth of the thread
+                self._readers += self._upgraded_reads
+            else:
+                self._readers += 1
+                if self._reentrant:
+                    me = get_ident()
+                    self._read_depths[me] = self._read_depths.get(me, 0) + 1
+            self._writer = None
+            self._write_depth = 0
+            self._upgraded_reads = 0
+            self._condition.notify_all()
+
+
+class SemaphoreRWLock(object):
     """Synchronization object used in a solution of so-called second 
     readers-writers problem. In this problem, many readers can simultaneously 
     access a share, and a writer has an exclusive access to this share.
@@ -492,14 +1949,15 @@ class RWLock(object):
     [3] http://en.wikipedia.org/wiki/Readers-writers_problem
     """
 
-    def __init__(self):
-        self._read_switch = _LightSwitch()
-        self._write_switch = _LightSwitch()
-        self._no_readers = Lock()
-        self._no_writers = Lock()
-        self._readers_queue = Lock()
+    def __init__(self, name='RWLock'):
+        self._read_switch = _LightSwitch("{}.read_switch".format(name))
+        self._write_switch = _LightSwitch("{}.write_switch".format(name))
+        self._no_readers = lock_monitor.lock("{}.no_readers".format(name))
+        self._no_writers = lock_monitor.lock("{}.no_writers".format(name))
+        self._readers_queue = lock_monitor.lock("{}.readers_queue".format(name))
         """A lock giving an even higher priority to the writer in certain
         cases (see [2] for a discussion)"""
+        # Kept as the reference for RWLock, which replaced it, see the benchmark in concurrency_test
 
     @contextlib.contextmanager
     def read_lock(self):
@@ -536,9 +1994,9 @@ class RWLock(object):
 class _LightSwitch:
     """An auxiliary "light switch"-like object. The first thread turns on the 
     "switch", the last one turns it off (see [1, sec. 4.2.2] for details)."""
-    def __init__(self):
+    def __init__(self, name='LightSwitch'):
         self.__counter = 0
-        self.__mutex = Lock()
+        self.__mutex = lock_monitor.lock(name)
     
     def acquire(self, lock):
         with self.__mutex:
@@ -4,7 +4,7 @@ import os
 import time
 import pytz
 from collections import defaultdict
-from threading import Event, RLock
+from threading import RLock
 from functools import reduce
 
 import Ice
@@ -13,7 +13,9 @@ from GS.dataobjects import OnDemandAllocation
 from GS.exceptions import ValidateException
 from GS.interfaces import Allocator as IceAllocator, AllocatorPrx, OnDemandAllocator as IceOnDemandAllocator
 
-from GoldenSource.python.common.concurrency import Timer, ThreadpoolService
+from GoldenSource.python.common.concurrency import lock_monitor
+from GoldenSource.python.services.scheduler_service import SchedulerService, ScheduledJob
+from GoldenSource.python.services.threadpool_service import ThreadpoolService
 from GoldenSource.python.ice.ice_service import IceService, ListenerProxyCache
 from GoldenSource.python.ice.servant import AMDContext, IceServant
 # from GoldenSource.infra import TidalService
@@ -106,7 +108,8 @@ class AllocatorServant(IceAllocator, IceServant):
         IceAllocator.__init__(self)
         IceServant.__init__(self, domain)
 
-        self._event = Event()
+        self._scheduler = domain.get_service(SchedulerService)
+        self._jobs = []
 
         self._node_watch = {}
         # will be used to track the nodes that have been spawned once
@@ -229,19 +232,18 @@ class AllocatorServant(IceAllocator, IceServant):
         # Prepare allocations
         self._allocate()
 
-        # Start the reallocation thread
+        # Schedule the reallocations, each one after the previous one completed
         interval = self.domain.get_param('app', 'reallocation_interval', default=120)
-        reallocation_timer = Timer(self._event, self._allocate, interval)
-        reallocation_timer.start()
+        self._jobs.append(self._scheduler.schedule(self._allocate, interval, name='Reallocation', mode=ScheduledJob.FIXED_DELAY))
 
-        # Start the administration thread
+        # Schedule the administration of the nodes
         admin_interval = self.domain.get_param('app', 'admin_interval', default=5)
-        admin_timer = Timer(self._event, self._administrate_nodes, admin_interval)
-        admin_timer.start()
+        self._jobs.append(self._scheduler.schedule(self._administrate_nodes, admin_interval, name='Administration'))
         self.logger.info('{} ready'.format(self.app_name))
 
     def ice_shutdown(self):
-        self._event.set()
+        for job in self._jobs:
+            job.cancel()
         self.logger.info('{} shutting down'.format(self.app_name))
 
     def _get_instance_id(self, i):
@@ -393,7 +395,7 @@ class OnDemandAllocatorServant(IceOnDemandAllocator, AllocatorServant):
 
         def __init__(self, domain):
             self._logger = domain.logger_service.get_logger(self.__class__.__name__)
-            self._universe_lock = RLock()
+            self._universe_lock = lock_monitor.lock('OnDemandAllocator.universe', RLock())
             self._universe = defaultdict(dict)
 
         @property
@@ -481,7 +483,7 @@ class OnDemandAllocatorServant(IceOnDemandAllocator, AllocatorServant):
     class IdleNodePool(object):
         def __init__(self, domain):
             self._logger = domain.logger_service.get_logger(self.__class__.__name__)
-            self._idle_nodes_lock = RLock()
+            self._idle_nodes_lock = lock_monitor.lock('OnDemandAllocator.idle_nodes', RLock())
             self._idle_nodes = []
 
         def push(self, node_id, node_fut):
@@ -529,9 +531,9 @@ class OnDemandAllocatorServant(IceOnDemandAllocator, AllocatorServant):
             self._node_handler = node_handler
             self._allocation_maker = allocation_maker
             self._logger = domain.logger_service.get_logger(self.__class__.__name__)
-            self._pending_runs_lock = RLock()
+            self._pending_runs_lock = lock_monitor.lock('OnDemandAllocator.pending_runs', RLock())
             self._pending_runs = []
-            self._pending_clients_lock = RLock()
+            self._pending_clients_lock = lock_monitor.lock('OnDemandAllocator.pending_clients', RLock())
             self._pending_clients = {}
 
         def on_run_allocated(self, node_id, element, client_id, client_fut=None):
@@ -782,29 +784,28 @@ class NodeServant(IceServant):
         self.proxy_cache = domain.get_service(ListenerProxyCache)
         self.notifier = domain.get_service(self.NOTIFIER_SERVICE)
 
-        self._timer_event = Event()
+        self._scheduler = domain.get_service(SchedulerService)
+        self._jobs = []
 
-        cycle_interval = self.domain.get_param('app', 'cycle_interval', default=120)
-        self._cycle_timer = Timer(self._timer_event, self._execute_cycle, cycle_interval,
-                                  name='CycleThread')
+        self._cycle_interval = self.domain.get_param('app', 'cycle_interval', default=120)
 
         self._cycle_id = 0
         self._cycles_failed = 0
         self._cycle_failure_limit = self.domain.get_param('app', 'cycle_failure_limit', default=25)
 
-        heartbeat_interval = self.domain.get_param('app', 'heartbeat_interval', default=5)
-        self._heartbeat_timer = Timer(self._timer_event, self._heartbeat, heartbeat_interval,
-                                      name='HeartBeatThread')
+        self._heartbeat_interval = self.domain.get_param('app', 'heartbeat_interval', default=5)
+        self._heartbeat_jitter = self.domain.get_param('app', 'heartbeat_jitter', default=0)
 
     def ice_init(self):
         self.logger.info('Starting {}'.format(self.app_name))
-        self._heartbeat_timer.start()
+        self._jobs.append(self._scheduler.schedule(self._heartbeat, self._heartbeat_interval, name='HeartBeat', jitter=self._heartbeat_jitter))
         self._register()
-        self._cycle_timer.start()
+        self._jobs.append(self._scheduler.schedule(self._execute_cycle, self._cycle_interval, name='Cycle'))
         self.logger.info('{} ready'.format(self.app_name))
 
     def ice_shutdown(self):
-        self._timer_event.set()
+        for job in self._jobs:
+            job.cancel()
         self.logger.info('{} shutting down'.format(self.app_name))
         if self._cycles_failed > self._cycle_failure_limit:
             exit(99)
@@ -1,42 +1,187 @@
 import contextlib
-import sys
+import functools
+import hashlib
+import io
+import math
+import multiprocessing
+import os
+import pickle
+import weakref
+from array import array
 import time
 from collections import defaultdict
-from threading import current_thread
+from threading import current_thread, get_ident, local, Lock
 
 class CLEAR(object):
   """Placeholder to use for a cleared value"""
 
+class GraphEvaluationError(Exception):
+    """
+    Raised when the evaluation of a vertex fails. The original exception is the __cause__, vertices is the chain of
+    the vertices being evaluated when it was raised, from the outermost to the one that failed.
+    """
+
+    def __init__(self, vertices, cause):
+        self.vertices = tuple(vertices)
+        self.cause = cause
+        super(GraphEvaluationError, self).__init__(
+            "{}: {!r}".format(" -> ".join(str(vertex) for vertex in self.vertices), cause))
+
+    def __reduce__(self):
+        return self.__class__, (self.vertices, self.cause)
+
 CLEAR = CLEAR()
 
+class _ActiveChild(local):
+    """
+    The vertex being computed in a GraphState, tracked per thread so that several threads can share a state.
+    frozen tells whether the dependencies of that vertex are frozen, see Graph.freeze.
+    """
+    vertex = None
+    frozen = False
+
 class GraphState(dict):
     """
-    A PayloadCache holds a mapping of Vertex to VertexPayload representing a particular state of this graph
+    A GraphState holds a mapping of Vertex to VertexPayload representing a particular state of this graph.
+    States can be layered: a state with a parent only holds the payloads it actually touched (diddled, recomputed or
+    invalidated) and falls through to its parent for everything else, which makes creating a child state O(1).
+    A state can be bounded: once it holds more than capacity payloads, the valid computed payloads are evicted down to
+    LOW_WATERMARK of the capacity, either the least recently used ones (LRU) or, among the least recently used, the
+    cheapest to recompute according to the profiler of the graph (COST). Fixed payloads are never evicted.
     """
+    LRU = 'lru'
+    COST = 'cost'
+    LOW_WATERMARK = 0.9
+    COST_WINDOW = 4
+
     _next_depth = 0
 
-    def __init__(self, graph):
+    def __init__(self, graph, parent_state=None, capacity=None, eviction=LRU):
         super(GraphState, self).__init__()
         self._depth = GraphState._next_depth
         GraphState._next_depth += 1
         self._graph = graph
-        self._active_child = None
+        self._parent_state = parent_state
+        self._active_child = _ActiveChild()
+        self._capacity = None
+        self.set_capacity(capacity, eviction)
+        if graph is not None and graph._weak_objects:
+            graph._states.add(self)
 
     def __del__(self):
         GraphState._next_depth -= 1
 
     @property
     def active_child(self):
-        return self._active_child
+        return self._active_child.vertex
 
     @active_child.setter
     def active_child(self, value):
-        self._active_child = value
+        self._active_child.vertex = value
+
+    @property
+    def parent_state(self):
+        return self._parent_state
+
+    def lookup(self, vertex):
+        """
+        Returns the payload of the vertex effective in this state, falling through to the parent states if this state
+        does not own one. None is returned if no state in the chain holds a payload for the vertex.
+        """
+        state = self
+        while state is not None:
+            payload = dict.get(state, vertex)
+            if payload is not None:
+                return payload
+            state = state._parent_state
+        return None
+
+    def own(self, vertex):
+        """
+        Returns the payload of the vertex owned by this state, creating it if needed. The new payload does not inherit
+        the value of the parent states, it is meant to be either computed or fixed.
+        """
+        payload = dict.get(self, vertex)
+        if payload is None:
+            payload = self.setdefault(vertex, VertexPayload(vertex, self))
+            if self._capacity is not None and len(self) > self._capacity:
+                self.evict()
+        return payload
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def set_capacity(self, capacity, eviction=LRU):
+        """
+        Bounds the number of payloads held by this state, None for no bound
+        :param eviction: GraphState.LRU or GraphState.COST
+        """
+        if eviction not in (self.LRU, self.COST):
+            raise ValueError('Unknown eviction policy {}'.format(eviction))
+        self._eviction = eviction
+        self._capacity = capacity
+        if capacity is not None and len(self) > capacity:
+            self.evict()
+
+    def touch(self, vertex):
+        """
+        Marks the payload of the vertex as the most recently used, called on the hits of bounded states
+        """
+        # Re-inserting the key moves it to the end of the dict, which then iterates from the least recently used.
+        # Not done while the state is shared between threads, where the payload must stay visible at all times
+        if not self._graph._concurrency:
+            payload = self.pop(vertex, None)
+            if payload is not None:
+                self[vertex] = payload
+
+    def evict(self):
+        """
+        Evicts valid computed payloads down to the low watermark of the capacity
+        :return: The number of evicted payloads
+        """
+        count = len(self) - int(self._capacity * self.LOW_WATERMARK)
+        if count <= 0:
+            return 0
+        candidates = [vertex for vertex, payload in list(self.items()) if payload._flags == _VALID]
+        profiler = self._graph._profiler if self._graph is not None else None
+        if self._eviction == self.COST and profiler is not None:
+            def cost(vertex):
+                profile = profiler._profiles.get(vertex)
+                return (profile.mean_time or 0.) if profile is not None else 0.
+            # The cheapest payloads among the least recently used ones
+            window = sorted(candidates[:count * self.COST_WINDOW], key=cost)
+            candidates = window + candidates[count * self.COST_WINDOW:]
+        evicted = candidates[:count]
+        for vertex in evicted:
+            self.discard(vertex)
+        return len(evicted)
+
+    def release(self, vertex):
+        """
+        Forgets the payload of a vertex whose GraphObject died
+        """
+        dict.pop(self, vertex, None)
+
+    def discard(self, vertex):
+        """
+        Removes the payload of the vertex from this state. If a parent state still holds a payload for it, an empty
+        payload is left behind to mask it.
+        """
+        self.pop(vertex, None)
+        if self._parent_state is not None and self._parent_state.lookup(vertex) is not None:
+            self[vertex] = VertexPayload(vertex, self)
 
     def copy(self, other=None):
         if other is None:
             other = GraphState(self._graph)
-        other.update({vx_id: vx.clone(other) for vx_id, vx in self.items()})
+        chain = []
+        state = self
+        while state is not None:
+            chain.append(state)
+            state = state._parent_state
+        for state in reversed(chain):
+            other.update({vx_id: vx.clone(other) for vx_id, vx in state.items()})
         return other
 
     def __hash__(self):
@@ -45,22 +190,702 @@ class GraphState(dict):
     def __eq__(self,other):
         return id(self) == id(other)
 
+_NO_EDGES = frozenset()
+
+class SetEdgeStore(object):
+    """
+    Default edge store, keeping the parents and children of each vertex in sets held by the vertex itself.
+    The sets are only allocated once the vertex gets its first edge.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+
+    def has_edge(self, parent, child):
+        return parent in child._parents
+
+    def add_edge(self, parent, child):
+        if child._parents is _NO_EDGES or parent._children is _NO_EDGES:
+            with self._lock:
+                if child._parents is _NO_EDGES:
+                    child._parents = set()
+                if parent._children is _NO_EDGES:
+                    parent._children = set()
+        child._parents.add(parent)
+        parent._children.add(child)
+
+    def parents(self, vertex):
+        return vertex._parents
+
+    def children(self, vertex):
+        return vertex._children
+
+    def remove_vertex(self, vertex):
+        with self._lock:
+            for parent in vertex._parents:
+                parent._children.discard(vertex)
+            for child in vertex._children:
+                child._parents.discard(vertex)
+            vertex._parents = vertex._children = _NO_EDGES
+
+class ArrayEdgeStore(object):
+    """
+    Compact edge store: each vertex is given an integer id and its parents and children are kept as arrays of ids,
+    which takes a fraction of the memory of a pair of sets. Membership checks are linear in the number of edges of a
+    vertex, so this store suits graphs made of millions of vertices with a small fan-in/fan-out.
+    """
+    TYPECODE = 'l'
+
+    def __init__(self):
+        self._vertices = []
+        self._lock = Lock()
+
+    def _vertex_id(self, vertex):
+        if vertex._vid is None:
+            vertex._vid = len(self._vertices)
+            self._vertices.append(vertex)
+        return vertex._vid
+
+    def has_edge(self, parent, child):
+        return parent._vid is not None and parent._vid in child._parents
+
+    def add_edge(self, parent, child):
+        with self._lock:
+            parent_id = self._vertex_id(parent)
+            child_id = self._vertex_id(child)
+            if parent_id in child._parents:
+                return
+            if child._parents is _NO_EDGES:
+                child._parents = array(self.TYPECODE)
+            if parent._children is _NO_EDGES:
+                parent._children = array(self.TYPECODE)
+            child._parents.append(parent_id)
+            parent._children.append(child_id)
+
+    def parents(self, vertex):
+        vertices = self._vertices
+        return tuple(vertices[vid] for vid in vertex._parents)
+
+    def children(self, vertex):
+        vertices = self._vertices
+        return tuple(vertices[vid] for vid in vertex._children)
+
+    def remove_vertex(self, vertex):
+        with self._lock:
+            vid = vertex._vid
+            if vid is None:
+                return
+            for parent_id in vertex._parents:
+                children = self._vertices[parent_id]._children
+                children.remove(vid)
+            for child_id in vertex._children:
+                parents = self._vertices[child_id]._parents
+                parents.remove(vid)
+            # The id is not reused, the slot only stops referencing the vertex
+            self._vertices[vid] = None
+            vertex._parents = vertex._children = _NO_EDGES
+            vertex._vid = None
+
+class DurationHistogram(object):
+    """
+    Bounded histogram of durations with logarithmic buckets: bucket 0 holds the durations up to RESOLUTION seconds and
+    every following bucket doubles the upper bound of the previous one, the last bucket catching everything above.
+    """
+    BUCKETS = 32
+    RESOLUTION = 1e-6
+
+    __slots__ = ('counts',)
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+
+    def add(self, duration):
+        if duration <= self.RESOLUTION:
+            bucket = 0
+        else:
+            bucket = min(int(math.log2(duration / self.RESOLUTION)) + 1, self.BUCKETS - 1)
+        self.counts[bucket] += 1
+
+    def upper_bound(self, bucket):
+        return self.RESOLUTION * 2 ** bucket
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, q):
+        """
+        Returns the upper bound of the bucket holding the q-th percentile (0 < q <= 100), None if empty
+        """
+        total = self.count
+        if not total:
+            return None
+        threshold = total * q / 100.
+        cumulated = 0
+        for bucket, count in enumerate(self.counts):
+            cumulated += count
+            if cumulated >= threshold:
+                return self.upper_bound(bucket)
+        return self.upper_bound(self.BUCKETS - 1)
+
+class VertexProfile(object):
+    """
+    Profiling statistics of a single vertex
+    """
+    __slots__ = ('vertex', 'hits', 'misses', 'self_time', 'inclusive_time', 'histogram')
+
+    def __init__(self, vertex):
+        self.vertex = vertex
+        self.hits = 0
+        self.misses = 0
+        self.self_time = 0.
+        self.inclusive_time = 0.
+        self.histogram = DurationHistogram()
+
+    @property
+    def hit_ratio(self):
+        calls = self.hits + self.misses
+        return self.hits / calls if calls else None
+
+    @property
+    def mean_time(self):
+        """
+        Mean inclusive time of an evaluation
+        """
+        return self.inclusive_time / self.misses if self.misses else None
+
+    def __str__(self):
+        return "{}<hits={}, misses={}, self={:.6f}s, inclusive={:.6f}s>".format(
+            self.vertex, self.hits, self.misses, self.self_time, self.inclusive_time)
+
+    __repr__ = __str__
+
+class GraphProfiler(object):
+    """
+    Collects per vertex statistics while attached to a Graph (see Graph.enable_profiling):
+    - hits (value served from a payload) and misses (value computed) counts
+    - self time (excluding the evaluation of the parents) and inclusive time of the evaluations
+    - a bounded histogram of the inclusive evaluation times
+    - self times aggregated per evaluation stack, exportable in the collapsed stack format used by flame graph tools
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._local = local()
+        self._profiles = {}
+        self._stacks = defaultdict(float)
+
+    def _profile(self, vertex):
+        profile = self._profiles.get(vertex)
+        if profile is None:
+            profile = self._profiles.setdefault(vertex, VertexProfile(vertex))
+        return profile
+
+    def _frames(self):
+        frames = getattr(self._local, 'frames', None)
+        if frames is None:
+            frames = self._local.frames = []
+        return frames
+
+    def hit(self, vertex):
+        with self._lock:
+            self._profile(vertex).hits += 1
+
+    def enter(self, vertex):
+        # Frame: vertex, start time, time spent evaluating parents
+        self._frames().append([vertex, time.perf_counter(), 0.])
+
+    def exit(self, vertex):
+        frames = self._frames()
+        if not frames or frames[-1][0] is not vertex:
+            # Profiling got enabled while the vertex was being computed
+            return
+        _, start_time, parents_time = frames.pop()
+        inclusive_time = time.perf_counter() - start_time
+        self_time = inclusive_time - parents_time
+        if frames:
+            frames[-1][2] += inclusive_time
+        stack = tuple(frame[0]._id for frame in frames) + (vertex._id,)
+
+        with self._lock:
+            profile = self._profile(vertex)
+            profile.misses += 1
+            profile.self_time += self_time
+            profile.inclusive_time += inclusive_time
+            profile.histogram.add(inclusive_time)
+            self._stacks[stack] += self_time
+
+    @property
+    def profiles(self):
+        """
+        Returns a snapshot of the statistics as a dictionary {vertex: VertexProfile}
+        """
+        with self._lock:
+            return dict(self._profiles)
+
+    def reset(self):
+        with self._lock:
+            self._profiles = {}
+            self._stacks = defaultdict(float)
+
+    def to_collapsed(self):
+        """
+        Returns the self times aggregated per evaluation stack in the collapsed stack format ("a;b;c <value>"), the
+        values being expressed in microseconds
+        """
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+        return "\n".join("{} {}".format(";".join(stack), int(round(self_time * 1e6))) for stack, self_time in stacks)
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_collapsed())
+            f.write("\n")
+
+    def to_dataframe(self):
+        """
+        Returns the statistics as a pandas DataFrame, one row per vertex, sorted by descending self time
+        """
+        import pandas
+        rows = [
+            {
+                'vertex': str(profile.vertex),
+                'hits': profile.hits,
+                'misses': profile.misses,
+                'hit_ratio': profile.hit_ratio,
+                'self_time': profile.self_time,
+                'inclusive_time': profile.inclusive_time,
+                'mean_time': profile.mean_time,
+                'p50': profile.histogram.percentile(50),
+                'p99': profile.histogram.percentile(99),
+            }
+            for profile in self.profiles.values()
+        ]
+        columns = ['vertex', 'hits', 'misses', 'hit_ratio', 'self_time', 'inclusive_time', 'mean_time', 'p50', 'p99']
+        return pandas.DataFrame(rows, columns=columns).sort_values('self_time', ascending=False, ignore_index=True)
+
+class PersistentStore(object):
+    """
+    Local content-addressed cache of the values of the persisted vertices (see Vertex(persist=True)).
+    The manifest of a persisted vertex lists its upstream vertices. Its value is stored under a digest of the vertex
+    identity and of the values fixed on those upstream vertices when it got evaluated: changing an input addresses
+    another entry, setting the input back addresses the former one again.
+    Upstream vertices are identified across processes by the persist_key of their GraphObject, a vertex is only
+    persisted if all its upstream vertices can be identified that way.
+    """
+    MANIFEST_EXT = '.manifest'
+    VALUE_EXT = '.value'
+
+    def __init__(self, graph, path):
+        self._graph = graph
+        self._path = os.path.expandvars(os.path.expanduser(path))
+        os.makedirs(self._path, exist_ok=True)
+
+    @property
+    def path(self):
+        return self._path
+
+    def _file(self, digest, ext):
+        return os.path.join(self._path, digest + ext)
+
+    @staticmethod
+    def _pickle(data):
+        buffer = io.BytesIO()
+        pickler = pickle.Pickler(buffer, protocol=4)
+        # Without memo the bytes only depend on the values, not on which objects happen to be shared. Cyclic values
+        # raise a ValueError, they cannot be persisted
+        pickler.fast = True
+        pickler.dump(data)
+        return buffer.getvalue()
+
+    @classmethod
+    def _canonical(cls, data, path):
+        """
+        Returns data with the elements of its sets sorted, as the iteration order of a set of strings depends on
+        PYTHONHASHSEED. Only the builtin containers are traversed: the sets held by other objects are pickled as they
+        come, hence may miss the cache of another process.
+        """
+        kind = type(data)
+        if kind not in (list, tuple, dict, set, frozenset):
+            return data
+        if id(data) in path:
+            raise ValueError("Cannot digest a cyclic {} value".format(kind.__name__))
+        path.add(id(data))
+        try:
+            if kind is dict:
+                return {key: cls._canonical(value, path) for key, value in data.items()}
+            elements = [cls._canonical(element, path) for element in data]
+            if kind is list:
+                return elements
+            if kind is tuple:
+                return tuple(elements)
+            return kind.__name__, sorted(elements, key=cls._pickle)
+        finally:
+            path.discard(id(data))
+
+    @classmethod
+    def _digest(cls, data):
+        return hashlib.sha1(cls._pickle(cls._canonical(data, set()))).hexdigest()
+
+    def _read(self, file_path):
+        try:
+            with open(file_path, 'rb') as f:
+                return True, pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+
+    def _write(self, file_path, data):
+        tmp_path = '{}.{}.{}.tmp'.format(file_path, os.getpid(), get_ident())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, file_path)
+
+    def _inputs_digest(self, descriptor, upstream):
+        """
+        Digest of the vertex descriptor and of the values fixed on its upstream vertices in the active state
+        """
+        state = self._graph.active_state
+        inputs = []
+        for upstream_descriptor, vertex in upstream:
+            payload = state.lookup(vertex)
+            if payload is not None and payload.is_fixed():
+                inputs.append((upstream_descriptor, True, payload._value))
+            else:
+                inputs.append((upstream_descriptor, False, None))
+        return self._digest((descriptor, inputs))
+
+    def load(self, vertex):
+        """
+        Looks the value of the vertex up
+        :return: (True, value) if found, (False, None) otherwise
+        """
+        descriptor = describe_vertex(vertex)
+        if descriptor is None:
+            return False, None
+        found, manifest = self._read(self._file(self._digest(descriptor), self.MANIFEST_EXT))
+        if not found:
+            return False, None
+
+        upstream = []
+        for upstream_descriptor in manifest:
+            upstream_vertex = resolve_vertex(upstream_descriptor)
+            if upstream_vertex is None:
+                return False, None
+            upstream.append((upstream_descriptor, upstream_vertex))
+
+        try:
+            inputs_digest = self._inputs_digest(descriptor, upstream)
+        except (pickle.PicklingError, TypeError, AttributeError, ValueError):
+            return False, None
+        found, value = self._read(self._file(inputs_digest, self.VALUE_EXT))
+        if found:
+            # The upstream vertices are not evaluated, link them directly so that changing them invalidates the vertex
+            for _, upstream_vertex in upstream:
+                self._graph._add_edge(upstream_vertex, vertex)
+        return found, value
+
+    def save(self, vertex, value):
+        """
+        Stores the value of a vertex that just got evaluated, its upstream vertices being known to the graph by now
+        :return: True if the value got stored
+        """
+        descriptor = describe_vertex(vertex)
+        if descriptor is None:
+            return False
+
+        upstream = []
+        for upstream_vertex in self._graph.ancestors(vertex):
+            upstream_descriptor = describe_vertex(upstream_vertex)
+            if upstream_descriptor is None:
+                return False
+            upstream.append((upstream_descriptor, upstream_vertex))
+        upstream.sort(key=lambda item: item[0])
+
+        try:
+            inputs_digest = self._inputs_digest(descriptor, upstream)
+            self._write(self._file(inputs_digest, self.VALUE_EXT), value)
+        except (pickle.PicklingError, TypeError, AttributeError, ValueError):
+            return False
+        self._write(self._file(self._digest(descriptor), self.MANIFEST_EXT), [item[0] for item in upstream])
+        return True
+
+class GraphSnapshot(object):
+    """
+    Frozen dependency DAG of a set of vertices and their ancestors, see Graph.freeze. The topological schedule of each
+    vertex is compiled on first use. A snapshot can be saved and loaded in another process, as long as the vertices
+    can be identified there (see GraphObject.persist_key), the edges of the others are left to dynamic discovery.
+    """
+
+    def __init__(self, parents):
+        """
+        :param parents: A dictionary {vertex: iterable of its parents}, holding every vertex of the snapshot
+        """
+        # Frozensets, the frozen reads checking their parent against them
+        self._parents = {vertex: frozenset(vertex_parents) for vertex, vertex_parents in parents.items()}
+        self._schedules = {}
+
+    @classmethod
+    def capture(cls, graph, vertices):
+        """
+        Records the edges discovered so far between the vertices and all their ancestors
+        """
+        parents = {}
+        stack = list(vertices)
+        while stack:
+            vertex = stack.pop()
+            if vertex not in parents:
+                parents[vertex] = tuple(graph._edges.parents(vertex))
+                stack.extend(parents[vertex])
+        return cls(parents)
+
+    def __contains__(self, vertex):
+        return vertex in self._parents
+
+    def __len__(self):
+        return len(self._parents)
+
+    def parents(self, vertex):
+        return self._parents[vertex]
+
+    def schedule(self, vertex):
+        """
+        Returns the ancestors of the vertex, followed by the vertex itself, in topological order
+        """
+        schedule = self._schedules.get(vertex)
+        if schedule is None:
+            # Iterative depth-first search over the parents, the post-order being a topological order
+            visited = {vertex}
+            post_order = []
+            stack = [(vertex, iter(self._parents.get(vertex, ())))]
+            while stack:
+                current, parents = stack[-1]
+                for parent in parents:
+                    if parent not in visited:
+                        visited.add(parent)
+                        stack.append((parent, iter(self._parents.get(parent, ()))))
+                        break
+                else:
+                    stack.pop()
+                    post_order.append(current)
+            schedule = self._schedules[vertex] = tuple(post_order)
+        return schedule
+
+    def thaw(self, vertex):
+        """
+        Removes the vertex from the snapshot, its dependencies being discovered dynamically again
+        """
+        if self._parents.pop(vertex, None) is not None:
+            self._schedules.clear()
+
+    def dump(self, path):
+        """
+        Saves the snapshot to path, leaving out the vertices that cannot be identified across processes
+        """
+        descriptors = {}
+        for vertex, parents in self._parents.items():
+            descriptor = describe_vertex(vertex)
+            parent_descriptors = [describe_vertex(parent) for parent in parents]
+            if descriptor is not None and None not in parent_descriptors:
+                descriptors[descriptor] = parent_descriptors
+        with open(path, 'wb') as f:
+            pickle.dump(descriptors, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return len(descriptors)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a snapshot saved by dump, leaving out the vertices that cannot be resolved in this process
+        """
+        with open(path, 'rb') as f:
+            descriptors = pickle.load(f)
+        parents = {}
+        for descriptor, parent_descriptors in descriptors.items():
+            vertex = resolve_vertex(descriptor)
+            vertex_parents = tuple(resolve_vertex(parent_descriptor) for parent_descriptor in parent_descriptors)
+            if vertex is not None and None not in vertex_parents:
+                parents[vertex] = vertex_parents
+        return cls(parents)
+
+def _value_changed(value, previous):
+    """
+    Tells whether the value of a watched vertex changed, arrays being compared element-wise
+    """
+    if value is previous:
+        return False
+    try:
+        return bool(value != previous)
+    except ValueError:
+        # The element-wise comparison of arrays has no truth value
+        import numpy
+        return not numpy.array_equal(value, previous)
+
+class _Watch(object):
+    """
+    The callbacks watching a vertex in a given state, and the last value they were notified of
+    """
+    __slots__ = ('vertex', 'state', 'callbacks', 'value')
+
+    def __init__(self, vertex, state, value):
+        self.vertex = vertex
+        self.state = state
+        self.callbacks = []
+        self.value = value
+
 class Graph(object):
-    def __init__(self) -> None:
-        self._state_stacks = defaultdict(lambda: [GraphState(self)])
+    TOPOLOGY_CACHE_SIZE = 1024
+
+    def __init__(self, edge_store=None, weak_objects=False) -> None:
+        """
+        :param edge_store: The store keeping track of the edges, SetEdgeStore by default. ArrayEdgeStore is a compact
+        alternative meant for very large graphs.
+        :param weak_objects: See Graph.weak_objects
+        """
+        self._weak_objects = weak_objects
+        self._states = weakref.WeakSet()
+        self._object_vertices = {}
+        self._state_capacity = None
+        self._eviction = GraphState.LRU
+        self._state_stacks = defaultdict(self._new_state_stack)
+        self._edges = edge_store if edge_store is not None else SetEdgeStore()
+        self._topology_cache = {}
+        self._concurrency = 0
+        self._concurrency_lock = Lock()
         self._debug_mode = False
-        self._gather_performance = False
-        self._timings = defaultdict(list)
+        self._profiler = None
+        self._persistent_store = None
+        # The watches of each vertex {vertex: [_Watch]}, one per state, and the watches to recompute
+        self._watches = {}
+        self._pending_watches = set()
+        self._batch_depth = 0
+        self._snapshot = None
+
+    def _new_state_stack(self):
+        return [GraphState(self, capacity=self._state_capacity, eviction=self._eviction)]
 
     def is_calculating(self):
         return self.active_state.active_child is not None
 
+    def set_state_capacity(self, capacity, eviction=GraphState.LRU):
+        """
+        Bounds the number of payloads of the root state of every thread, see GraphState.set_capacity
+        """
+        self._state_capacity = capacity
+        self._eviction = eviction
+        for stack in list(self._state_stacks.values()):
+            stack[0].set_capacity(capacity, eviction)
+
+    @property
+    def weak_objects(self):
+        """
+        When set, the vertices bound from then on only hold a weak reference to their GraphObject, and the payloads
+        and edges of its vertices are released when the object dies instead of keeping it alive forever. Vertex
+        functions then see a weakref.proxy of the object as self.
+        """
+        return self._weak_objects
+
+    @weak_objects.setter
+    def weak_objects(self, weak_objects):
+        self._weak_objects = weak_objects
+        if weak_objects:
+            for stack in list(self._state_stacks.values()):
+                self._states.update(stack)
+
+    def bind(self, obj, names=None):
+        """
+        Binds the vertices of the GraphObject to this graph rather than the default one. The vertices must not have
+        been accessed yet, which would have bound them to the default graph.
+        :param names: The names of the vertices to bind, all the vertices of the object by default
+        :return: The object
+        """
+        clazz = type(obj)
+        for name in clazz.vertex_names() if names is None else names:
+            vertex = obj.__dict__.get(name)
+            if vertex is not None and vertex._graph is not self:
+                raise ValueError('{} is already bound to another graph'.format(vertex))
+            clazz._vertices[name].bind(obj, self)
+        return obj
+
+    def _track(self, obj, vertex):
+        """
+        Registers the vertex for release on the death of its object
+        :return: The weak proxy of the object to be held by the vertex
+        """
+        ref = obj.__dict__.get(_OBJECT_REF)
+        if ref is None:
+            ref = obj.__dict__.setdefault(_OBJECT_REF, weakref.ref(obj, self._release))
+        self._object_vertices.setdefault(ref, []).append(vertex)
+        return weakref.proxy(obj)
+
+    def _release(self, ref):
+        for vertex in self._object_vertices.pop(ref, ()):
+            for state in list(self._states):
+                state.release(vertex)
+            self._edges.remove_vertex(vertex)
+            self._pending_watches.difference_update(self._watches.pop(vertex, ()))
+            if self._snapshot is not None:
+                self._snapshot.thaw(vertex)
+        self._topology_cache.clear()
+
+    @property
+    def profiler(self):
+        return self._profiler
+
+    def enable_profiling(self, profiler=None):
+        """
+        Attaches a profiler to the graph, replacing the current one if any. Can be toggled at runtime.
+        :param profiler: The GraphProfiler to use, a new one if omitted
+        :return: The profiler
+        """
+        self._profiler = profiler if profiler is not None else GraphProfiler()
+        return self._profiler
+
+    def disable_profiling(self):
+        """
+        Detaches the profiler from the graph
+        :return: The detached profiler, None if profiling was not enabled
+        """
+        profiler, self._profiler = self._profiler, None
+        return profiler
+
+    @contextlib.contextmanager
+    def profiling(self, profiler=None):
+        """
+        Profiles the graph evaluations happening within the context
+        """
+        saved_profiler = self._profiler
+        profiler = self.enable_profiling(profiler)
+        try:
+            yield profiler
+        finally:
+            self._profiler = saved_profiler
+
     @property
     def timings(self):
-        return self._timings
+        """
+        Returns the profiling statistics {vertex: VertexProfile} gathered so far, empty if profiling is disabled
+        """
+        return self._profiler.profiles if self._profiler is not None else {}
 
     def reset_timings(self):
-        self._timings = defaultdict(list)
+        if self._profiler is not None:
+            self._profiler.reset()
+
+    @property
+    def persistent_store(self):
+        return self._persistent_store
+
+    def enable_persistence(self, path):
+        """
+        Stores the values of the persisted vertices (see Vertex(persist=True)) under path, and reloads them from there
+        instead of evaluating them whenever their inputs match a stored entry
+        :return: The PersistentStore
+        """
+        self._persistent_store = PersistentStore(self, path)
+        return self._persistent_store
+
+    def disable_persistence(self):
+        store, self._persistent_store = self._persistent_store, None
+        return store
 
     @property
     def is_debug_mode(self):
@@ -68,17 +893,7 @@ class Graph(object):
 
     @property
     def gather_performance(self):
-        return self._gather_performance
-
-    @contextlib.contextmanager
-    def time_it(self, obj):
-        if self.gather_performance:
-            start_time = time.time()
-            yield self
-            elapsed = time.time() - start_time
-            self._timings[obj].append(elapsed)
-        else:
-            yield self
+        return self._profiler is not None
 
     @property
     def _state_stack(self):
@@ -101,116 +916,655 @@ class Graph(object):
         return self._state_stack.pop()
 
     def get_value(self, vertex):
-        # If there is a valid active child, add a directed edge
-        active_child = self.active_state.active_child
-        if active_child:
-            if vertex not in active_child.parents:
-                active_child.parents.add(vertex)
-            if active_child not in vertex.children:
-                vertex.children.add(active_child)
-        
-        payload = self.active_state.get(vertex)
+        state = self._state_stacks[current_thread()][-1]
+
+        # If there is a valid active child, add a directed edge. The dependencies of a frozen child are checked against
+        # the snapshot instead, a parent missing from the snapshot meaning that the code path of the child changed
+        active = state._active_child
+        active_child = active.vertex
+        if active_child is not None:
+            if not active.frozen:
+                if not self._edges.has_edge(vertex, active_child):
+                    self._add_edge(vertex, active_child)
+            elif vertex not in self._snapshot._parents.get(active_child, _NO_EDGES):
+                self._thaw(vertex, active_child, active)
+
+        # The payload flags are checked inline, this is the hot path of the graph
+        payload = state.get(vertex)
         if payload is None:
-            payload = self.active_state.setdefault(vertex, VertexPayload(vertex, self.active_state))
-        if payload.is_valid():
-            return payload.value
+            # Values still valid in the parent states are shared as is, anything else gets computed in this state
+            if state._parent_state is not None:
+                payload = state._parent_state.lookup(vertex)
+                if payload is not None and payload._flags & _VALID:
+                    if self._profiler is not None:
+                        self._profiler.hit(vertex)
+                    return payload._value
+            payload = state.own(vertex)
+        if payload._flags & _VALID:
+            if self._profiler is not None:
+                self._profiler.hit(vertex)
+            if state._capacity is not None:
+                state.touch(vertex)
+            return payload._value
+        if self._snapshot is not None:
+            return self._evaluate_frozen(state, vertex, payload, active_child)
+        if self._concurrency:
+            return self._evaluate_latched(state, vertex, payload, active_child)
+        return self._evaluate(state, vertex, payload, active_child)
+
+    def _evaluate(self, state, vertex, payload, saved_child):
+        profiler = self._profiler
+        if profiler is not None:
+            profiler.enter(vertex)
+        active = state._active_child
+        saved_frozen = active.frozen
+        try:
+            active.vertex = vertex
+            active.frozen = self._snapshot is not None and vertex in self._snapshot
+            payload.value = vertex.evaluate()
+        except Exception as ex:
+            # Only the outermost evaluation translates the error, the inner ones let it through untouched
+            if saved_child is None and not isinstance(ex, GraphEvaluationError):
+                raise GraphEvaluationError(self._evaluation_chain(ex.__traceback__), ex) from ex
+            raise
+        finally:
+            active.vertex = saved_child
+            active.frozen = saved_frozen
+            if profiler is not None:
+                profiler.exit(vertex)
+        return payload._value
+
+    def _thaw(self, vertex, active_child, active):
+        """
+        A frozen child reading a vertex it was not reading when frozen means its code path changed: the edge is added
+        and the child falls back to dynamic discovery
+        """
+        self._add_edge(vertex, active_child)
+        self._snapshot.thaw(active_child)
+        active.frozen = False
+
+    def _evaluate_frozen(self, state, vertex, payload, active_child):
+        """
+        Evaluation of a stale vertex while the graph is frozen. When asked from outside of any evaluation, the stale
+        ancestors of a frozen vertex are evaluated first following its schedule, so that the evaluation of the vertex
+        only meets valid parents.
+        """
+        snapshot = self._snapshot
+        evaluate = self._evaluate_latched if self._concurrency else self._evaluate
+        if active_child is None and vertex in snapshot:
+            for ancestor in snapshot.schedule(vertex)[:-1]:
+                ancestor_payload = state.lookup(ancestor)
+                if ancestor_payload is not None and ancestor_payload._flags & _VALID:
+                    continue
+                try:
+                    evaluate(state, ancestor, state.own(ancestor), None)
+                except GraphEvaluationError:
+                    # The ancestor might not be needed by the current code path, let the vertex decide
+                    break
+
+        return evaluate(state, vertex, payload, active_child)
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def freeze(self, vertices=None, snapshot=None):
+        """
+        Freezes the dependencies of the vertices and their ancestors, as discovered so far: reading a parent from a
+        frozen vertex no longer goes through the edge bookkeeping, and stale frozen vertices are evaluated following a
+        precompiled topological schedule. Vertices outside of the snapshot keep being discovered dynamically.
+        Code path changes are caught when a frozen vertex reads a vertex it did not read when frozen, the vertex then
+        falls back to dynamic discovery.
+        :param vertices: The vertices to freeze, typically the outputs of the graph
+        :param snapshot: A GraphSnapshot to freeze instead, e.g. loaded from a previous process
+        :return: The GraphSnapshot
+        :raise ValueError: If neither vertices nor a snapshot are given
+        """
+        if snapshot is None:
+            if vertices is None:
+                raise ValueError('Freezing requires the vertices to freeze or a snapshot')
+            snapshot = GraphSnapshot.capture(self, vertices)
+        else:
+            # The edges of a loaded snapshot have to be known to the graph for the invalidation to go through them
+            for vertex in list(snapshot._parents):
+                for parent in snapshot.parents(vertex):
+                    self._add_edge(parent, vertex)
+        self._snapshot = snapshot
+        return snapshot
+
+    def unfreeze(self):
+        snapshot, self._snapshot = self._snapshot, None
+        return snapshot
+
+    @staticmethod
+    def _evaluation_chain(tb):
+        """
+        Returns the vertices being evaluated by the frames of the traceback, from the outermost
+        """
+        chain = []
+        while tb is not None:
+            frame = tb.tb_frame
+            if frame.f_code is _EVALUATE_CODE:
+                chain.append(frame.f_locals['vertex'])
+            tb = tb.tb_next
+        return chain
+
+    def _evaluate_latched(self, state, vertex, payload, saved_child):
+        """
+        Computes the payload holding its latch, so that concurrent threads wait for the result instead of evaluating
+        the vertex again
+        """
+        latch = payload.latch
+        if latch is None:
+            with self._concurrency_lock:
+                if payload.latch is None:
+                    payload.latch = Lock()
+                latch = payload.latch
+
+        with latch:
+            if payload._flags & _VALID:
+                return payload._value
+            return self._evaluate(state, vertex, payload, saved_child)
 
-        saved_child = active_child
+    @contextlib.contextmanager
+    def concurrent_mode(self):
+        """
+        Within this context, payloads are computed under a compute-once latch and a state can be shared across threads
+        """
+        with self._concurrency_lock:
+            self._concurrency += 1
         try:
-            self.active_state.active_child = vertex
-            with self.time_it(vertex):
-                payload.value = vertex.evaluate()
+            yield self
         finally:
-            self.active_state.active_child = saved_child
-        
-        return payload.value
+            with self._concurrency_lock:
+                self._concurrency -= 1
+
+    def evaluate_concurrently(self, vertex, pool=None):
+        """
+        Evaluates the vertex, computing the independent branches of its dependency tree in parallel on a threadpool.
+        The stale ancestors known to the graph are scheduled level by level starting from the leaves, each level being
+        fanned out on the pool. Dependencies not discovered yet are computed by whichever thread needs them first, the
+        payload latches guaranteeing that no vertex gets evaluated twice.
+        :param vertex: The vertex to evaluate
+        :param pool: The threadpool to use, or the name of a ThreadpoolService pool (DEFAULT if omitted)
+        :return: The value of the vertex
+        """
+        if pool is None or isinstance(pool, str):
+            from GoldenSource.python.common.domain import Domain
+            from GoldenSource.python.services.threadpool_service import ThreadpoolService
+            pool = Domain().get_service(ThreadpoolService).get_pool(pool or ThreadpoolService.DEFAULT_POOL_NAME)
+
+        state = self.active_state
+        with self.concurrent_mode():
+            for level in self._stale_levels(state, vertex)[:-1]:
+                futures = [pool.add_task(self._evaluate_in_state, state, parent) for parent in level]
+                for future in futures:
+                    future.get()
+            return self.get_value(vertex)
+
+    def _evaluate_in_state(self, state, vertex):
+        self.push_state(state)
+        try:
+            return self.get_value(vertex)
+        finally:
+            self.pop_state()
+
+    def _stale_levels(self, state, vertex):
+        """
+        Groups the vertex and its known ancestors needing a computation by level, a vertex sitting one level above its
+        highest stale parent. Ancestors of valid payloads are not considered.
+        """
+        levels = {}
+        stack = [(vertex, False)]
+        while stack:
+            current, expanded = stack.pop()
+            if current in levels:
+                continue
+            if expanded:
+                parents = self._edges.parents(current)
+                levels[current] = 1 + max((levels[parent] for parent in parents if parent in levels), default=-1)
+                continue
+            stack.append((current, True))
+            for parent in tuple(self._edges.parents(current)):
+                if parent not in levels:
+                    payload = state.lookup(parent)
+                    if payload is None or not payload.is_valid():
+                        stack.append((parent, False))
+
+        grouped = defaultdict(list)
+        for current, level in levels.items():
+            grouped[level].append(current)
+        return [grouped[level] for level in sorted(grouped)]
+
+    def _add_edge(self, parent, child):
+        if not self._edges.has_edge(parent, child):
+            self._edges.add_edge(parent, child)
+            if self._topology_cache:
+                self._topology_cache.clear()
+
+    def ancestors(self, vertex):
+        """
+        Returns the set of the known ancestors of the vertex
+        """
+        ancestors = set()
+        stack = list(self._edges.parents(vertex))
+        while stack:
+            parent = stack.pop()
+            if parent not in ancestors:
+                ancestors.add(parent)
+                stack.extend(self._edges.parents(parent))
+        return ancestors
+
+    def _topological_descendants(self, roots):
+        """
+        Returns the roots and all their descendants in topological order. The order is cached per set of roots until a
+        new edge gets discovered.
+        """
+        key = frozenset(roots)
+        order = self._topology_cache.get(key)
+        if order is None:
+            # Iterative depth-first search, the reversed post-order being a topological order
+            visited = set()
+            post_order = []
+            for root in roots:
+                if root in visited:
+                    continue
+                visited.add(root)
+                stack = [(root, iter(tuple(self._edges.children(root))))]
+                while stack:
+                    vertex, children = stack[-1]
+                    for child in children:
+                        if child not in visited:
+                            visited.add(child)
+                            stack.append((child, iter(tuple(self._edges.children(child)))))
+                            break
+                    else:
+                        stack.pop()
+                        post_order.append(vertex)
+            post_order.reverse()
+            order = tuple(post_order)
+            if len(self._topology_cache) >= self.TOPOLOGY_CACHE_SIZE:
+                self._topology_cache.clear()
+            self._topology_cache[key] = order
+        return order
+
+    def _invalidate_descendants(self, roots):
+        """
+        Invalidates the descendants of the roots in a single pass over their topological order. A vertex is
+        invalidated if one of its parents changed, the walk does not go through fixed or already invalid payloads.
+        """
+        state = self.active_state
+        dirty = set(roots)
+        for vertex in self._topological_descendants(roots):
+            if vertex in dirty or dirty.isdisjoint(self._edges.parents(vertex)):
+                continue
+
+            payload = state.lookup(vertex)
+            if payload is None:
+                # Never computed or evicted, its children may still hold values computed from it
+                dirty.add(vertex)
+            elif not payload.is_fixed() and payload.is_valid():
+                if payload.graph_state is state:
+                    payload.invalidate()
+                else:
+                    # The payload belongs to a parent state, shadow it rather than altering the parent
+                    state[vertex] = VertexPayload(vertex, state)
+                dirty.add(vertex)
+
+        if self._watches:
+            self._schedule_watches(state, dirty)
 
     def _invalidate_children(self, vertex):
-        children = set(vertex.children)
-        while children:
-            child = children.pop()
-
-            payload = self.active_state.get(child)
-            if payload is not None and not payload.is_fixed() and payload.is_valid():
-                payload.invalidate()
-                children.update(child.children)
+        self._invalidate_descendants((vertex,))
+
+    def watch(self, vertex, callback):
+        """
+        Pushes the value of the vertex to the callback whenever it changes. After each update of the inputs (or at the
+        end of a batch) the invalidated watched vertices are recomputed in dependency order and callback(vertex, value)
+        is called for those whose value actually changed.
+        The vertex is watched in the active state, it is evaluated right away to record its current value.
+        :return: The current value of the vertex
+        """
+        state = self.active_state
+        watches = self._watches.get(vertex, ())
+        watch = next((watch for watch in watches if watch.state is state), None)
+        if watch is None:
+            # The watches of the other states, another thread or below a DiddleScope, are kept alongside
+            watch = _Watch(vertex, state, self.get_value(vertex))
+            self._watches[vertex] = list(watches) + [watch]
+        watch.callbacks.append(callback)
+        return watch.value
+
+    def unwatch(self, vertex, callback=None):
+        """
+        Stops pushing the value of the vertex to the callback, or to all its callbacks in all states if callback is omitted
+        """
+        watches = self._watches.get(vertex)
+        if watches is None:
+            return
+        if callback is not None:
+            # The watch of the active state first, the same callback may watch the vertex in several states
+            state = self.active_state
+            for watch in sorted(watches, key=lambda watch: watch.state is not state):
+                if callback in watch.callbacks:
+                    watch.callbacks.remove(callback)
+                    break
+            else:
+                raise ValueError('{} is not watching {}'.format(callback, vertex))
+        stopped = [watch for watch in watches if callback is None or not watch.callbacks]
+        self._pending_watches.difference_update(stopped)
+        watches = [watch for watch in watches if watch not in stopped]
+        if watches:
+            self._watches[vertex] = watches
+        else:
+            del self._watches[vertex]
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Defers the watch notifications until the end of the context, so that a batch of input updates recomputes each
+        watched vertex once
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+        if not self._batch_depth:
+            self.notify_watches()
+
+    def _schedule_watches(self, state, dirty):
+        for vertex in dirty:
+            for watch in self._watches.get(vertex, ()):
+                if watch.state is state:
+                    self._pending_watches.add(watch)
+
+    def notify_watches(self):
+        """
+        Recomputes the invalidated watched vertices in dependency order and notifies the callbacks of those whose value
+        changed. Called after every update of the inputs outside of a batch.
+        """
+        if not self._pending_watches or self._batch_depth:
+            return
+        # Watches of another state (another thread, or below a DiddleScope) wait until their state is active again
+        state = self.active_state
+        pending = {watch for watch in self._pending_watches if watch.state is state}
+        self._pending_watches.difference_update(pending)
+        pending = {watch.vertex: watch for watch in pending}
+
+        changes = []
+        for vertex in self._topological_descendants(pending):
+            watch = pending.get(vertex)
+            if watch is None:
+                continue
+            value = self.get_value(vertex)
+            if _value_changed(value, watch.value):
+                watch.value = value
+                changes.append((vertex, watch))
+
+        for vertex, watch in changes:
+            for callback in list(watch.callbacks):
+                callback(vertex, watch.value)
+
+    def _check_not_calculating(self, vertex):
+        if self.is_calculating() and self.active_state.lookup(vertex) is not None:
+            raise RuntimeError('Graph cannot be modified while its updating its state')
     
     def is_fixed(self, vertex):
-        if vertex in self.active_state and self.is_calculating():
-            raise RuntimeError('Graph cannot be modified while its updating its state')
+        self._check_not_calculating(vertex)
 
-        payload = self.active_state.get(vertex)
-        if payload is None:
-            payload = self.active_state.setdefault(vertex, VertexPayload(vertex, self.active_state))
-        
-        return payload.is_fixed()
+        payload = self.active_state.lookup(vertex)
+        return payload is not None and payload.is_fixed()
 
     def set_value(self, vertex, value):
-        if vertex in self.active_state and self.is_calculating():
-            raise RuntimeError('Graph cannot be modified while its updating its state')
+        self._check_not_calculating(vertex)
         
         if value == CLEAR:
             self.clear_value(vertex)
         else:
-            payload = self.active_state.get(vertex)
-            if payload is None:
-                payload = self.active_state.setdefault(vertex, VertexPayload(vertex, self.active_state))
-            
-            if not payload.is_fixed() or payload.value != value:
+            payload = self.active_state.lookup(vertex)
+            if payload is None or not payload.is_fixed() or payload.value != value:
+                payload = self.active_state.own(vertex)
                 payload.fix_value(value)
                 self._invalidate_children(vertex)
+                self.notify_watches()
             return payload.value
 
     def clear_value(self, vertex):
-        if vertex in self.active_state and self.is_calculating():
-            raise RuntimeError('Graph cannot be modified while its updating its state')
+        self._check_not_calculating(vertex)
         
-        payload = self.active_state.get(vertex)
+        payload = self.active_state.lookup(vertex)
         if not payload or not payload.is_fixed():
             raise RuntimeError('Cannot clear a value that has not been set')
         
-        del self.active_state[vertex]
+        self.active_state.discard(vertex)
         self._invalidate_children(vertex)
+        self.notify_watches()
+
+    def _check_values(self, values):
+        """
+        Checks that all the values can be set, so that set_values changes either all of them or none
+        """
+        state = self.active_state
+        for vertex, value in values.items():
+            self._check_not_calculating(vertex)
+            if value is CLEAR:
+                payload = state.lookup(vertex)
+                if not payload or not payload.is_fixed():
+                    raise RuntimeError('Cannot clear a value that has not been set')
+
+    def set_values(self, values):
+        """
+        Sets the values of several vertices at once. The descendants of all the vertices are invalidated in one
+        combined pass, which is a lot cheaper than as many set_value calls when they share descendants.
+        :param values: A dictionary {vertex: value}, a CLEAR value clears the vertex
+        """
+        self._check_values(values)
+        state = self.active_state
+        changed = []
+        for vertex, value in values.items():
+            payload = state.lookup(vertex)
+            if value is CLEAR:
+                state.discard(vertex)
+                changed.append(vertex)
+            elif payload is None or not payload.is_fixed() or payload.value != value:
+                state.own(vertex).fix_value(value)
+                changed.append(vertex)
+
+        if changed:
+            self._invalidate_descendants(changed)
+            self.notify_watches()
       
     def set_diddle(self, vertex, value):
-        if vertex in self.active_state and self.is_calculating():
-            raise RuntimeError('Graph cannot be modified while its updating its state')
+        self._check_not_calculating(vertex)
         
         if not isinstance(self.active_state, DiddleScope):
             raise RuntimeError('Cannot diddle value outside of a DiddleScope')
 
-        payload = self.active_state.setdefault(vertex, VertexPayload(vertex, self.active_state))
-        if not payload.is_fixed() or payload.value != value:
-            payload._value = value
-            payload._flags |= (VertexPayload.FIXED | VertexPayload.VALID)
+        payload = self.active_state.lookup(vertex)
+        if payload is None or not payload.is_fixed() or payload.value != value:
+            payload = self.active_state.own(vertex)
+            payload.fix_value(value)
             self._invalidate_children(vertex)
+            self.notify_watches()
         return payload.value
       
     def clear_diddle(self, vertex):
-        if vertex in self.active_state and self.is_calculating():
-            raise RuntimeError('Graph cannot be modified while its updating its state')
+        self._check_not_calculating(vertex)
         if not isinstance(self.active_state, DiddleScope):
             raise RuntimeError('Cannot diddle value outside of a DiddleScope')
 
-        payload = self.active_state.get(vertex)
+        payload = self.active_state.lookup(vertex)
         if not payload or not payload.is_fixed():
             raise RuntimeError('Cannot clear a diddle that has not been set')
         
-        del self.active_state[vertex]
+        self.active_state.discard(vertex)
         self._invalidate_children(vertex)
+        self.notify_watches()
+
+    def evaluate_scenarios(self, targets, scenarios, pool=None, nprocs=None):
+        """
+        Evaluates the targets under each scenario, a scenario being a dictionary of {vertex: value} overrides applied
+        as diddles on top of the active state. The targets are computed in the active state first so that the parts
+        of the graph unaffected by a scenario are computed once and shared across all the scenarios.
+        :param targets: The vertices to evaluate
+        :param scenarios: The list of overrides dictionaries
+        :param pool: Optional threadpool (see ThreadpoolService.get_pool) used to fan the scenarios out
+        :param nprocs: Optional number of processes used to fan the scenarios out, takes precedence over pool. The
+        vertices of the GraphEvaluationError raised by a process are the names of the vertices.
+        :return: A dictionary {scenario index: {target: value}}
+        """
+        targets = list(targets)
+        base_state = self.active_state
+        for target in targets:
+            self.get_value(target)
+
+        if nprocs:
+            # Forked workers inherit the warm graph, only the scenario indices and the results cross process boundaries
+            from GoldenSource.python.common.concurrency import ProcessPool
+            evaluate = functools.partial(self._evaluate_scenario_at, base_state, targets, scenarios)
+            with ProcessPool(evaluate, nprocs) as pool:
+                results = pool.map(range(len(scenarios)))
+        elif pool is not None:
+            futures = [pool.add_task(self._evaluate_scenario, base_state, targets, overrides) for overrides in scenarios]
+            results = [future.get() for future in futures]
+        else:
+            results = [self._evaluate_scenario(base_state, targets, overrides) for overrides in scenarios]
+
+        return {index: dict(zip(targets, values)) for index, values in enumerate(results)}
+
+    def scenario_pool(self, targets, inputs, nprocs=None, capacity=1024):
+        """
+        Forks worker processes holding a warm copy of the graph, to evaluate many batches of scenarios on the
+        targets without paying the process creation and warm-up again, see ScenarioPool
+        :param targets: The vertices to evaluate, their values must be numbers
+        :param inputs: The vertices the scenarios may override
+        :param nprocs: The number of processes, the number of CPUs by default
+        :param capacity: The number of scenarios evaluated per round trip to the workers
+        """
+        return ScenarioPool(self, targets, inputs, nprocs=nprocs, capacity=capacity)
+
+    def _evaluate_scenario_at(self, base_state, targets, scenarios, index):
+        """
+        Evaluates a scenario in a worker process, the vertices of the errors being sent back to the parent by name
+        """
+        try:
+            return self._evaluate_scenario(base_state, targets, scenarios[index])
+        except GraphEvaluationError as ex:
+            raise GraphEvaluationError([str(vertex) for vertex in ex.vertices], ex.cause) from None
+
+    def _evaluate_scenario(self, base_state, targets, overrides):
+        """
+        Evaluates the targets in a DiddleScope layered on top of base_state, which may belong to another thread
+        """
+        scope = DiddleScope(graph=self)
+        self.push_state(scope)
+        scope._parent_state = base_state
+        try:
+            for vertex, value in overrides.items():
+                self.set_diddle(vertex, value)
+            return [self.get_value(target) for target in targets]
+        finally:
+            self.pop_state()
+            scope.clear()
+            scope._parent_state = None
+
+class ScenarioPool(object):
+    """
+    Process pool evaluating scenarios over a warm graph. The targets are computed before the workers are forked, so
+    that each worker starts with the whole unaffected part of the graph already valid. Only the overrides cross the
+    process boundary, with the inputs sent as indices, and the workers write the values of the targets straight
+    into a shared memory array instead of sending them back through a queue.
+    """
+
+    def __init__(self, graph, targets, inputs, nprocs=None, capacity=1024):
+        from GoldenSource.python.common.concurrency import ProcessPool
+
+        self._graph = graph
+        self._targets = list(targets)
+        self._inputs = list(inputs)
+        self._input_indices = {vertex: index for index, vertex in enumerate(self._inputs)}
+        self._capacity = capacity
+        self._base_state = graph.active_state
+        for target in self._targets:
+            graph.get_value(target)
+
+        # Allocated before the fork, the workers inherit the mapping of the same shared memory
+        context = multiprocessing.get_context('fork')
+        self._results = context.RawArray('d', capacity * len(self._targets))
+        # The calls share the array of results, they run one at a time
+        self._lock = Lock()
+        self._pool = ProcessPool(self._evaluate, nprocs or multiprocessing.cpu_count())
+
+    def _evaluate(self, task):
+        """
+        Evaluates a scenario in a worker, writing the values of the targets at its slot of the shared array
+        :return: None, or the description of the error
+        """
+        slot, overrides = task
+        try:
+            overrides = {self._inputs[index]: value for index, value in overrides.items()}
+            values = self._graph._evaluate_scenario(self._base_state, self._targets, overrides)
+            offset = slot * len(self._targets)
+            for position, value in enumerate(values):
+                self._results[offset + position] = value
+        except Exception as ex:
+            return "{}: {!r}".format(ex.__class__.__name__, ex)
+        return None
+
+    def evaluate(self, scenarios):
+        """
+        Evaluates the targets under each scenario, a scenario being a dictionary of {vertex: value} overrides on the
+        inputs of the pool
+        :return: A dictionary {scenario index: {target: value}}, like Graph.evaluate_scenarios
+        """
+        tasks = []
+        for overrides in scenarios:
+            try:
+                tasks.append({self._input_indices[vertex]: value for vertex, value in overrides.items()})
+            except KeyError as ex:
+                raise ValueError('{} is not an input of the scenario pool'.format(ex.args[0]))
+
+        results = {}
+        target_count = len(self._targets)
+        for start in range(0, len(tasks), self._capacity):
+            chunk = tasks[start:start + self._capacity]
+            with self._lock:
+                errors = self._pool.map(list(enumerate(chunk)))
+                values = self._results[:len(chunk) * target_count]
+            for slot, error in enumerate(errors):
+                if error is not None:
+                    raise RuntimeError('Scenario {} failed: {}'.format(start + slot, error))
+            for slot in range(len(chunk)):
+                offset = slot * target_count
+                results[start + slot] = dict(zip(self._targets, values[offset:offset + target_count]))
+        return results
+
+    def close(self):
+        self._pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 _graph = Graph()
+_EVALUATE_CODE = Graph._evaluate.__code__
 
 class VertexPayload(object):
     NONE = 0x0000
     VALID = 0x0001
     FIXED = 0x0002
 
+    __slots__ = ('_vertex', '_graph_state', '_flags', '_value', 'latch')
+
     def __init__(self, vertex, graph_state, flags=NONE, value=None):
         self._vertex = vertex
         self._graph_state = graph_state
         self._flags = flags
         self._value = value
+        self.latch = None
 
     @property
     def vertex(self):
@@ -244,10 +1598,10 @@ class VertexPayload(object):
         self._value = None
 
     def is_valid(self):
-        return bool(self.flags & self.VALID)
+        return bool(self._flags & _VALID)
 
     def is_fixed(self):
-        return bool(self.flags & self.FIXED)
+        return bool(self._flags & _FIXED)
 
     def clone(self, graph_state=None):
         return VertexPayload(
@@ -257,18 +1611,26 @@ class VertexPayload(object):
             self._value
         )
 
+_VALID = VertexPayload.VALID
+_FIXED = VertexPayload.FIXED
+
 class GraphVertex(object):
     """
     A Vertex is a vertex or node on the graph which has an associated "payload" responsible for holding a value. A Vertex is applied to a memeber function of a GraphObject as a method decorator.
     As part of an acyclic directed graph, edges which connect vertices are directed in a parent -> child fashion such that the payload of the child is dependent upon the payload of the parent.
     """
 
-    def __init__(self, obj, func) -> None:
-        self._obj = obj
+    __slots__ = ('_obj', '_func', '_graph', '_parents', '_children', '_vid')
+
+    def __init__(self, obj, func, graph=None) -> None:
+        if graph is None:
+            graph = _graph
+        self._obj = graph._track(obj, self) if graph._weak_objects else obj
         self._func = func
-        self._id = "{}.{}".format(self._obj.__class__.__name__, self._func.__name__)
-        self.parents = set()
-        self.children = set()
+        # Edges are managed by the edge store of the graph, see SetEdgeStore and ArrayEdgeStore
+        self._parents = _NO_EDGES
+        self._children = _NO_EDGES
+        self._vid = None
         """
         self._graph = _graph:
         - Dependency Injection:
@@ -285,29 +1647,29 @@ class GraphVertex(object):
 
         In summary, initializing self._graph with _graph rather than Graph() promotes flexibility, reusability, and encapsulation in the design of the GraphVertex class. It allows for easier customization and testing while keeping the class decoupled from specific implementations of the Graph class.
         """
-        self._graph = _graph
+        self._graph = graph
+
+    @property
+    def _id(self):
+        return "{}.{}".format(self._obj.__class__.__name__, self._func.__name__)
+
+    @property
+    def parents(self):
+        return self._graph._edges.parents(self)
+
+    @property
+    def children(self):
+        return self._graph._edges.children(self)
     
     def __str__(self) -> str:
         return self._id
 
     __repr__ = __str__
 
-    def __call__(self, *args, **kwargs):
-        # This hack allows us to manipulate the stacktrace, effectively removing the graph inner-working from it
-        # Note that if an error would stem from the graph, the stacktrace would still be intact
-        try:
-            value = self._graph.get_value(self)
-        except:
-            ex_type, ex, ex_tb = sys.exc_info()
-            hacked_tb = ex_tb
-            for _ in range(3):
-                hacked_tb = hacked_tb.tb_next
-                if hacked_tb is None:
-                    break
-            raise(ex_type, ex, hacked_tb or ex_tb)
-        if self._graph.is_debug_mode:
-            print("{}() -> {}".format(self._id, value))
-        return value
+    def __call__(self):
+        # Nothing but the lookup on the hot path, evaluation errors are translated once by the outermost evaluation
+        # into a GraphEvaluationError, and debug mode is reported by evaluate()
+        return self._graph.get_value(self)
 
     def evaluate(self):
         value = self._func(self._obj)
@@ -343,44 +1705,252 @@ class GraphVertex(object):
         if self._graph.is_debug_mode:
             print("{}.clear_diddle() -> {}".format(self._id, CLEAR))
 
+    def watch(self, callback):
+        return self._graph.watch(self, callback)
+
+    def unwatch(self, callback=None):
+        self._graph.unwatch(self, callback)
+
+class PersistentGraphVertex(GraphVertex):
+    """
+    GraphVertex whose evaluations go through the PersistentStore of the graph, when persistence is enabled
+    """
+    __slots__ = ()
+
+    def evaluate(self):
+        store = self._graph.persistent_store
+        if store is None:
+            return super(PersistentGraphVertex, self).evaluate()
+
+        found, value = store.load(self)
+        if not found:
+            value = super(PersistentGraphVertex, self).evaluate()
+            store.save(self, value)
+        elif self._graph.is_debug_mode:
+            print("{}.evaluate() -> {} (persisted)".format(self._id, value))
+        return value
+
 class Vertex(object):
     """
-    The decorator used to indicator
+    The decorator used to indicate that a member function of a GraphObject is a vertex of the graph.
+    Vertex is a non-data descriptor: the GraphVertex bound to an instance is only created on first access and then
+    cached in the instance __dict__, so subsequent lookups bypass the descriptor altogether.
+    Expensive vertices can be persisted on disk across processes with @Vertex(persist=True), see
+    Graph.enable_persistence and GraphObject.persist_key.
     """
 
-    def __init__(self, func) -> None:
+    def __init__(self, func=None, persist=False) -> None:
         self.func = func
+        self.name = func.__name__ if func is not None else None
+        self.persist = persist
 
-class GraphObject(object):
-    def __new__(cls, *args, **kwargs):
+    def __call__(self, func):
+        if self.func is not None:
+            raise TypeError('{} is already bound to {}'.format(self.__class__.__name__, self.func))
+        self.func = func
+        self.name = func.__name__
+        return self
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return self.bind(instance)
+
+    def bind(self, instance, graph=None):
         """
-        We control here the creation of the GraphObject. All the magic here happens as follows.
-        We scan the class for Vertex and replace them on-the-fly with GraphVertex objects that 
-        are directly bound to the instance of the GraphObject we created.
-        Note that instance.__init__(*args, **kwargs) gets automatically called by the python constructor
+        Binds the GraphVertex of the instance, on the default graph unless given another one, see Graph.bind
         """
+        vertex_clazz = PersistentGraphVertex if self.persist else GraphVertex
+        # setdefault keeps the binding unique should two threads race on the first access
+        vertex = instance.__dict__.setdefault(self.name, vertex_clazz(instance, self.func, graph))
+        columns = instance.__dict__.get(_COLUMNS)
+        if columns:
+            for column, index in columns:
+                column._link(self.name, index, vertex)
+        return vertex
+
+_persistent_objects = defaultdict(weakref.WeakSet)
+_resolved_objects = weakref.WeakValueDictionary()
+
+def _class_path(clazz):
+    return "{}.{}".format(clazz.__module__, clazz.__qualname__)
+
+def describe_vertex(vertex):
+    """
+    Returns the (class, persist key, vertex name) descriptor identifying the vertex across processes, None if its
+    GraphObject does not define a persist key
+    """
+    obj = vertex._obj
+    persist_key = obj.persist_key() if isinstance(obj, GraphObject) else None
+    if persist_key is None:
+        return None
+    return _class_path(obj.__class__), persist_key, vertex._func.__name__
+
+def resolve_vertex(descriptor):
+    """
+    Returns the live vertex matching a descriptor built by describe_vertex, None if there is no such vertex
+    """
+    class_path, persist_key, name = descriptor
+    obj = _resolved_objects.get((class_path, persist_key))
+    if obj is None or obj.persist_key() != persist_key:
+        obj = None
+        for candidate in list(_persistent_objects.get(class_path, ())):
+            if candidate.persist_key() == persist_key:
+                obj = _resolved_objects[(class_path, persist_key)] = candidate
+                break
+    return getattr(obj, name, None) if obj is not None else None
+
+class GraphObject(object):
+    """
+    Base class of the objects living on the graph.
+    The Vertex members of each class are collected once, when the class is created, into the _vertices registry.
+    GraphVertex objects are then bound lazily to the instance on first access (see Vertex.__get__), which keeps the
+    construction of a GraphObject independent of the number of vertices it declares.
+    """
+    _vertices = {}
+    _persistable = False
+
+    def __new__(cls, *args, **kwargs):
         instance = object.__new__(cls)
+        if cls._persistable:
+            # Instances identified by a persist key can be resolved as the upstream vertices of persisted vertices
+            _persistent_objects[_class_path(cls)].add(instance)
+        return instance
+
+    def __init_subclass__(cls, **kwargs):
+        super(GraphObject, cls).__init_subclass__(**kwargs)
+        vertices = {}
         for member_name in dir(cls):
             member = getattr(cls, member_name, None)
             if isinstance(member, Vertex):
-                setattr(instance, member_name, GraphVertex(instance, member.func))
-        return instance
+                vertices[member_name] = member
+        cls._vertices = vertices
+        cls._persistable = cls.persist_key is not GraphObject.persist_key
+
+    def persist_key(self):
+        """
+        Returns a key identifying this object across processes, which is required for the persisted vertices of the
+        object, and the vertices upstream of any persisted vertex, to be stored on disk. The default None means that
+        the object does not take part in persistence.
+        """
+        return None
+
+    @classmethod
+    def vertex_names(cls):
+        """
+        Returns the names of the vertices declared by this class and its bases
+        """
+        return tuple(cls._vertices)
+
+_COLUMNS = '_graph_columns'
+_OBJECT_REF = '_graph_object_ref'
+
+class ColumnGraphVertex(GraphVertex):
+    """
+    Vertex of a GraphColumn: evaluates the vertex function once over the whole column, then applies the values fixed on
+    the vertices of individual instances as masked overrides
+    """
+    __slots__ = ()
+
+    @property
+    def _id(self):
+        return "{}[].{}".format(self._obj.clazz.__name__, self._func.__name__)
+
+    def evaluate(self):
+        import numpy
+
+        column = self._obj
+        values = numpy.asarray(self._func(column))
+        if values.shape[:1] != (len(column),):
+            # Scalar results, or results not depending on the instances, are broadcast over the column
+            values = numpy.broadcast_to(values, (len(column),) + values.shape)
+
+        state = self._graph.active_state
+        overrides = {}
+        for index, vertex in column._bound.get(self._func.__name__, {}).items():
+            payload = state.lookup(vertex)
+            if payload is not None and payload.is_fixed():
+                overrides[index] = payload._value
+        if overrides:
+            # Never write into the array returned by the function, it may well be the value of another vertex
+            values = values.astype(numpy.result_type(values, *overrides.values()))
+            indices = numpy.fromiter(overrides, dtype=numpy.intp, count=len(overrides))
+            values[indices] = list(overrides.values())
+
+        if self._graph.is_debug_mode:
+            print("{}.evaluate() -> {}".format(self._id, values))
+        return values
+
+class GraphColumn(object):
+    """
+    Column of instances of a GraphObject class whose vertices are evaluated once over NumPy arrays instead of once
+    per instance: column.area() runs Rectangle.area with self being the column, so self.length() * self.width()
+    multiplies the arrays of lengths and widths. Attributes which are not vertices are gathered into arrays, and plain
+    methods are bound to the column.
+    The values set or diddled on the vertices of individual instances are applied to the column results as masked
+    overrides, and invalidate the column vertices like any other parent.
+    """
+
+    def __init__(self, clazz, instances, graph=None):
+        """
+        :param clazz: The GraphObject class whose vertices get vectorized
+        :param instances: The instances making up the column, in order
+        :param graph: The graph the column vertices belong to, the default graph if omitted
+        """
+        self.__dict__.update(clazz=clazz, instances=tuple(instances), _graph=graph if graph is not None else _graph,
+                             _bound=defaultdict(dict))
+        for index, instance in enumerate(self.instances):
+            instance.__dict__.setdefault(_COLUMNS, []).append((self, index))
+            for name in clazz._vertices:
+                vertex = instance.__dict__.get(name)
+                if vertex is not None:
+                    self._link(name, index, vertex)
+
+    def __len__(self):
+        return len(self.instances)
+
+    def __str__(self) -> str:
+        return "GraphColumn({}, {})".format(self.clazz.__name__, len(self))
+
+    __repr__ = __str__
+
+    def __getattr__(self, name):
+        member = getattr(self.clazz, name, None)
+        if isinstance(member, Vertex):
+            return self.__dict__.setdefault(name, ColumnGraphVertex(self, member.func, self._graph))
+        if callable(member) and hasattr(member, '__get__'):
+            return member.__get__(self, self.__class__)
+
+        import numpy
+        return numpy.array([getattr(instance, name) for instance in self.instances])
+
+    def _link(self, name, index, vertex):
+        """
+        Tracks the vertex bound to an instance, which might carry an override of the column vertex
+        """
+        bound = self._bound[name]
+        if index not in bound:
+            bound[index] = vertex
+            self._graph._add_edge(vertex, getattr(self, name))
 
 class DiddleScope(GraphState):
     """
     A DiddleScope object is used in conjunction with a "with" block. DiddleScopes can be nested and revert the so called "diddles" that are applied within 
     them upon exit. A "set_value" that is called within a diddle scope will remain applied until it is explicitly cleared.
+    Entering a scope does not copy the state it is layered upon: the scope only stores the payloads it touches and reads
+    through to the parent state for the rest.
     """
 
-    def __init__(self, debug_mode=None):
-        super(DiddleScope, self).__init__(_graph)
-        self._parent_state = None
+    def __init__(self, debug_mode=None, graph=None):
+        super(DiddleScope, self).__init__(_graph if graph is None else graph)
         self._debug_mode = debug_mode
         self._saved_debug_mode = None
 
     def __enter__(self):
         self._parent_state = self._graph.push_state(self)
-        self._parent_state.copy(self)
         self._saved_debug_mode = self._parent_state._graph._debug_mode
         self._parent_state._graph._debug_mode = self._debug_mode
 
@@ -391,25 +1961,31 @@ class DiddleScope(GraphState):
         self._parent_state = None
         return extype is None
 
+def _set_values_per_graph(values):
+    """
+    Sets the values on the graphs owning the vertices, each graph invalidating its vertices in one pass
+    """
+    per_graph = {}
+    for vertex, value in values.items():
+        per_graph.setdefault(vertex._graph, {})[vertex] = value
+    for graph, graph_values in per_graph.items():
+        graph._check_values(graph_values)
+    for graph, graph_values in per_graph.items():
+        graph.set_values(graph_values)
+
 class SetScope(object):
     def __init__(self, overrides):
         self._overrides = overrides
         self._to_revert = {}
-        self._to_clear = set()
 
     def __enter__(self):
-        for vertex, override in self._overrides.items():
-            if vertex.is_fixed():
-                self._to_revert[vertex] = vertex()
-            else:
-                self._to_clear.add(vertex)
-            vertex.set_value(override)
+        for vertex in self._overrides:
+            self._to_revert[vertex] = vertex() if vertex.is_fixed() else CLEAR
+        _set_values_per_graph(self._overrides)
 
     def __exit__(self, extype, exvalue, tb):
-        for vertex, prev_value in self._to_revert.items():
-            vertex.set_value(prev_value)
-        for vertex in self._to_clear:
-            vertex.clear_value()
+        _set_values_per_graph(self._to_revert)
+        self._to_revert = {}
         return extype is None
 
 
@@ -438,6 +2014,30 @@ def clear_value(vertex):
         raise Exception('Can only clear on a GraphVertex')
     vertex.clear_value
 
+def set_values(values):
+    if not all(isinstance(vertex, GraphVertex) for vertex in values):
+        raise Exception('Can only set values on GraphVertex objects')
+    _set_values_per_graph(values)
+
+def watch(vertex, callback):
+    if not isinstance(vertex, GraphVertex):
+        raise Exception('Can only watch a GraphVertex')
+    return vertex.watch(callback)
+
+def unwatch(vertex, callback=None):
+    if not isinstance(vertex, GraphVertex):
+        raise Exception('Can only unwatch a GraphVertex')
+    vertex.unwatch(callback)
+
+def batch():
+    return _graph.batch()
+
+def evaluate_scenarios(targets, scenarios, pool=None, nprocs=None):
+    targets = list(targets)
+    if not all(isinstance(target, GraphVertex) for target in targets):
+        raise Exception('Can only evaluate scenarios on GraphVertex targets')
+    return _graph.evaluate_scenarios(targets, scenarios, pool=pool, nprocs=nprocs)
+
 if __name__ == '__main__':
     class Example(GraphObject):
         @Vertex
@@ -1,4 +1,16 @@
+import gc
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+import tracemalloc
 import unittest
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
 import GoldenSource.python.common.graph as graph
 from GoldenSource.python.common.graph import set_value, is_fixed, SetScope
 
@@ -195,4 +207,919 @@ def test_fixing():
     strip.area.clear_value()
     assert not strip.area.is_fixed()
     assert strip.area() == area
-    assert strip.area() != fixed_area
\ No newline at end of file
+    assert strip.area() != fixed_area
+
+def test_lazy_binding():
+    rect = Rectangle()
+    assert 'length' not in rect.__dict__
+    assert rect.length is rect.length
+    assert isinstance(rect.length, graph.GraphVertex)
+    assert isinstance(Rectangle.length, graph.Vertex)
+
+    assert set(Rectangle.vertex_names()) == {'length', 'width', 'area'}
+    assert set(Block.vertex_names()) == {'rectangles', 'length', 'width', 'area', 'height', 'volume'}
+
+    custom = graph.Graph()
+    rect = custom.bind(Rectangle())
+    assert all(getattr(rect, name)._graph is custom for name in Rectangle.vertex_names())
+    assert custom.bind(rect) is rect
+    with pytest.raises(ValueError):
+        graph._graph.bind(rect)
+
+def _make_graph_class(vertex_count):
+    namespace = {}
+    for i in range(vertex_count):
+        def func(self, i=i):
+            return i
+        func.__name__ = 'v{}'.format(i)
+        namespace[func.__name__] = graph.Vertex(func)
+    return type('Bench{}'.format(vertex_count), (graph.GraphObject,), namespace)
+
+def test_construction_cost():
+    instance_count = 10000
+    elapsed = {}
+    for vertex_count in (5, 50, 500):
+        clazz = _make_graph_class(vertex_count)
+        assert len(clazz.vertex_names()) == vertex_count
+
+        for _ in range(3):
+            start_time = time.perf_counter()
+            instances = [clazz() for _ in range(instance_count)]
+            run_time = time.perf_counter() - start_time
+            elapsed[vertex_count] = min(elapsed.get(vertex_count, run_time), run_time)
+
+        # Construction no longer scans the class members, the vertices get bound on first access
+        assert not any(name in instances[-1].__dict__ for name in clazz.vertex_names())
+        assert instances[-1].v3() == 3
+        assert 'v3' in instances[-1].__dict__
+        assert len(instances[-1].__dict__) == 1
+
+    # Constructing an object costs the same whatever the number of vertices of its class, relative to the small class
+    # measured on the same machine
+    assert elapsed[500] < elapsed[5] * 3
+
+def test_diddle_scope_copy_on_write():
+    rect_count = 50
+    block = Block()
+    rectangles = [Rectangle() for _ in range(rect_count)]
+    set_value(block.rectangles, rectangles)
+    area = block.area()
+    volume = block.volume()
+
+    with graph.DiddleScope():
+        scope = graph._graph.active_state
+        assert len(scope) == 0
+        assert block.volume() == volume
+        assert len(scope) == 0
+
+        rectangles[0].length.set_diddle(10)
+        diddle_area = area + (10 - Rectangle.init_length) * Rectangle.init_width
+        assert block.area() == diddle_area
+        assert block.volume() == diddle_area * Block.init_height
+        # Only the diddled vertex and its descendants live in the scope
+        assert set(scope) == {rectangles[0].length, rectangles[0].area, block.area, block.volume}
+
+        with graph.DiddleScope():
+            rectangles[1].width.set_diddle(1)
+            rectangles[0].length.clear_diddle()
+            assert not is_fixed(rectangles[0].length)
+            assert block.area() == area + (1 - Rectangle.init_width) * Rectangle.init_length
+
+        assert is_fixed(rectangles[0].length)
+        assert block.area() == diddle_area
+
+    assert block.area() == area
+    assert block.volume() == volume
+
+class _ExecutorPool(object):
+    """
+    Minimal stand-in for a Threadpool: add_task returns an object exposing get()
+    """
+
+    class _Future(object):
+        def __init__(self, future):
+            self._future = future
+
+        def get(self):
+            return self._future.result()
+
+    def __init__(self, num_threads):
+        self._executor = ThreadPoolExecutor(num_threads)
+
+    def add_task(self, func, *args, **kwargs):
+        return self._Future(self._executor.submit(func, *args, **kwargs))
+
+    def terminate(self):
+        self._executor.shutdown()
+
+def _scenarios_fixture(rect_count=5):
+    block = Block()
+    rectangles = [Rectangle() for _ in range(rect_count)]
+    set_value(block.rectangles, rectangles)
+    scenarios = [{rectangles[i].length: 10 + i, block.height: i + 1} for i in range(rect_count)]
+    expected = {}
+    for index, overrides in enumerate(scenarios):
+        with graph.DiddleScope():
+            for vertex, value in overrides.items():
+                vertex.set_diddle(value)
+            expected[index] = {block.area: block.area(), block.volume: block.volume()}
+    return block, scenarios, expected
+
+def test_evaluate_scenarios():
+    block, scenarios, expected = _scenarios_fixture()
+    area, volume = block.area(), block.volume()
+
+    assert graph.evaluate_scenarios([block.area, block.volume], scenarios) == expected
+
+    # The base state is left untouched
+    assert not is_fixed(block.height)
+    assert block.area() == area
+    assert block.volume() == volume
+
+def test_evaluate_scenarios_threaded():
+    block, scenarios, expected = _scenarios_fixture(rect_count=20)
+    pool = _ExecutorPool(4)
+    try:
+        assert graph.evaluate_scenarios([block.area, block.volume], scenarios, pool=pool) == expected
+    finally:
+        pool.terminate()
+
+def test_evaluate_scenarios_custom_graph():
+    custom = graph.Graph()
+    switch = custom.bind(Switch('test_evaluate_scenarios_custom_graph'))
+    assert switch.total() == 10
+
+    scenarios = [{switch.base: 20}, {switch.use_bonus: True, switch.bonus: 5}]
+    assert custom.evaluate_scenarios([switch.total], scenarios) == {0: {switch.total: 20}, 1: {switch.total: 15}}
+    assert switch.total() == 10
+
+    with graph.DiddleScope(graph=custom):
+        assert custom.active_state._graph is custom
+        switch.base.set_diddle(30)
+        assert switch.total() == 30
+    assert switch.total() == 10
+
+def _concurrency_available():
+    try:
+        import GoldenSource.python.common.concurrency
+    except Exception:
+        return False
+    return True
+
+@pytest.mark.skipif(not _concurrency_available(), reason='concurrency module cannot be loaded in this environment')
+def test_evaluate_scenarios_processes():
+    block, scenarios, expected = _scenarios_fixture()
+    assert graph.evaluate_scenarios([block.area, block.volume], scenarios, nprocs=2) == expected
+
+    # A failing scenario is reported to the caller instead of killing its worker
+    rectangle = block.rectangles()[0]
+    with pytest.raises(graph.GraphEvaluationError) as error:
+        graph.evaluate_scenarios([block.volume], scenarios + [{rectangle.length: None}], nprocs=2)
+    assert error.value.vertices == ('Block.volume', 'Block.area', 'Rectangle.area')
+    assert isinstance(error.value.cause, TypeError)
+
+@pytest.mark.skipif(not _concurrency_available(), reason='concurrency module cannot be loaded in this environment')
+def test_scenario_pool():
+    block, scenarios, expected = _scenarios_fixture()
+    inputs = {vertex for overrides in scenarios for vertex in overrides}
+    with graph._graph.scenario_pool([block.area, block.volume], inputs, nprocs=2, capacity=2) as pool:
+        assert pool.evaluate(scenarios) == expected
+        # The workers are reused from one batch to the next
+        assert pool.evaluate(scenarios[:1]) == {0: expected[0]}
+        # Concurrent calls do not overwrite each other's results
+        with ThreadPoolExecutor(4) as executor:
+            calls = [executor.submit(pool.evaluate, scenarios[index:] + scenarios[:index]) for index in range(4)]
+        for index, call in enumerate(calls):
+            assert call.result() == {slot: expected[(slot + index) % len(scenarios)] for slot in range(len(scenarios))}
+        with pytest.raises(ValueError):
+            pool.evaluate([{block.area: 1}])
+
+def test_set_values():
+    rect_count = 5
+    block = Block()
+    rectangles = [Rectangle() for _ in range(rect_count)]
+    set_value(block.rectangles, rectangles)
+    area = block.area()
+    volume = block.volume()
+
+    graph.set_values({rect.length: 2 for rect in rectangles})
+    area = 2 * Rectangle.init_width * rect_count
+    assert block.area() == area
+    assert block.volume() == area * Block.init_height
+
+    graph.set_values({rectangles[0].width: 1, block.height: 3, rectangles[1].length: graph.CLEAR})
+    area += (1 - Rectangle.init_width) * 2 + (Rectangle.init_length - 2) * Rectangle.init_width
+    assert not is_fixed(rectangles[1].length)
+    assert block.area() == area
+    assert block.volume() == area * 3
+
+    with pytest.raises(RuntimeError):
+        graph.set_values({rectangles[1].length: graph.CLEAR})
+
+    # A value that cannot be set leaves all the others unchanged
+    with pytest.raises(RuntimeError):
+        graph.set_values({rectangles[2].length: 3, rectangles[1].length: graph.CLEAR})
+    assert rectangles[2].length() == 2
+    assert block.area() == area
+
+def test_set_values_custom_graph():
+    custom = graph.Graph()
+    switch = custom.bind(Switch('test_set_values_custom_graph'))
+    rect = Rectangle()
+    assert switch.total() == 10
+
+    # Each vertex is set on the graph it belongs to
+    with SetScope({switch.base: 20, rect.length: 2}):
+        assert custom.active_state.lookup(switch.base).is_fixed()
+        assert graph._graph.active_state.lookup(switch.base) is None
+        assert switch.total() == 20
+        assert rect.area() == 2 * Rectangle.init_width
+    assert not is_fixed(switch.base)
+    assert switch.total() == 10
+    assert rect.area() == Rectangle.init_length * Rectangle.init_width
+
+    graph.set_values({switch.use_bonus: True, rect.width: 1})
+    assert switch.total() == 11
+    assert rect.area() == Rectangle.init_length
+
+def test_topological_order_tracks_new_edges():
+    rect = Rectangle()
+    rect.area()
+    order = graph._graph._topological_descendants((rect.length,))
+    assert order == (rect.length, rect.area)
+
+    # A dependency discovered after the order got cached must still be invalidated
+    strip = Strip()
+    set_value(strip.rectangles, [rect])
+    assert strip.area() == rect.area()
+    order = graph._graph._topological_descendants((rect.length,))
+    assert order.index(rect.length) < order.index(rect.area) < order.index(strip.area)
+
+    rect.length.set_value(10)
+    assert strip.area() == 10 * Rectangle.init_width
+
+class SlowRectangle(Rectangle):
+    evaluations = Counter()
+    threads = set()
+
+    @graph.Vertex
+    def area(self):
+        SlowRectangle.evaluations[self] += 1
+        SlowRectangle.threads.add(threading.get_ident())
+        time.sleep(0.01)
+        return self.length() * self.width()
+
+def test_concurrent_latch():
+    rect = SlowRectangle()
+    state = graph._graph.active_state
+    barrier = threading.Barrier(8)
+
+    def evaluate():
+        barrier.wait()
+        graph._graph._evaluate_in_state(state, rect.area)
+
+    with graph._graph.concurrent_mode():
+        threads = [threading.Thread(target=evaluate) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert SlowRectangle.evaluations[rect] == 1
+    assert rect.area() == Rectangle.init_length * Rectangle.init_width
+
+def test_evaluate_concurrently():
+    rect_count = 20
+    strip = Strip()
+    rectangles = [SlowRectangle() for _ in range(rect_count)]
+    set_value(strip.rectangles, rectangles)
+    area = strip.area()
+
+    graph.set_values({rect.length: 2 for rect in rectangles})
+    SlowRectangle.evaluations.clear()
+    SlowRectangle.threads.clear()
+    pool = _ExecutorPool(rect_count)
+    try:
+        assert graph._graph.evaluate_concurrently(strip.area, pool) == area * 2 // Rectangle.init_length
+    finally:
+        pool.terminate()
+
+    assert all(SlowRectangle.evaluations[rect] == 1 for rect in rectangles)
+    # The rectangle areas got computed on the pool threads
+    assert threading.get_ident() not in SlowRectangle.threads
+    assert len(SlowRectangle.threads) > 1
+
+def test_array_edge_store():
+    edge_graph = graph.Graph(edge_store=graph.ArrayEdgeStore())
+    rect = Rectangle()
+    length = graph.GraphVertex(rect, Rectangle.length.func, edge_graph)
+    width = graph.GraphVertex(rect, Rectangle.width.func, edge_graph)
+    area = graph.GraphVertex(rect, lambda obj: edge_graph.get_value(length) * edge_graph.get_value(width), edge_graph)
+
+    assert edge_graph.get_value(area) == Rectangle.init_length * Rectangle.init_width
+    assert set(area.parents) == {length, width}
+    assert length.children == (area,)
+
+    edge_graph.set_value(length, 2)
+    assert edge_graph.get_value(area) == 2 * Rectangle.init_width
+    assert set(area.parents) == {length, width}
+
+def _graph_memory(edge_store, vertex_count):
+    """
+    Returns the memory taken by vertex_count chained vertices and their payloads, in MB per million vertices
+    """
+    memory_graph = graph.Graph(edge_store=edge_store)
+    state = memory_graph.active_state
+    func = Rectangle.length.func
+    rect = Rectangle()
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        previous = None
+        vertices = []
+        for _ in range(vertex_count):
+            vertex = graph.GraphVertex(rect, func, memory_graph)
+            state.own(vertex).value = 0
+            if previous is not None:
+                edge_store.add_edge(previous, vertex)
+            vertices.append(vertex)
+            previous = vertex
+        memory, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return memory / vertex_count * 1e6 / 2 ** 20
+
+def _object_memory(factory, count=20000):
+    """
+    Returns the memory taken by each of count objects built by factory, in bytes
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        objects = [factory() for _ in range(count)]
+        memory = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    assert len(objects) == count
+    return memory / count
+
+def test_memory_footprint():
+    # The __slots__ payloads and vertices against the same classes keeping their attributes in a __dict__
+    memory_graph = graph.Graph()
+    state = memory_graph.active_state
+    rect = Rectangle()
+    func = Rectangle.length.func
+    vertex = graph.GraphVertex(rect, func, memory_graph)
+    dict_payload = type('DictPayload', (object,), {'__init__': graph.VertexPayload.__init__})
+    dict_vertex = type('DictVertex', (object,), {'__init__': graph.GraphVertex.__init__})
+    assert _object_memory(lambda: graph.VertexPayload(vertex, state)) < _object_memory(lambda: dict_payload(vertex, state))
+    assert _object_memory(lambda: graph.GraphVertex(rect, func, memory_graph)) < \
+        _object_memory(lambda: dict_vertex(rect, func, memory_graph))
+
+    vertex_count = 20000
+    assert _graph_memory(graph.ArrayEdgeStore(), vertex_count) < _graph_memory(graph.SetEdgeStore(), vertex_count)
+
+def test_profiler():
+    rect_count = 5
+    block = Block()
+    rectangles = [Rectangle() for _ in range(rect_count)]
+    set_value(block.rectangles, rectangles)
+
+    with graph._graph.profiling() as profiler:
+        block.volume()
+        block.volume()
+        block.area()
+
+    assert not graph._graph.gather_performance
+    profiles = profiler.profiles
+    assert profiles[block.volume].misses == 1
+    assert profiles[block.volume].hits == 1
+    assert profiles[block.area].misses == 1
+    assert profiles[block.area].hits == 1
+    assert profiles[block.area].hit_ratio == 0.5
+    for rect in rectangles:
+        assert profiles[rect.area].misses == 1
+        assert profiles[rect.length].misses == 1
+
+    volume = profiles[block.volume]
+    assert 0 <= volume.self_time <= volume.inclusive_time
+    assert profiles[block.area].inclusive_time <= volume.inclusive_time
+    assert volume.histogram.count == 1
+    assert volume.histogram.percentile(50) >= volume.inclusive_time
+
+    collapsed = profiler.to_collapsed().splitlines()
+    assert any(line.startswith('Block.volume;Block.area;Rectangle.area;Rectangle.length ') for line in collapsed)
+    assert all(int(line.rsplit(' ', 1)[1]) >= 0 for line in collapsed)
+
+def test_profiler_dataframe():
+    pytest.importorskip('pandas')
+    rect = Rectangle()
+    with graph._graph.profiling() as profiler:
+        rect.area()
+    frame = profiler.to_dataframe()
+    assert set(frame['vertex']) == {'Rectangle.area', 'Rectangle.length', 'Rectangle.width'}
+    assert (frame['misses'] == 1).all()
+
+def test_duration_histogram():
+    histogram = graph.DurationHistogram()
+    for duration in (0, 1e-7, 3e-6, 1e-3, 10., 1e9):
+        histogram.add(duration)
+    assert histogram.count == 6
+    assert len(histogram.counts) == graph.DurationHistogram.BUCKETS
+    assert histogram.counts[0] == 2
+    assert histogram.counts[-1] == 1
+    assert histogram.percentile(50) == histogram.upper_bound(2)
+
+class Curve(graph.GraphObject):
+    evaluations = Counter()
+
+    def __init__(self, name):
+        self.name = name
+
+    def persist_key(self):
+        return self.name
+
+    @graph.Vertex
+    def quotes(self):
+        return [1., 2., 3.]
+
+    @graph.Vertex(persist=True)
+    def bootstrap(self):
+        Curve.evaluations[self.name] += 1
+        return [2. * quote for quote in self.quotes()]
+
+def test_persistent_vertex(tmp_path):
+    graph._graph.enable_persistence(str(tmp_path))
+    try:
+        curve = Curve('test_persistent_vertex')
+        assert curve.bootstrap() == [2., 4., 6.]
+        curve.quotes.set_value([1.])
+        assert curve.bootstrap() == [2.]
+        assert Curve.evaluations[curve.name] == 2
+
+        # Inputs seen before address the stored entries again
+        curve.quotes.set_value([1., 2., 3.])
+        assert curve.bootstrap() == [2., 4., 6.]
+        curve.quotes.clear_value()
+        assert curve.bootstrap() == [2., 4., 6.]
+        curve.quotes.set_value([1.])
+        assert curve.bootstrap() == [2.]
+        assert Curve.evaluations[curve.name] == 3
+    finally:
+        graph._graph.disable_persistence()
+    assert graph._graph.persistent_store is None
+
+    curve.quotes.set_value([5.])
+    assert curve.bootstrap() == [10.]
+    assert Curve.evaluations[curve.name] == 4
+    assert not list(tmp_path.glob('*.tmp'))
+
+class Book(graph.GraphObject):
+    def __init__(self, name):
+        self.name = name
+
+    def persist_key(self):
+        return self.name
+
+    @graph.Vertex
+    def positions(self):
+        return {}
+
+    @graph.Vertex(persist=True)
+    def size(self):
+        return len(self.positions())
+
+def test_persistent_vertex_undigestable_inputs(tmp_path):
+    graph._graph.enable_persistence(str(tmp_path))
+    try:
+        book = Book('test_persistent_vertex_undigestable_inputs')
+        positions = {'usd': 1}
+        positions['self'] = positions
+        # The cyclic input cannot be digested, the vertex is evaluated without being stored
+        book.positions.set_value(positions)
+        assert book.size() == 2
+        assert not list(tmp_path.glob('*.value'))
+        book.positions.set_value({'usd': 1})
+        assert book.size() == 1
+        assert len(list(tmp_path.glob('*.value'))) == 1
+        book.positions.set_value(positions)
+        assert book.size() == 2
+    finally:
+        graph._graph.disable_persistence()
+
+    # Sets digest the same whatever the hash seed of the process
+    code = 'import GoldenSource.python.common.graph as graph; print(graph.PersistentStore._digest(({}, ["x"])))'.format(
+        "{'usd', 'eur', 'gbp', 'jpy', frozenset({'a', 'b', 'c'})}"
+    )
+    root = os.path.abspath(os.path.join(os.path.dirname(graph.__file__), '..', '..', '..'))
+    digests = set()
+    for seed in ('1', '2', '3'):
+        env = dict(os.environ, PYTHONHASHSEED=seed, PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')]))
+        digests.add(subprocess.run([sys.executable, '-c', code], env=env, check=True, stdout=subprocess.PIPE,
+                                   universal_newlines=True).stdout)
+    assert len(digests) == 1
+
+_PERSISTENT_SCRIPT = textwrap.dedent("""
+    import sys
+    import GoldenSource.python.common.graph as graph
+
+    class Curve(graph.GraphObject):
+        def __init__(self, name):
+            self.name = name
+
+        def persist_key(self):
+            return self.name
+
+        @graph.Vertex
+        def quotes(self):
+            return [1., 2., 3.]
+
+        @graph.Vertex(persist=True)
+        def bootstrap(self):
+            print('evaluated')
+            return [2. * quote for quote in self.quotes()]
+
+    graph._graph.enable_persistence(sys.argv[1])
+    curve = Curve('usd')
+    print(curve.bootstrap())
+    curve.quotes.set_value([4.])
+    print(curve.bootstrap())
+""")
+
+def test_persistent_vertex_across_processes(tmp_path):
+    root = os.path.abspath(os.path.join(os.path.dirname(graph.__file__), '..', '..', '..'))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')]))
+    script = tmp_path / 'persistent.py'
+    script.write_text(_PERSISTENT_SCRIPT)
+
+    def run():
+        return subprocess.run([sys.executable, str(script), str(tmp_path / 'store')], env=env, check=True,
+                              stdout=subprocess.PIPE, universal_newlines=True).stdout.split('\n')
+
+    assert run() == ['evaluated', '[2.0, 4.0, 6.0]', 'evaluated', '[8.0]', '']
+    # The restarted process reloads both entries, and the loaded vertex is still invalidated by its upstream input
+    assert run() == ['[2.0, 4.0, 6.0]', '[8.0]', '']
+
+def test_watch():
+    evaluations = Counter()
+    notifications = []
+
+    class Box(Rectangle):
+        @graph.Vertex
+        def height(self):
+            return 5
+
+        @graph.Vertex
+        def volume(self):
+            evaluations['volume'] += 1
+            return self.area() * self.height()
+
+    block = Box()
+    other = Rectangle()
+    assert graph.watch(block.volume, lambda vertex, value: notifications.append((vertex, value))) == 125
+    assert block.area.watch(lambda vertex, value: notifications.append((vertex, value))) == 25
+    assert evaluations['volume'] == 1
+
+    block.height.set_value(2)
+    assert notifications == [(block.volume, 50)]
+
+    # Dependency order within a batch, each watched vertex recomputed once
+    del notifications[:]
+    with graph.batch():
+        block.length.set_value(2)
+        block.width.set_value(3)
+        assert notifications == []
+    assert notifications == [(block.area, 6), (block.volume, 12)]
+    assert evaluations['volume'] == 3
+
+    # Unchanged values do not notify, unrelated inputs do not recompute
+    del notifications[:]
+    graph.set_values({block.length: 3, block.width: 2})
+    other.length.set_value(10)
+    assert notifications == []
+    assert evaluations['volume'] == 4
+
+    # Diddles do not notify the watches of the root state, only those of their scope
+    with graph.DiddleScope():
+        scoped = []
+        graph.watch(block.area, lambda vertex, value: scoped.append((vertex, value)))
+        block.height.set_diddle(100)
+        assert block.volume() == 600
+        block.length.set_diddle(1)
+        assert scoped == [(block.area, 2)]
+        block.length.clear_diddle()
+        assert scoped == [(block.area, 2), (block.area, block.area())]
+    assert notifications == []
+
+    # The watches of the scope are kept apart, the root watches still notify
+    block.length.set_value(2)
+    assert notifications == [(block.area, 4), (block.volume, 8)]
+    block.length.set_value(3)
+    del notifications[:]
+
+    graph.unwatch(block.area)
+    block.height.clear_value()
+    assert notifications == [(block.volume, 30)]
+    block.volume.unwatch()
+    block.height.set_value(1)
+    assert notifications == [(block.volume, 30)]
+
+class Chain(graph.GraphObject):
+    def __init__(self, parent=None):
+        self.parent = parent
+
+    @graph.Vertex
+    def value(self):
+        return self.parent.value() + 1 if self.parent is not None else 0
+
+class FailingChain(Chain):
+    @graph.Vertex
+    def value(self):
+        return self.parent.value() + 1 if self.parent is not None else {}['missing']
+
+def _make_chain(clazz, depth):
+    chain = None
+    for _ in range(depth):
+        chain = clazz(chain)
+    return chain
+
+def test_evaluation_error():
+    chain = _make_chain(FailingChain, 3)
+    with pytest.raises(graph.GraphEvaluationError) as error:
+        chain.value()
+    assert error.value.vertices == (chain.value, chain.parent.value, chain.parent.parent.value)
+    assert isinstance(error.value.__cause__, KeyError)
+    assert error.value.cause is error.value.__cause__
+    assert str(error.value).startswith('FailingChain.value -> FailingChain.value -> FailingChain.value: KeyError')
+    assert not graph._graph.is_calculating()
+
+def test_nested_call_overhead():
+    def per_level_time(depth, count=50):
+        best = float('inf')
+        for _ in range(3):
+            chains = [_make_chain(Chain, depth) for _ in range(count)]
+            start = time.perf_counter()
+            for chain in chains:
+                assert chain.value() == depth - 1
+            best = min(best, (time.perf_counter() - start) / (depth * count))
+        return best
+
+    # Evaluating a vertex costs the same whatever its depth in the graph, relative to the shallow chains measured on
+    # the same machine. Rewriting the traceback at every level made the cost per level grow with the depth
+    shallow, deep = per_level_time(10), per_level_time(150)
+    assert deep < shallow * 3
+
+class CountingEdgeStore(graph.SetEdgeStore):
+    def __init__(self):
+        super(CountingEdgeStore, self).__init__()
+        self.checks = 0
+
+    def has_edge(self, parent, child):
+        self.checks += 1
+        return super(CountingEdgeStore, self).has_edge(parent, child)
+
+class Switch(graph.GraphObject):
+    def __init__(self, name):
+        self.name = name
+
+    def persist_key(self):
+        return self.name
+
+    @graph.Vertex
+    def use_bonus(self):
+        return False
+
+    @graph.Vertex
+    def base(self):
+        return 10
+
+    @graph.Vertex
+    def bonus(self):
+        return 1
+
+    @graph.Vertex
+    def total(self):
+        return self.base() + (self.bonus() if self.use_bonus() else 0)
+
+def test_freeze(tmp_path):
+    edges = CountingEdgeStore()
+    custom = graph.Graph(edge_store=edges)
+    switch = custom.bind(Switch('test_freeze'))
+
+    assert switch.total() == 10
+    with pytest.raises(ValueError):
+        custom.freeze()
+    snapshot = custom.freeze([switch.total])
+    assert custom.snapshot is snapshot
+    assert snapshot.schedule(switch.total)[-1] is switch.total
+    assert set(snapshot.schedule(switch.total)) == {switch.total, switch.base, switch.use_bonus}
+
+    # No edge bookkeeping for the frozen vertices, the invalidation still follows the frozen edges
+    edges.checks = 0
+    custom.set_value(switch.base, 20)
+    assert switch.total() == 20
+    assert edges.checks == 0
+
+    # A new code path falls back to dynamic discovery
+    custom.set_value(switch.use_bonus, True)
+    assert switch.total() == 21
+    assert switch.total not in snapshot
+    assert switch.bonus in switch.total.parents
+    custom.set_value(switch.bonus, 2)
+    assert switch.total() == 22
+    custom.unfreeze()
+
+    path = str(tmp_path / 'snapshot')
+    snapshot = custom.freeze([switch.total])
+    assert snapshot.dump(path) == 4
+    custom.unfreeze()
+    loaded = graph.GraphSnapshot.load(path)
+    assert len(loaded) == 4
+    assert set(loaded.parents(switch.total)) == {switch.base, switch.bonus, switch.use_bonus}
+    assert custom.freeze(snapshot=loaded) is loaded
+    custom.unfreeze()
+
+def test_freeze_new_valid_parent():
+    edges = CountingEdgeStore()
+    custom = graph.Graph(edge_store=edges)
+    switch = custom.bind(Switch('test_freeze_new_valid_parent'))
+
+    assert switch.total() == 10
+    assert switch.bonus() == 1
+    snapshot = custom.freeze([switch.total])
+
+    # The new code path reads a parent that is already valid, which still thaws the vertex
+    custom.set_value(switch.use_bonus, True)
+    assert switch.total() == 11
+    assert switch.total not in snapshot
+    assert switch.bonus in switch.total.parents
+    custom.set_value(switch.bonus, 100)
+    assert switch.total() == 110
+    custom.unfreeze()
+
+class ScaledRectangle(Rectangle):
+    evaluations = Counter()
+
+    @graph.Vertex
+    def scale(self):
+        return 1
+
+    @graph.Vertex
+    def length(self):
+        ScaledRectangle.evaluations[self] += 1
+        time.sleep(0.01)
+        return self.init_length * self.scale()
+
+def test_freeze_concurrent_latch():
+    rect = ScaledRectangle()
+    assert rect.area() == Rectangle.init_length * Rectangle.init_width
+    graph._graph.freeze([rect.area])
+    try:
+        set_value(rect.scale, 2)
+        ScaledRectangle.evaluations.clear()
+        state = graph._graph.active_state
+        barrier = threading.Barrier(8)
+
+        def evaluate():
+            barrier.wait()
+            graph._graph._evaluate_in_state(state, rect.area)
+
+        # The stale ancestors scheduled by the frozen vertex are computed once too
+        with graph._graph.concurrent_mode():
+            threads = [threading.Thread(target=evaluate) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        graph._graph.unfreeze()
+
+    assert ScaledRectangle.evaluations[rect] == 1
+    assert rect.area() == 2 * Rectangle.init_length * Rectangle.init_width
+
+def test_graph_column():
+    numpy = pytest.importorskip('numpy')
+    rects = [Rectangle() for _ in range(1000)]
+    for index, rect in enumerate(rects):
+        rect.init_length = index
+    rects[3].width.set_value(2)
+    column = graph.GraphColumn(Rectangle, rects)
+    assert len(column) == 1000
+
+    lengths = numpy.arange(1000)
+    widths = numpy.full(1000, Rectangle.init_width)
+    widths[3] = 2
+    assert (column.length() == lengths).all()
+    assert (column.area() == lengths * widths).all()
+    assert column.area() is column.area()
+
+    # Per-instance overrides are masked over the column results, and invalidate them
+    rects[10].length.set_value(0.5)
+    rects[20].area.set_value(-1)
+    expected = (lengths * widths).astype(float)
+    expected[10] = 0.5 * Rectangle.init_width
+    expected[20] = -1
+    assert column.area()[10] == 2.5
+    assert (column.area() == expected).all()
+    assert rects[10].area() == 2.5
+
+    with graph.DiddleScope():
+        rects[30].width.set_diddle(0)
+        assert column.area()[30] == 0
+    assert column.area()[30] == 30 * Rectangle.init_width
+
+    rects[20].area.clear_value()
+    assert column.area()[20] == 20 * Rectangle.init_width
+    assert str(column.area) == 'Rectangle[].area'
+
+def test_watch_column():
+    numpy = pytest.importorskip('numpy')
+    rects = [Rectangle() for _ in range(10)]
+    column = graph.GraphColumn(Rectangle, rects)
+    notifications = []
+    assert (column.area.watch(lambda vertex, value: notifications.append(value.copy())) == 25).all()
+
+    rects[3].width.set_value(Rectangle.init_width)
+    assert notifications == []
+    rects[3].width.set_value(2)
+    expected = numpy.full(10, 25)
+    expected[3] = 10
+    assert len(notifications) == 1
+    assert (notifications[0] == expected).all()
+    column.area.unwatch()
+
+def test_bounded_state():
+    custom = graph.Graph()
+    state = custom.active_state
+    state.set_capacity(100)
+    assert state.capacity == 100
+
+    rects = [custom.bind(Rectangle()) for _ in range(200)]
+    rects[0].length.set_value(2)
+    for rect in rects:
+        rect.area()
+    assert len(state) <= 100
+    assert custom.is_fixed(rects[0].length)
+    assert all(rect.area() == (10 if rect is rects[0] else 25) for rect in rects)
+
+    # Recently used payloads survive
+    state.set_capacity(None)
+    state.clear()
+    for rect in rects[:30]:
+        rect.area()
+    state.set_capacity(100)
+    rects[5].area()
+    for rect in rects[30:40]:
+        rect.area()
+    assert rects[5].area in state
+    assert rects[6].area not in state
+
+    # The invalidation goes through evicted payloads
+    chain = [custom.bind(Chain())]
+    for _ in range(3):
+        chain.append(custom.bind(Chain(chain[-1])))
+    assert chain[-1].value() == 3
+    state.discard(chain[1].value)
+    custom.set_value(chain[0].value, 10)
+    assert chain[-1].value() == 13
+
+def test_bounded_state_cost_eviction():
+    custom = graph.Graph()
+    custom.set_state_capacity(20, eviction=graph.GraphState.COST)
+    state = custom.active_state
+    assert state.capacity == 20
+
+    slow = custom.bind(SlowRectangle(), ('area',))
+    rects = []
+    for _ in range(30):
+        rect = Rectangle()
+        rect.__dict__['area'] = graph.GraphVertex(rect, lambda obj: 1, custom)
+        rects.append(rect)
+
+    with custom.profiling():
+        slow.area()
+        for rect in rects:
+            rect.area()
+    assert len(state) <= 20
+    assert slow.area in state
+
+    with pytest.raises(ValueError):
+        state.set_capacity(10, eviction='fifo')
+
+def test_weak_objects():
+    custom = graph.Graph(weak_objects=True)
+    assert custom.weak_objects
+
+    strip = custom.bind(Strip())
+    rects = [custom.bind(Rectangle()) for _ in range(3)]
+    custom.set_value(strip.rectangles, rects)
+    assert strip.area() == 75
+    assert len(custom.active_state) == 11
+    assert len(strip.area.parents) == 4
+
+    custom.set_value(strip.rectangles, [])
+    del rects
+    assert strip.area() == 0
+    assert len(custom.active_state) == 2
+    assert strip.area.parents == {strip.rectangles}
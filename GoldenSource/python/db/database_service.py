@@ -1,10 +1,11 @@
-from threading import RLock, current_thread, Event
+from threading import RLock, current_thread
 import datetime
 
 import pandas
 from mysql.connector import MySQLConnection, Error as ConnectionError, ProgrammingError, errorcode
 from GoldenSource.python.utils.data_types import ndict
-from GoldenSource.python.common.concurrency import Timer
+from GoldenSource.python.common.concurrency import lock_monitor
+from GoldenSource.python.services.scheduler_service import SchedulerService, ScheduledJob
 from GoldenSource.python.common.domain import Domain
 from GoldenSource.python.common.services import Service
 from GoldenSource.python.utils.patterns import Singleton
@@ -323,21 +324,22 @@ class DatabaseService(Service, metaclass=Singleton):
         self._logger = domain.logger_service.get_logger(self.__class__.__name__)
         self._databases = domain.get_param('databases', default = {})
         self._connections = {}
-        self._global_lock = RLock()
+        self._global_lock = lock_monitor.lock('DatabaseService.global', RLock())
         self._locks = {}
 
         self._idle_timeout = domain.get_param(self.__class__.__name__, 'idle_timeout', as_type=int, default = 0)
-        self._idle_timeout_event = Event()
+        self._idle_job = None
         if self._idle_timeout > 0:
-            self._idle_timer = Timer(event=self._idle_timeout_event, fcn=self._recycle, interval=int(self._idle_timeout / 2), name="Recycle")
-            self._idle_timer.start()
+            self._idle_job = domain.get_service(SchedulerService).schedule(self._recycle, int(self._idle_timeout / 2), name="Recycle",
+                                                                           mode=ScheduledJob.FIXED_DELAY)
 
     @property
     def is_recycle_running(self):
         return self._idle_timeout > 0
     
     def shutdown(self):
-        self._idle_timeout_event.set()
+        if self._idle_job is not None:
+            self._idle_job.cancel()
         with self._global_lock:
             for db in self._connections.values():
                 if db.link_status:
@@ -0,0 +1,39 @@
+from GoldenSource.python.utils import patterns
+from GoldenSource.python.common.concurrency import lock_monitor
+from GoldenSource.python.common.services import Service
+from GoldenSource.python.services.scheduler_service import SchedulerService
+
+
+
+class LockMonitorService(Service, metaclass=patterns.Singleton):
+    """
+    Periodically logs the contention report of the named locks, see concurrency.LockMonitor. Lock instrumentation is opt-in, with the
+    locks section of the configuration:
+        instrument: True to instrument the named locks
+        report_interval: Seconds between reports, 0 for none
+    """
+    DEFAULT_REPORT_INTERVAL = 60
+    _REPORT_INTERVAL = 'report_interval'
+
+    def __init__(self, domain):
+        super(LockMonitorService, self).__init__(domain)
+        self.logger = domain.logger_service.get_logger(self.__class__.__name__)
+        self._report_interval = domain.get_param('locks', self._REPORT_INTERVAL, default=self.DEFAULT_REPORT_INTERVAL)
+        self._job = None
+        if lock_monitor.enabled and self._report_interval > 0:
+            self._job = domain.get_service(SchedulerService).schedule(self.log_report, self._report_interval, name='LockReport')
+
+    def snapshot(self):
+        """
+        Returns the statistics of the named locks {name: LockStats}
+        """
+        return lock_monitor.snapshot()
+
+    def log_report(self):
+        report = lock_monitor.report()
+        if report:
+            self.logger.info("Lock contention:\n{}".format(report))
+
+    def shutdown(self):
+        if self._job is not None:
+            self._job.cancel()
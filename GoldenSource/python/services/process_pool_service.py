@@ -0,0 +1,101 @@
+import importlib
+import multiprocessing
+
+from GoldenSource.python.utils import patterns
+from GoldenSource.python.common.concurrency import ProcessPool
+from GoldenSource.python.common.services import Service
+
+
+
+class ProcessPoolService(Service, metaclass=patterns.Singleton):
+    """
+    Multiprocessing service, keeping named pools of warm worker processes so that parallel maps do not pay for starting processes on every
+    call like parmap does. The workers are forked from the process creating the pool, see ProcessPool.
+
+    Pools are configured in the multiprocessing section, per pool name or for all pools:
+        number: Number of worker processes, the number of CPUs by default
+        chunksize: Number of items sent to a worker at once
+        max_pending: Maximum number of chunks in flight, bounding the memory used by a map
+        initializer: "module:function" run once in each worker when it starts, e.g. to load configuration
+    """
+    DEFAULT_POOL_NAME = "DEFAULT"
+    _PROCESS_COUNT = 'number'
+    _CHUNK_SIZE = 'chunksize'
+    _MAX_PENDING = 'max_pending'
+    _INITIALIZER = 'initializer'
+
+    def __init__(self, domain):
+        super(ProcessPoolService, self).__init__(domain)
+        self._domain = domain
+        self._default_process_count = domain.get_param('multiprocessing', self._PROCESS_COUNT, default=multiprocessing.cpu_count())
+        self._default_chunk_size = domain.get_param('multiprocessing', self._CHUNK_SIZE, default=1)
+        self._default_max_pending = domain.get_param('multiprocessing', self._MAX_PENDING, default=None)
+        self._default_initializer = domain.get_param('multiprocessing', self._INITIALIZER, default=None)
+        self._pools = {}
+
+    def __getitem__(self, name):
+        return self.get_pool(name)
+
+    @staticmethod
+    def _resolve(initializer):
+        """
+        Resolves a "module:function" initializer
+        """
+        if initializer is None or callable(initializer):
+            return initializer
+        module, _, name = initializer.partition(':')
+        return getattr(importlib.import_module(module), name)
+
+    def get_pool(self, name=DEFAULT_POOL_NAME, f=None, initargs=(), **kwargs):
+        """
+        Returns the named pool, starting its workers on first use
+        :param f: Default function of the pool, see ProcessPool
+        :param initargs: Arguments of the initializer
+        :param kwargs: number, chunksize, max_pending or initializer (a callable or "module:function"), overriding the configuration
+        """
+        if name not in self._pools:
+            process_count = kwargs.get(
+                self._PROCESS_COUNT
+                , self._domain.get_param('multiprocessing', name, self._PROCESS_COUNT, default=self._default_process_count)
+            )
+            chunk_size = kwargs.get(
+                self._CHUNK_SIZE
+                , self._domain.get_param('multiprocessing', name, self._CHUNK_SIZE, default=self._default_chunk_size)
+            )
+            max_pending = kwargs.get(
+                self._MAX_PENDING
+                , self._domain.get_param('multiprocessing', name, self._MAX_PENDING, default=self._default_max_pending)
+            )
+            initializer = kwargs.get(
+                self._INITIALIZER
+                , self._domain.get_param('multiprocessing', name, self._INITIALIZER, default=self._default_initializer)
+            )
+            self._pools[name] = ProcessPool(f, process_count, initializer=self._resolve(initializer), initargs=initargs,
+                                            chunksize=chunk_size, max_pending=max_pending)
+        return self._pools[name]
+
+    def map(self, func, X, pool_name=DEFAULT_POOL_NAME, chunksize=None):
+        """
+        Runs func over X on the named pool
+        :return: The list of the results, in the order of X
+        """
+        return self.get_pool(pool_name).map(X, func, chunksize)
+
+    def imap(self, func, X, pool_name=DEFAULT_POOL_NAME, chunksize=None):
+        """
+        Runs func over X on the named pool, streaming the results, see ProcessPool.imap
+        :return: Generator of the results, in the order of X
+        """
+        return self.get_pool(pool_name).imap(X, func, chunksize)
+
+    def map_array(self, func, X, pool_name=DEFAULT_POOL_NAME, rows=None, out_dtype=None, out_shape=None):
+        """
+        Runs the vectorized func over slices of rows of the NumPy array or DataFrame X on the named pool, through shared memory, see
+        ProcessPool.map_array
+        """
+        return self.get_pool(pool_name).map_array(func, X, rows, out_dtype, out_shape)
+
+    def shutdown(self):
+        for pool in self._pools.values():
+            pool.close()
+        self._pools.clear()
@@ -0,0 +1,198 @@
+import heapq
+import itertools
+import math
+import random
+import time
+from datetime import datetime
+from queue import Full
+from threading import Thread, Condition
+
+from GoldenSource.python.utils import patterns
+from GoldenSource.python.common.concurrency import WaitTimeStats
+from GoldenSource.python.common.services import Service
+from GoldenSource.python.services.threadpool_service import ThreadpoolService
+
+
+
+class ScheduledJob(object):
+    """
+    Periodic job of the SchedulerService, see SchedulerService.schedule
+    """
+    FIXED_RATE = 'fixed_rate'
+    FIXED_DELAY = 'fixed_delay'
+
+    def __init__(self, scheduler, fcn, interval, name, mode, jitter, pool):
+        if mode not in (self.FIXED_RATE, self.FIXED_DELAY):
+            raise ValueError("Unknown scheduling mode {} for job {}".format(mode, name))
+        self.scheduler = scheduler
+        self.fcn = fcn
+        self.interval = interval
+        self.name = name
+        self.mode = mode
+        self.jitter = jitter
+        self.pool = pool
+        self.last_called = None
+        self.runs = 0
+        self.missed = 0
+        # How late the runs start, queueing on the pool included
+        self.lateness = WaitTimeStats()
+        self.cancelled = False
+        self.running = False
+        self._scheduled = None
+
+    def _due(self, scheduled):
+        """
+        Returns when to run the occurrence scheduled at the given time, the jitter delaying each run without shifting the schedule
+        """
+        self._scheduled = scheduled
+        return scheduled + random.uniform(0, self.jitter) if self.jitter else scheduled
+
+    def _next_due(self, now):
+        """
+        Returns when to run the next occurrence of a fixed rate job, skipping the occurrences already missed
+        """
+        scheduled = self._scheduled + self.interval
+        if scheduled <= now:
+            missed = math.floor((now - scheduled) / self.interval) + 1
+            self.missed += missed
+            scheduled += missed * self.interval
+        return self._due(scheduled)
+
+    def _run(self, due):
+        self.lateness.add(max(0., time.monotonic() - due))
+        try:
+            self.fcn()
+        except:
+            self.scheduler.logger.exception("{} failed".format(self.fcn))
+        finally:
+            self.last_called = datetime.now()
+            self.runs += 1
+            self.scheduler._completed(self)
+
+    def cancel(self):
+        """
+        Cancels the next runs of the job, a run in progress completes
+        """
+        self.cancelled = True
+        self.scheduler._cancelled(self)
+
+    def __str__(self):
+        return "{}<{} every {:.4f} seconds>".format(self.name, self.mode, self.interval)
+
+    def __repr__(self):
+        return "{}({!r},{!r},{!r},{!r},{!r})".format(self.__class__.__name__, self.fcn, self.interval, self.name, self.mode, self.jitter)
+
+
+class SchedulerService(Service, metaclass=patterns.Singleton):
+    """
+    Runs all the periodic jobs of the application from a single thread, keeping the next runs in a heap and handing the calls over to a
+    threadpool, rather than having a Timer thread per job.
+    Fixed rate jobs run on a fixed schedule regardless of how long they take: a run due while the previous one is still going is skipped.
+    Fixed delay jobs run interval seconds after the previous run completes, like Timer.
+    The lateness of the runs is recorded per job, see lateness.
+    """
+    DEFAULT_POOL_NAME = "Scheduler"
+    _POOL = 'pool'
+    _JITTER = 'jitter'
+
+    def __init__(self, domain):
+        super(SchedulerService, self).__init__(domain)
+        self._domain = domain
+        self.logger = domain.logger_service.get_logger(self.__class__.__name__)
+        self._default_pool_name = domain.get_param('scheduler', self._POOL, default=self.DEFAULT_POOL_NAME)
+        self._default_jitter = domain.get_param('scheduler', self._JITTER, default=0)
+        self._condition = Condition()
+        self._heap = []
+        self._sequence = itertools.count()
+        self._jobs = []
+        self._stopped = False
+        self._thread = None
+
+    def schedule(self, fcn, interval, name=None, mode=ScheduledJob.FIXED_RATE, jitter=None, immediate=False, pool_name=None):
+        """
+        Schedules fcn to be called every interval seconds
+        :param name: Name of the job, for logging and statistics
+        :param mode: ScheduledJob.FIXED_RATE or ScheduledJob.FIXED_DELAY
+        :param jitter: Maximum random delay in seconds added to each run, e.g. to spread the heartbeats of a fleet of nodes
+        :param immediate: True to run the job right away, otherwise the first run is interval seconds from now
+        :param pool_name: The ThreadpoolService pool running the job, the scheduler pool by default
+        :return: The ScheduledJob, to be cancelled once not needed anymore
+        """
+        pool = self._domain.get_service(ThreadpoolService).get_task_pool(pool_name or self._default_pool_name)
+        name = name or "Job-{}".format(len(self._jobs))
+        job = ScheduledJob(self, fcn, interval, name, mode, self._default_jitter if jitter is None else jitter, pool)
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("The scheduler is shut down")
+            self._jobs.append(job)
+            self._push(job, job._due(time.monotonic() + (0 if immediate else interval)))
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name=self.__class__.__name__, daemon=True)
+                self._thread.start()
+        return job
+
+    def _push(self, job, due):
+        heapq.heappush(self._heap, (due, next(self._sequence), job))
+        self._condition.notify()
+
+    def _dispatch(self, job, due):
+        try:
+            job.pool.add_task(job._run, due)
+        except Full:
+            self.logger.warning("{} skipped, the {} pool is full".format(job, job.pool._name))
+            job.missed += 1
+            return False
+        job.running = True
+        return True
+
+    def _run(self):
+        with self._condition:
+            while not self._stopped:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                due, _, job = self._heap[0]
+                now = time.monotonic()
+                if due > now:
+                    self._condition.wait(due - now)
+                    continue
+                heapq.heappop(self._heap)
+                if job.cancelled:
+                    continue
+                if job.mode == ScheduledJob.FIXED_RATE:
+                    if job.running:
+                        job.missed += 1
+                    else:
+                        self._dispatch(job, due)
+                    self._push(job, job._next_due(now))
+                elif not self._dispatch(job, due):
+                    self._push(job, job._due(now + job.interval))
+
+    def _completed(self, job):
+        with self._condition:
+            job.running = False
+            if job.mode == ScheduledJob.FIXED_DELAY and not job.cancelled and not self._stopped:
+                self._push(job, job._due(time.monotonic() + job.interval))
+
+    def _cancelled(self, job):
+        with self._condition:
+            if job in self._jobs:
+                self._jobs.remove(job)
+
+    def jobs(self):
+        with self._condition:
+            return list(self._jobs)
+
+    def lateness(self):
+        """
+        Returns the lateness statistics of the jobs {job name: WaitTimeStats}
+        """
+        return {job.name: job.lateness for job in self.jobs()}
+
+    def shutdown(self):
+        with self._condition:
+            self._stopped = True
+            for job in list(self._jobs):
+                job.cancel()
+            self._heap = []
+            self._condition.notify()
@@ -1,4 +1,7 @@
 from queue import Full
+import asyncio
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 import copy
 from functools import partial
 import threading
@@ -6,9 +9,13 @@ import time
 import unittest 
 import os
 
-from GoldenSource.python.common.concurrency import Trigger, RWLock
+from GoldenSource.python.common.concurrency import Trigger, RWLock, SemaphoreRWLock, Future, Threadpool, WorkStealingThreadpool, AssignedThreadpool, \
+    StealingAssignedThreadpool, ElasticThreadpool, DeadlineExceededError, AsyncTimer, InstrumentedLock, lock_monitor, \
+    ProcessPool
 from GoldenSource.python.services.monitor_service import MonitorService
-from GoldenSource.python.services.threadpool_service import ThreadpoolService, Threadify
+from GoldenSource.python.services.threadpool_service import ThreadpoolService, Threadify, AsyncThreadify
+from GoldenSource.python.services.process_pool_service import ProcessPoolService
+from GoldenSource.python.services.scheduler_service import SchedulerService, ScheduledJob
 from GoldenSource.python.common.domain import Domain
 from GoldenSource.python.common.config import LocalConfigurator
 
@@ -192,6 +199,539 @@ class Test(unittest.TestCase):
         non_blocking_pool.wait_completion()
         self.assertEqual(i, self.values['test_filling_non_blocking_queue:value'])
 
+    def test_work_stealing_pool(self):
+        pool = self.threading.get_pool('test_work_stealing_pool:pool', number=4, type=ThreadpoolService.STEALING_POOL)
+
+        def fan_out():
+            # Tasks added from a worker land on its own deque, the idle workers have to steal them
+            return [pool.add_task(time.sleep, 0.2) for _ in range(8)]
+
+        start = time.time()
+        futures = pool.add_task(fan_out).get()
+        pool.wait_completion()
+        self.assertTrue(all(future.done for future in futures))
+        self.assertLess(time.time() - start, 1.2)
+
+    def test_stealing_assigned_pool(self):
+        pool = self.threading.get_pool('test_stealing_assigned_pool:pool', number=4, type=ThreadpoolService.STEALING_ASSIGNED_POOL)
+        executed = {subject: [] for subject in range(3)}
+        active = {subject: 0 for subject in range(3)}
+        overlaps = []
+
+        def run(subject, i):
+            active[subject] += 1
+            if active[subject] > 1:
+                overlaps.append(subject)
+            time.sleep(0.01 if subject else 0.03)
+            executed[subject].append(i)
+            active[subject] -= 1
+
+        for i in range(20):
+            for subject in executed:
+                pool.add_task(subject, run, subject, i)
+        pool.wait_completion()
+        self.assertEqual(executed, {subject: list(range(20)) for subject in executed})
+        self.assertEqual(overlaps, [])
+
+    def test_terminate(self):
+        for clazz in (Threadpool, WorkStealingThreadpool, AssignedThreadpool):
+            pool = clazz('test_terminate:{}'.format(clazz.__name__), 20)
+            start = time.time()
+            self.assertTrue(pool.terminate())
+            self.assertLess(time.time() - start, 0.5)
+            self.assertFalse(any(worker.is_alive() for worker in pool))
+
+    def test_terminate_drain(self):
+        for clazz in (Threadpool, WorkStealingThreadpool):
+            pool = clazz('test_terminate_drain:{}'.format(clazz.__name__), 1)
+            futures = [pool.add_task(time.sleep, 0.05) for _ in range(5)]
+            self.assertTrue(pool.terminate(drain=True, timeout=5))
+            self.assertTrue(all(future.successful for future in futures))
+
+    def test_terminate_cancel(self):
+        for clazz in (Threadpool, WorkStealingThreadpool):
+            pool = clazz('test_terminate_cancel:{}'.format(clazz.__name__), 1)
+            futures = [pool.add_task(time.sleep, 0.2) for _ in range(5)]
+            time.sleep(0.05)
+            self.assertTrue(pool.terminate(timeout=5))
+            self.assertTrue(futures[0].successful)
+            self.assertTrue(all(future.cancelled() for future in futures[1:]))
+            self.assertRaises(concurrent.futures.CancelledError, futures[-1].get)
+
+    def test_cancel_stealing_pool(self):
+        pool = WorkStealingThreadpool('test_cancel_stealing_pool', 2, num_slots=8)
+        release = threading.Event()
+        running = [pool.add_task(release.wait, 5) for _ in range(2)]
+        queued = [pool.add_task(time.sleep, 0.01) for _ in range(6)]
+        self.assertRaises(Full, pool.add_task, time.sleep, 0.01)
+        while not all(future.running for future in running):
+            time.sleep(0.001)
+
+        # Cancelled while the workers are busy, the queued tasks give their releases of the semaphore and their slots back
+        pool._cancel_queued()
+        release.set()
+        self.assertTrue(all(future.get() for future in running))
+        self.assertTrue(all(future.cancelled() for future in queued))
+        pool.wait_completion()
+        time.sleep(0.05)
+        self.assertEqual(pool._queued._value, 0)
+
+        # Parked on the semaphore, the workers still run the new tasks and stop on request
+        futures = [pool.add_task(time.sleep, 0.01) for _ in range(8)]
+        pool.wait_completion()
+        self.assertTrue(all(future.successful for future in futures))
+        self.assertTrue(pool.terminate(timeout=1))
+
+        pool = StealingAssignedThreadpool('test_cancel_stealing_pool:assigned', 1, 4)
+        release.clear()
+        running = pool.add_task('first', release.wait, 5)
+        queued = [pool.add_task('second', time.sleep, 0.01) for _ in range(3)]
+        while not running.running:
+            time.sleep(0.001)
+        pool.stop()
+        release.set()
+        self.assertTrue(pool.join(timeout=1))
+        self.assertTrue(running.get())
+        self.assertTrue(all(future.cancelled() for future in queued))
+        self.assertEqual(pool._unfinished, 0)
+
+    def test_stealing_race(self):
+        pool = WorkStealingThreadpool('test_stealing_race', 2)
+        release = threading.Event()
+        running = [pool.add_task(release.wait, 5) for _ in range(2)]
+        while not all(future.running for future in running):
+            time.sleep(0.001)
+
+        # A worker takes the release of a task which another worker then runs, the task added meanwhile lands in a deque
+        # already scanned: the worker keeps looking until it finds it
+        first = pool.add_task(time.sleep, 0.01)
+        pool._queued.acquire()
+        self.assertIs(pool[0].tasks.pop(), first)
+        second = Future(time.sleep, 0.01)
+        threading.Timer(0.05, pool._submit, (second, pool[0])).start()
+        self.assertIs(pool[1]._next_task(), second)
+        second()
+        pool._task_done()
+        pool[0].tasks.append(first)
+
+        # The task of the release taken is cancelled, the worker gives up
+        pool._queued.acquire()
+        pool._cancel_queued()
+        self.assertIsNone(pool[1]._next_task())
+        self.assertTrue(first.cancelled())
+        self.assertEqual(pool._vanished, 0)
+
+        release.set()
+        pool.wait_completion()
+        self.assertTrue(second.successful)
+        futures = [pool.add_task(time.sleep, 0.01) for _ in range(4)]
+        pool.wait_completion()
+        self.assertTrue(all(future.successful for future in futures))
+        self.assertTrue(pool.terminate(timeout=1))
+
+    def test_subject_pools(self):
+        for pool_type in (ThreadpoolService.ASSIGNED_POOL, ThreadpoolService.STEALING_ASSIGNED_POOL):
+            pool_name = 'test_subject_pools:{}'.format(pool_type)
+            pool = self.threading.get_pool(pool_name, number=2, type=pool_type)
+            futures = [pool.add_task(subject, time.sleep, 0.01) for subject in range(4)]
+            pool.wait_completion()
+            self.assertTrue(all(future.successful for future in futures))
+            # Plain calls have no subject to be run for
+            self.assertRaises(TypeError, Threadify(pool_name)(time.sleep), 0.01)
+            self.assertRaises(TypeError, self.threading.get_executor, pool_name)
+
+    def test_priority(self):
+        pool = self.threading.get_pool('test_priority', number=1, priority_queue=True)
+        order = []
+        blocker = pool.schedule_task(Threadpool.HIGH_PRIORITY, None, time.sleep, 0.2)
+        time.sleep(0.05)
+        low = [pool.schedule_task(Threadpool.LOW_PRIORITY, None, order.append, ('low', i)) for i in range(3)]
+        high = [pool.schedule_task(Threadpool.HIGH_PRIORITY, None, order.append, ('high', i)) for i in range(3)]
+        pool.wait_completion()
+        self.assertTrue(all(future.successful for future in [blocker] + low + high))
+        self.assertEqual(order, [('high', i) for i in range(3)] + [('low', i) for i in range(3)])
+        wait_times = pool.wait_times()
+        self.assertEqual(wait_times[Threadpool.LOW_PRIORITY].count, 3)
+        self.assertEqual(wait_times[Threadpool.HIGH_PRIORITY].count, 4)
+        self.assertGreater(wait_times[Threadpool.LOW_PRIORITY].mean, wait_times[Threadpool.HIGH_PRIORITY].mean)
+        self.assertIn('test_priority', self.threading.wait_times())
+
+    def test_deadline(self):
+        for clazz in (Threadpool, WorkStealingThreadpool):
+            pool = clazz('test_deadline:{}'.format(clazz.__name__), 1)
+            values = []
+            pool.add_task(time.sleep, 0.2)
+            expired = pool.schedule_task(Threadpool.DEFAULT_PRIORITY, 0.05, values.append, 'expired')
+            in_time = pool.schedule_task(Threadpool.DEFAULT_PRIORITY, 5, values.append, 'in time')
+            pool.wait_completion()
+            self.assertEqual(values, ['in time'])
+            self.assertTrue(expired.done)
+            self.assertFalse(expired.successful)
+            self.assertRaises(DeadlineExceededError, expired.get)
+            self.assertTrue(in_time.successful)
+            self.assertTrue(pool.terminate(timeout=5))
+
+    def test_elastic_pool(self):
+        pool = self.threading.get_pool('test_elastic', type=ThreadpoolService.ELASTIC_POOL, number=1, max_number=4, idle_timeout=0.2,
+                                       max_queue_depth=2, max_wait_time=0.05)
+        self.assertEqual(self.threading.pool_sizes()['test_elastic'], 1)
+        futures = [pool.add_task(time.sleep, 0.3) for _ in range(8)]
+        time.sleep(0.1)
+        futures.append(pool.add_task(time.sleep, 0.3))
+        self.assertEqual(pool.size, 4)
+        pool.wait_completion()
+        self.assertTrue(all(future.successful for future in futures))
+        # Back to the minimum once idle
+        deadline = time.time() + 5
+        while pool.size > 1 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.threading.pool_sizes()['test_elastic'], 1)
+        actions = [event.action for event in self.threading.scaling_events()['test_elastic']]
+        self.assertEqual(actions, [ElasticThreadpool.GROW] * 3 + [ElasticThreadpool.REAP] * 3)
+        # Still serving after shrinking
+        self.assertEqual(pool.add_task(self.add_one, 1).get(5), 2)
+
+    @AsyncThreadify('test_asyncio')
+    def async_set_with_delay(self, k, v):
+        return self.set_with_delay(k, v)
+
+    def test_asyncio_bridge(self):
+        self.values = {}
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            loop.set_default_executor(self.threading.get_executor('test_asyncio', number=4))
+            pool_threads = set(self.threading.get_pool('test_asyncio'))
+            names = await asyncio.gather(*[loop.run_in_executor(None, lambda: threading.current_thread().name) for _ in range(4)])
+            self.assertTrue(all(name.startswith('test_asyncio:') for name in names))
+            # Decorated methods are coroutine functions, the blocking calls run concurrently on the pool
+            start = time.time()
+            values = await asyncio.gather(*[self.async_set_with_delay(k, k * 2) for k in range(4)])
+            self.assertLess(time.time() - start, 2)
+            self.assertEqual(values, [0, 2, 4, 6])
+            # Timers run blocking callables on the executor and coroutines on the loop
+            calls = []
+
+            async def tick():
+                calls.append('async')
+
+            timers = [AsyncTimer(lambda: calls.append(threading.current_thread() in pool_threads), 0.05, immediate=True),
+                      AsyncTimer(tick, 0.05)]
+            for timer in timers:
+                timer.start()
+            await asyncio.sleep(0.28)
+            for timer in timers:
+                timer.stop()
+                await timer.join()
+            return calls
+
+        calls = asyncio.run(main())
+        self.assertEqual(self.values, {0: 0, 1: 2, 2: 4, 3: 6})
+        self.assertGreaterEqual(calls.count(True), 5)
+        self.assertGreaterEqual(calls.count('async'), 4)
+        self.assertNotIn(False, calls)
+        # The pool outlives the loop and its executor
+        self.assertEqual(self.threading.get_pool('test_asyncio').add_task(self.add_one, 1).get(5), 2)
+
+    @staticmethod
+    def add_one(x):
+        return x + 1
+
+_WORKER_STATE = {}
+
+
+def _load_state(value):
+    _WORKER_STATE['value'] = value
+    _WORKER_STATE['pid'] = os.getpid()
+
+
+def _worker_pid(x):
+    # Slow enough for every worker to get some of the items
+    time.sleep(0.01)
+    return _WORKER_STATE['pid'], _WORKER_STATE['value'] + x
+
+
+def _square(x):
+    if x < 0:
+        raise ValueError(x)
+    return x * x
+
+
+def _exit(x):
+    if x == 3:
+        os._exit(1)
+    return x
+
+
+def _lock(x):
+    return threading.Lock()
+
+
+def _scale_rows(X):
+    return X * 2 + 1
+
+
+def _row_sums(X):
+    return X.sum(axis=1)
+
+
+class ProcessPoolTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.processes = Domain(TestConfigurator).get_service(ProcessPoolService)
+
+    def test_warm_workers(self):
+        pool = self.processes.get_pool('test_warm_workers', number=2, initializer=_load_state, initargs=(10,))
+        first = pool.map(range(20), _worker_pid)
+        second = pool.map(range(20), _worker_pid, chunksize=5)
+        self.assertEqual([value for _, value in first], list(range(10, 30)))
+        self.assertEqual([value for _, value in second], list(range(10, 30)))
+        # The same processes serve every call
+        pids = {pid for pid, _ in first + second}
+        self.assertEqual(pids, {p.pid for p in pool.procs})
+        self.assertNotIn(os.getpid(), pids)
+
+    def test_imap(self):
+        pool = self.processes.get_pool('test_imap', number=2, chunksize=3, max_pending=2)
+        consumed = []
+
+        def items():
+            for x in range(100):
+                consumed.append(x)
+                yield x
+
+        results = pool.imap(items(), _square)
+        self.assertEqual([next(results) for _ in range(3)], [0, 1, 4])
+        # Backpressure: only max_pending chunks have been pulled from the input
+        self.assertLessEqual(len(consumed), 3 * 3)
+        results.close()
+        self.assertEqual(self.processes.map(_square, range(10), pool_name='test_imap'), [x * x for x in range(10)])
+        self.assertRaises(ValueError, pool.map, [1, -1, 2], _square)
+        # The pool is still usable after an error
+        self.assertEqual(list(self.processes.imap(_square, range(5), pool_name='test_imap')), [0, 1, 4, 9, 16])
+
+    def test_concurrent_calls(self):
+        pool = self.processes.get_pool('test_concurrent_calls', number=2, max_pending=2)
+        # Calls made while iterating over the results of another, or while another is left unfinished, do not wait for it
+        nested = [(x, pool.map(range(x), _square)) for x in pool.imap(range(5), _square)]
+        self.assertEqual(nested, [(x * x, [y * y for y in range(x * x)]) for x in range(5)])
+        abandoned = pool.imap(range(100), _square)
+        self.assertEqual(next(abandoned), 0)
+        self.assertEqual(pool.map(range(10), _square), [x * x for x in range(10)])
+
+        results = {}
+
+        def run(i):
+            results[i] = pool.map(range(i * 10, i * 10 + 50), _square)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(results, {i: [x * x for x in range(i * 10, i * 10 + 50)] for i in range(4)})
+        self.assertEqual(list(abandoned), [x * x for x in range(1, 100)])
+
+    def test_broken_pool(self):
+        with ProcessPool(nprocs=2) as pool:
+            # Results that cannot be pickled fail the call, not the pool
+            self.assertRaises(RuntimeError, pool.map, range(4), _lock)
+            self.assertEqual(pool.map(range(4), _square), [0, 1, 4, 9])
+            self.assertRaises(BrokenProcessPool, pool.map, range(10), _exit)
+            self.assertRaises(BrokenProcessPool, pool.map, range(4), _square)
+
+    def test_map_array(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        self.processes.get_pool('test_map_array', number=2)
+        X = numpy.arange(30000, dtype=float).reshape(10000, 3)
+        numpy.testing.assert_array_equal(self.processes.map_array(_scale_rows, X, pool_name='test_map_array', rows=999), X * 2 + 1)
+        sums = self.processes.map_array(_row_sums, X, pool_name='test_map_array', out_dtype=int, out_shape=())
+        self.assertEqual(sums.dtype, numpy.dtype(int))
+        numpy.testing.assert_array_equal(sums, X.sum(axis=1))
+        self.assertRaises(ValueError, self.processes.map_array, _square, -X, pool_name='test_map_array')
+        # Python objects cannot be shared
+        labels = numpy.array([['a', 1]] * 10, dtype=object)
+        self.assertRaisesRegex(ValueError, 'dtype object', self.processes.map_array, _scale_rows, labels, pool_name='test_map_array')
+        self.assertRaisesRegex(ValueError, 'dtype object', self.processes.map_array, _scale_rows, X, pool_name='test_map_array',
+                               out_dtype=object)
+        try:
+            import pandas
+        except ImportError:
+            return
+        frame = pandas.DataFrame(X, columns=['a', 'b', 'c'], index=numpy.arange(10000) * 2)
+        result = self.processes.map_array(_row_sums, frame, pool_name='test_map_array', out_shape=())
+        pandas.testing.assert_series_equal(result, frame.sum(axis=1))
+        frame['d'] = 'label'
+        self.assertRaisesRegex(ValueError, 'dtype object', self.processes.map_array, _row_sums, frame, pool_name='test_map_array')
+
+class LockMonitorTestCase(unittest.TestCase):
+    def tearDown(self):
+        lock_monitor.enable(False)
+        lock_monitor.reset()
+
+    def test_disabled(self):
+        lock_monitor.enable(False)
+        lock = RWLock('test_disabled')
+        self.assertNotIsInstance(lock._mutex, InstrumentedLock)
+        with lock.write_lock():
+            pass
+        self.assertEqual(lock_monitor.snapshot(), {})
+
+    def test_contention(self):
+        lock_monitor.enable()
+        rlock = lock_monitor.lock('test.rlock', threading.RLock())
+        with rlock:
+            with rlock:
+                pass
+            self.assertTrue(rlock.locked())
+        self.assertFalse(rlock.locked())
+
+        lock = RWLock('test')
+
+        def write():
+            with lock.write_lock():
+                time.sleep(0.1)
+
+        writers = [threading.Thread(target=write) for _ in range(3)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        snapshot = lock_monitor.snapshot()
+        stats = snapshot['test.write']
+        self.assertEqual(stats.acquisitions, 3)
+        self.assertEqual(stats.contentions, 2)
+        self.assertGreater(stats.wait_total, 0.25)
+        self.assertGreater(stats.hold_max, 0.09)
+        self.assertEqual(snapshot['test.rlock'].acquisitions, 2)
+        self.assertEqual(lock_monitor.report().splitlines()[0].split()[0], 'test.write')
+
+    def test_condition(self):
+        lock_monitor.enable()
+        lock = lock_monitor.lock('test.condition', threading.RLock())
+        condition = threading.Condition(lock)
+        self.assertFalse(lock._is_owned())
+        with condition:
+            self.assertTrue(lock._is_owned())
+            condition.notify_all()
+            self.assertFalse(condition.wait(0.01))
+        self.assertFalse(lock._is_owned())
+        # The ownership checks of notify and wait are not acquisitions, the wait re-acquiring the lock is
+        self.assertEqual(lock_monitor.snapshot()['test.condition'].acquisitions, 2)
+
+class SchedulerTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.scheduler = Domain(TestConfigurator).get_service(SchedulerService)
+
+    def test_fixed_rate_and_delay(self):
+        calls = {ScheduledJob.FIXED_RATE: [], ScheduledJob.FIXED_DELAY: []}
+
+        def job(mode):
+            calls[mode].append(time.monotonic())
+            time.sleep(0.05)
+
+        start = time.monotonic()
+        jobs = [self.scheduler.schedule(partial(job, mode), 0.1, name=mode, mode=mode) for mode in calls]
+        time.sleep(1.03)
+        for job in jobs:
+            job.cancel()
+        # Fixed rate runs never start before their occurrence and do not drift by their own duration, every occurrence being either run
+        # or counted as missed. Fixed delay runs start interval seconds after the previous one completed
+        rate = [t - start for t in calls[ScheduledJob.FIXED_RATE]]
+        delay = calls[ScheduledJob.FIXED_DELAY]
+        self.assertTrue(all(t >= 0.1 * (k + 1) for k, t in enumerate(rate)))
+        self.assertTrue(all(second - first >= 0.15 for first, second in zip(delay, delay[1:])))
+        self.assertGreater(len(rate) + jobs[0].missed, len(delay))
+        lateness = jobs[0].lateness
+        self.assertEqual(lateness.count, len(rate))
+        self.assertNotIn(ScheduledJob.FIXED_RATE, self.scheduler.lateness())
+
+    def test_skip_and_jitter(self):
+        calls = []
+        slow = self.scheduler.schedule(lambda: calls.append(time.monotonic()) or time.sleep(0.25), 0.1, name='slow', immediate=True)
+        jittered = self.scheduler.schedule(lambda: None, 0.05, name='jittered', jitter=0.04)
+        time.sleep(0.65)
+        slow.cancel()
+        jittered.cancel()
+        # A run due while the previous one is still going is skipped, the runs never overlap
+        self.assertTrue(all(second - first >= 0.25 for first, second in zip(calls, calls[1:])))
+        self.assertGreater(slow.missed, 0)
+        # Jitter delays the runs without shifting the schedule, the occurrences still come every interval
+        self.assertGreaterEqual(jittered.runs + jittered.missed, 11)
+        self.assertRaises(ValueError, self.scheduler.schedule, lambda: None, 1, mode='hourly')
+
+class FutureTestCase(unittest.TestCase):
+    @staticmethod
+    def add(x, y=1):
+        return x + y
+
+    def test_done_callback(self):
+        done = []
+        future = Future(self.add, 1, y=2)
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [])
+        self.assertEqual(future(), 3)
+        self.assertEqual(done, [future])
+        # Registered after completion, called right away
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [future, future])
+        self.assertEqual(str(future), "add(1, y=2)")
+
+    def test_wait_from_threads(self):
+        future = Future(time.sleep, 0.2)
+        waiters = [threading.Thread(target=future.get) for _ in range(4)]
+        for waiter in waiters:
+            waiter.start()
+        self.assertRaises(TimeoutError, future.get, 0.01)
+        threading.Thread(target=future).start()
+        for waiter in waiters:
+            waiter.join(5)
+            self.assertFalse(waiter.is_alive())
+        self.assertTrue(future.done)
+        self.assertTrue(future.successful)
+
+    def test_cancel(self):
+        future = Future(self.add, 1)
+        self.assertTrue(future.cancel())
+        self.assertIsNone(future())
+        self.assertTrue(future.done)
+        self.assertTrue(future.cancelled())
+        self.assertRaises(concurrent.futures.CancelledError, future.get)
+
+        future = Future(self.add, 1)
+        future()
+        self.assertFalse(future.cancel())
+        self.assertIsNone(future.exception())
+
+    def test_asyncio(self):
+        async def wait_for(future):
+            return await future
+
+        future = Future(self.add, 2)
+        threading.Timer(0.1, future).start()
+        self.assertEqual(asyncio.run(wait_for(future)), 3)
+
+        future = Future(self.add, None)
+        threading.Timer(0.1, future).start()
+        self.assertRaises(TypeError, asyncio.run, wait_for(future))
+
+        future = Future(self.add, 2)
+        future()
+        self.assertEqual(future.concurrent_future().result(), 3)
+
+    def test_inline_completion(self):
+        # A future completed before anyone waits on it never allocates a latch, and holds no instance dictionary
+        for i in range(1000):
+            future = Future(self.add, i, y=i)
+            future()
+            self.assertEqual(future.get(), 2 * i)
+            self.assertIsNone(future._latch)
+        self.assertFalse(hasattr(future, '__dict__'))
+
 class Writer(threading.Thread):
     def __init__(self, buffer_, rw_lock, init_sleep_time, sleep_time, to_write):
         """
@@ -345,6 +885,86 @@ class RWLockTestCase(unittest.TestCase):
         self.assertTrue(threads[5].exit_time <= threads[3].entry_time)
         self.assertTrue(threads[5].exit_time <= threads[4].entry_time)
 
+    def test_reentrant(self):
+        rw_lock = RWLock(reentrant=True)
+        with rw_lock.write_lock():
+            with rw_lock.write_lock():
+                with rw_lock.read_lock():
+                    pass
+        # A nested read does not wait for the pending writer
+        entered = threading.Event()
+
+        def write():
+            with rw_lock.write_lock():
+                entered.set()
+
+        with rw_lock.read_lock():
+            writer = threading.Thread(target=write)
+            writer.start()
+            time.sleep(0.1)
+            with rw_lock.read_lock():
+                self.assertFalse(entered.is_set())
+        writer.join(5)
+        self.assertTrue(entered.is_set())
+        # Not reentrant by default
+        plain = RWLock()
+        plain.writer_acquire()
+        self.assertRaises(RuntimeError, plain.writer_acquire)
+        plain.writer_release()
+
+    def test_upgrade_downgrade(self):
+        (buffer_, rw_lock, threads) = self._init_variables()
+        rw_lock.reader_acquire()
+        # Readers arrived before the upgrade finish, then no writer gets in before the upgraded reader
+        threads.append(Reader(buffer_, rw_lock, 0, 0.2))
+        threads.append(Writer(buffer_, rw_lock, 0.1, 0, 2))
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        rw_lock.upgrade()
+        upgraded_at = time.time()
+        buffer_.append(1)
+        rw_lock.downgrade()
+        self.assertEqual(buffer_, [1])
+        rw_lock.reader_release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(buffer_, [1, 2])
+        self.assertTrue(threads[0].exit_time <= upgraded_at)
+        self.assertTrue(upgraded_at <= threads[1].entry_time)
+
+    def test_reader_throughput(self):
+        iterations = 10000
+
+        def throughput(clazz, num_threads):
+            rw_lock = clazz()
+            start = threading.Barrier(num_threads + 1)
+
+            reads = []
+
+            def read():
+                start.wait()
+                for _ in range(iterations):
+                    rw_lock.reader_acquire()
+                    rw_lock.reader_release()
+                reads.append(iterations)
+
+            readers = [threading.Thread(target=read) for _ in range(num_threads)]
+            for reader in readers:
+                reader.start()
+            t = time.perf_counter()
+            start.wait()
+            for reader in readers:
+                reader.join()
+            elapsed = time.perf_counter() - t
+            self.assertEqual(sum(reads), num_threads * iterations)
+            return sum(reads) / elapsed
+
+        # Both locks let concurrent readers through, the relative throughput is machine dependent and not asserted
+        for num_threads in (1, 4, 16):
+            for clazz in (SemaphoreRWLock, RWLock):
+                self.assertGreater(throughput(clazz, num_threads), 0)
+
     @staticmethod
     def _init_variables():
         buffer_ = []
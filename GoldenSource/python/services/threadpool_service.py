@@ -1,8 +1,11 @@
+import concurrent.futures
 import functools
+import time
 
 from GoldenSource.python.utils import patterns
 from GoldenSource.python.common.domain import Domain
-from GoldenSource.python.common.concurrency import Threadpool
+from GoldenSource.python.common.concurrency import Threadpool, ElasticThreadpool, WorkStealingThreadpool, AssignedThreadpool, StealingAssignedThreadpool, \
+    TERMINATE_TIMEOUT
 from GoldenSource.python.common.services import Service
 
 
@@ -20,6 +23,36 @@ class ThreadpoolService(Service, metaclass=patterns.Singleton):
     _THREAD_COUNT = 'number'
     _QUEUE_SIZE = 'queue'
     _BLOCKING_QUEUE = 'blocking_queue'
+    _POOL_TYPE = 'type'
+    _PRIORITY_QUEUE = 'priority_queue'
+    # Parameters of the elastic pools, whose thread count is the minimum number of threads
+    _MAX_THREAD_COUNT = 'max_number'
+    _IDLE_TIMEOUT = 'idle_timeout'
+    _MAX_QUEUE_DEPTH = 'max_queue_depth'
+    _MAX_WAIT_TIME = 'max_wait_time'
+    _ELASTIC_DEFAULTS = {
+        _IDLE_TIMEOUT: ElasticThreadpool.DEFAULT_IDLE_TIMEOUT,
+        _MAX_QUEUE_DEPTH: ElasticThreadpool.DEFAULT_MAX_QUEUE_DEPTH,
+        _MAX_WAIT_TIME: ElasticThreadpool.DEFAULT_MAX_WAIT_TIME,
+    }
+    _DRAIN_ON_SHUTDOWN = 'drain_on_shutdown'
+    _SHUTDOWN_TIMEOUT = 'shutdown_timeout'
+
+    # Pool implementations selectable with the type parameter: a single shared queue, growing and shrinking with the load for the elastic
+    # pools, work-stealing deques, and their counterparts running the tasks of each subject in order (add_task(subject, func, ...))
+    SHARED_POOL = 'shared'
+    ELASTIC_POOL = 'elastic'
+    STEALING_POOL = 'stealing'
+    ASSIGNED_POOL = 'assigned'
+    STEALING_ASSIGNED_POOL = 'stealing_assigned'
+    POOL_TYPES = {
+        SHARED_POOL: Threadpool,
+        ELASTIC_POOL: ElasticThreadpool,
+        STEALING_POOL: WorkStealingThreadpool,
+        ASSIGNED_POOL: AssignedThreadpool,
+        STEALING_ASSIGNED_POOL: StealingAssignedThreadpool,
+    }
+    SUBJECT_POOL_TYPES = (ASSIGNED_POOL, STEALING_ASSIGNED_POOL)
 
     def __init__(self, domain):
         super(ThreadpoolService, self).__init__(domain)
@@ -27,6 +60,10 @@ class ThreadpoolService(Service, metaclass=patterns.Singleton):
         self._default_thread_count = domain.get_param('threading', self._THREAD_COUNT, default=self.DEFAULT_POOL_SIZE)
         self._default_queue_size = domain.get_param('threading', self._QUEUE_SIZE, default=0)
         self._default_blocking_queue = domain.get_param('threading', self._BLOCKING_QUEUE, default=False)
+        self._default_pool_type = domain.get_param('threading', self._POOL_TYPE, default=self.SHARED_POOL)
+        self._default_priority_queue = domain.get_param('threading', self._PRIORITY_QUEUE, default=False)
+        self._drain_on_shutdown = domain.get_param('threading', self._DRAIN_ON_SHUTDOWN, default=False)
+        self._shutdown_timeout = domain.get_param('threading', self._SHUTDOWN_TIMEOUT, default=TERMINATE_TIMEOUT)
         self._pools = {}
 
     def __getitem__(self, name):
@@ -46,31 +83,146 @@ class ThreadpoolService(Service, metaclass=patterns.Singleton):
                 self._BLOCKING_QUEUE
                 , self._domain.get_param('threading', name, self._BLOCKING_QUEUE, default=self._default_blocking_queue)
             )
-            self._pools[name] = Threadpool(name, thread_count, queue_size, blocking=blocking_queue)
+            pool_type = kwargs.get(
+                self._POOL_TYPE
+                , self._domain.get_param('threading', name, self._POOL_TYPE, default=self._default_pool_type)
+            )
+            if pool_type not in self.POOL_TYPES:
+                raise ValueError("Unknown pool type {} for pool {}".format(pool_type, name))
+            options = {}
+            if pool_type in (self.SHARED_POOL, self.ELASTIC_POOL):
+                # Only the shared queues can be ordered by priority, the other pools run their tasks FIFO
+                options['priority'] = kwargs.get(
+                    self._PRIORITY_QUEUE
+                    , self._domain.get_param('threading', name, self._PRIORITY_QUEUE, default=self._default_priority_queue)
+                )
+            if pool_type == self.ELASTIC_POOL:
+                options['max_threads'] = kwargs.get(
+                    self._MAX_THREAD_COUNT
+                    , self._domain.get_param('threading', name, self._MAX_THREAD_COUNT,
+                                             default=self._domain.get_param('threading', self._MAX_THREAD_COUNT, default=thread_count))
+                )
+                for key, default in self._ELASTIC_DEFAULTS.items():
+                    options[key] = kwargs.get(
+                        key
+                        , self._domain.get_param('threading', name, key, default=self._domain.get_param('threading', key, default=default))
+                    )
+            self._pools[name] = self.POOL_TYPES[pool_type](name, thread_count, queue_size, blocking=blocking_queue, **options)
         return self._pools[name]
 
+    def get_task_pool(self, name=DEFAULT_POOL_NAME, **kwargs):
+        """
+        Returns the named pool, checking that it runs plain calls, add_task(func, ...), as opposed to the pools running the tasks of each
+        subject in order, add_task(subject, func, ...)
+        :param kwargs: Pool parameters, see get_pool
+        """
+        pool = self.get_pool(name, **kwargs)
+        if isinstance(pool, tuple(self.POOL_TYPES[pool_type] for pool_type in self.SUBJECT_POOL_TYPES)):
+            raise TypeError("Pool {} runs the tasks of each subject in order, add_task(subject, func, ...), it cannot run plain calls".format(name))
+        return pool
+
     def wait_completion(self):
         for pool in self._pools.values():
             pool.wait_completion()
 
-    def shutdown(self):
+    def get_executor(self, name=DEFAULT_POOL_NAME, **kwargs):
+        """
+        Returns a concurrent.futures executor submitting to the given pool, e.g. for loop.run_in_executor or loop.set_default_executor, so that
+        asyncio code offloads its blocking calls onto the named pools rather than onto a thread pool of its own
+        :param kwargs: Pool parameters, see get_pool
+        """
+        return PoolExecutor(self.get_task_pool(name, **kwargs))
+
+    def pool_sizes(self):
+        """
+        Returns the current number of threads of the pools {pool name: size}
+        """
+        return {name: len(pool) for name, pool in self._pools.items()}
+
+    def scaling_events(self):
+        """
+        Returns the latest scaling events of the elastic pools {pool name: [ScalingEvent]}
+        """
+        return {name: pool.events() for name, pool in self._pools.items() if isinstance(pool, ElasticThreadpool)}
+
+    def wait_times(self):
+        """
+        Returns the queue wait time statistics of the pools {pool name: {priority: WaitTimeStats}}
+        """
+        return {name: pool.wait_times() for name, pool in self._pools.items() if hasattr(pool, 'wait_times')}
+
+    def shutdown(self, drain=None):
+        """
+        Stops all the pools at once, then waits for their threads within the shutdown timeout
+        :param drain: True to run the tasks already queued first, False to cancel them. Defaults to the drain_on_shutdown parameter
+        """
+        drain = self._drain_on_shutdown if drain is None else drain
         for pool in self._pools.values():
-            pool.terminate()
+            pool.stop(drain)
+        deadline = time.monotonic() + self._shutdown_timeout
+        for pool in self._pools.values():
+            pool.join(max(0., deadline - time.monotonic()))
+
+
+class PoolExecutor(concurrent.futures.ThreadPoolExecutor):
+    """
+    Executor running its calls on a ThreadpoolService pool. It starts no thread of its own, deriving from ThreadPoolExecutor only because
+    event loops only accept those as default executor.
+    The pool belongs to the service: shutting the executor down refuses new calls but leaves the pool running.
+    """
+
+    def __init__(self, pool):
+        super(PoolExecutor, self).__init__(max_workers=1)
+        self.pool = pool
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._shutdown_lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+        return self.pool.add_task(fn, *args, **kwargs).concurrent_future()
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._shutdown_lock:
+            self._shutdown = True
+
+    def __repr__(self):
+        return "PoolExecutor({!r})".format(self.pool._name)
 
 
 class Threadify(object):
     """
     Convenient decorator to implicitly call a given function or method on a given threadpool. Uses the ThreadPoolService under the hood
     The wrapped function will return a Future.
+    Optionally, the calls are queued with a priority and dropped if not started within timeout seconds, see Threadpool.schedule_task
     """
 
-    def __init__(self, pool_name=ThreadpoolService.DEFAULT_POOL_NAME):
+    def __init__(self, pool_name=ThreadpoolService.DEFAULT_POOL_NAME, priority=None, timeout=None):
         self.pool_name = pool_name
+        self.priority = priority
+        self.timeout = timeout
 
     def __call__(self, func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            pool = Domain().get_service(ThreadpoolService).get_pool(self.pool_name)
-            return pool.add_task(func, *args, **kwargs)
+            pool = Domain().get_service(ThreadpoolService).get_task_pool(self.pool_name)
+            if self.priority is None and self.timeout is None:
+                return pool.add_task(func, *args, **kwargs)
+            priority = Threadpool.DEFAULT_PRIORITY if self.priority is None else self.priority
+            return pool.schedule_task(priority, self.timeout, func, *args, **kwargs)
+
+        return wrapper
+
+
+class AsyncThreadify(Threadify):
+    """
+    Threadify variant for asyncio code: the wrapped function becomes a coroutine function, awaiting the result of the call on the pool
+    """
+
+    def __call__(self, func):
+        call = super(AsyncThreadify, self).__call__(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await call(*args, **kwargs)
 
-        return wrapper
\ No newline at end of file
+        return wrapper